@@ -0,0 +1,256 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""
+Precomputed bank of augmented training epochs.
+
+The augmentations do not depend on the hyperparameters of a run, so instead of recomputing them
+in every run of a grid, K augmented epochs are materialised once into compressed shards of uint8
+images, keyed by (dataset, augmentation, seed). During training, epoch e is replayed from bank
+epoch e mod K without any augmentation cost.
+
+Usage:
+    python augmentation_bank.py --dataset cifar100 --augmentation_name auto_augment --num_epochs 10
+    python train.py --dataset cifar100 --augmentation_name auto_augment --augmentation_bank_dir save/augmentation_banks
+"""
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+import torch
+import torch.utils.data as data
+from torchvision.transforms import v2 as transforms
+from tqdm import tqdm
+
+from cifar100_utils import (
+    get_train_validation_set,
+    get_resize_transform,
+    set_dataset,
+    get_dataset_name,
+)
+
+
+def get_bank_dir(bank_root, dataset_name, augmentation_name, seed):
+    """Returns the directory of the bank of the given (dataset, augmentation, seed)."""
+    return os.path.join(bank_root, f"{dataset_name}_{augmentation_name}_seed{seed}")
+
+
+def get_uint8_augmentation(augmentation_name):
+    """Returns the augmentation to apply on the uint8 images in their native resolution."""
+    if augmentation_name == "auto_augment":
+        return transforms.AutoAugment(transforms.AutoAugmentPolicy.CIFAR10)
+    elif augmentation_name == "random_hflip":
+        return transforms.RandomHorizontalFlip(p=0.5)
+    else:
+        raise NotImplementedError(f"Augmentation name {augmentation_name}")
+
+
+def get_bank_transform(image_size=224):
+    """Returns the per-sample transform that turns the uint8 bank images into normalized model inputs."""
+    mean = (0.5071, 0.4867, 0.4408)
+    std = (0.2675, 0.2565, 0.2761)
+    return transforms.Compose(
+        get_resize_transform(image_size)
+        + [
+            transforms.ToDtype(torch.float32, scale=True),
+            transforms.Normalize(mean, std),
+        ]
+    )
+
+
+class AugmentedDataset(data.Dataset):
+    """Applies a transform on top of the samples of a dataset."""
+
+    def __init__(self, dataset, transform):
+        self.dataset = dataset
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        img, target = self.dataset[idx]
+        return self.transform(img), target
+
+
+def create_bank(
+    data_dir,
+    bank_dir,
+    augmentation_name,
+    num_epochs,
+    seed,
+    shard_size=5000,
+    num_workers=4,
+    print_tqdm_interval=1.0,
+):
+    """
+    Materialises num_epochs augmented epochs of the training set into bank_dir.
+    Each epoch is split into compressed shards of shard_size uint8 images. Epochs that
+    are already complete in the bank are skipped, so an interrupted run can be resumed.
+    """
+    os.makedirs(bank_dir, exist_ok=True)
+    train_dataset, _ = get_train_validation_set(data_dir, batch_augmentation=True)
+    augmented_dataset = AugmentedDataset(
+        train_dataset, get_uint8_augmentation(augmentation_name)
+    )
+    num_shards = (len(augmented_dataset) + shard_size - 1) // shard_size
+
+    for epoch in range(num_epochs):
+        if len(glob.glob(os.path.join(bank_dir, f"epoch{epoch:03d}_shard*.npz"))) == num_shards:
+            continue
+
+        # Seed every epoch separately, so the bank does not depend on which epochs were resumed
+        generator = torch.Generator().manual_seed(seed * 1000003 + epoch)
+        loader = data.DataLoader(
+            augmented_dataset,
+            batch_size=shard_size,
+            shuffle=False,
+            num_workers=num_workers,
+            generator=generator,
+        )
+        torch.manual_seed(seed * 1000003 + epoch)
+        for shard, (images, targets) in enumerate(
+            tqdm(
+                loader,
+                desc=f"Bank epoch {epoch}",
+                mininterval=print_tqdm_interval,
+                maxinterval=print_tqdm_interval,
+            )
+        ):
+            shard_file = os.path.join(bank_dir, f"epoch{epoch:03d}_shard{shard:03d}.npz")
+            tmp_file = os.path.join(bank_dir, f"tmp_epoch{epoch:03d}_shard{shard:03d}.npz")
+            np.savez_compressed(tmp_file, images=images.numpy(), targets=targets.numpy())
+            os.replace(tmp_file, shard_file)
+
+    meta = {
+        "dataset": get_dataset_name(),
+        "augmentation_name": augmentation_name,
+        "seed": seed,
+        "num_epochs": num_epochs,
+        "num_samples": len(augmented_dataset),
+        "shard_size": shard_size,
+    }
+    with open(os.path.join(bank_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+class AugmentationBankDataset(data.Dataset):
+    """
+    Replays the augmented training set from a bank created by create_bank.
+    Call set_epoch at the start of every epoch; epoch e is read from bank epoch e mod K.
+    """
+
+    def __init__(self, bank_dir, transform=None):
+        meta_file = os.path.join(bank_dir, "meta.json")
+        if not os.path.isfile(meta_file):
+            raise FileNotFoundError(
+                f"No augmentation bank found in {bank_dir}, create it with augmentation_bank.py first"
+            )
+        with open(meta_file) as f:
+            self.meta = json.load(f)
+        self.bank_dir = bank_dir
+        self.transform = transform
+        self.bank_epoch = None
+        self.images = None
+        self.targets = None
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        """Loads the bank epoch to replay for the given (0-based) training epoch."""
+        bank_epoch = epoch % self.meta["num_epochs"]
+        if bank_epoch == self.bank_epoch:
+            return
+        shards = [
+            np.load(fn)
+            for fn in sorted(
+                glob.glob(os.path.join(self.bank_dir, f"epoch{bank_epoch:03d}_shard*.npz"))
+            )
+        ]
+        self.images = torch.from_numpy(np.concatenate([s["images"] for s in shards]))
+        self.targets = torch.from_numpy(np.concatenate([s["targets"] for s in shards]))
+        self.bank_epoch = bank_epoch
+
+    def __len__(self):
+        return self.meta["num_samples"]
+
+    def __getitem__(self, idx):
+        img = self.images[idx]
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, self.targets[idx]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--data_dir",
+        default="data/",
+        type=str,
+        help="Data directory where to store/find the CIFAR100 dataset.",
+    )
+    parser.add_argument(
+        "--dataset",
+        default="cifar100",
+        type=str,
+        choices=["cifar100", "cifar10"],
+        help="Dataset to use.",
+    )
+    parser.add_argument(
+        "--augmentation_name",
+        default="auto_augment",
+        type=str,
+        choices=["auto_augment", "random_hflip"],
+        help="Augmentation to materialise.",
+    )
+    parser.add_argument(
+        "--num_epochs", default=10, type=int, help="Number of augmented epochs (K)"
+    )
+    parser.add_argument(
+        "--seed", default=123, type=int, help="Seed of the augmentations"
+    )
+    parser.add_argument(
+        "--bank_dir",
+        default="save/augmentation_banks",
+        type=str,
+        help="Root directory of the augmentation banks",
+    )
+    parser.add_argument("--shard_size", default=5000, type=int, help="Images per shard")
+    parser.add_argument(
+        "--num_workers", default=4, type=int, help="Number of workers to augment with"
+    )
+    parser.add_argument(
+        "--print_tqdm_interval",
+        type=float,
+        default=1.0,
+        help="min and max interval to print tqdm progress bars to avoid polluting the Snellius log files too much",
+    )
+
+    args = parser.parse_args()
+    set_dataset(args.dataset)
+    create_bank(
+        data_dir=args.data_dir,
+        bank_dir=get_bank_dir(
+            args.bank_dir, args.dataset, args.augmentation_name, args.seed
+        ),
+        augmentation_name=args.augmentation_name,
+        num_epochs=args.num_epochs,
+        seed=args.seed,
+        shard_size=args.shard_size,
+        num_workers=args.num_workers,
+        print_tqdm_interval=args.print_tqdm_interval,
+    )
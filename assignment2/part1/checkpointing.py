@@ -0,0 +1,152 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""Trainable-only checkpoints, written atomically from a background thread."""
+import os
+import queue
+import threading
+
+import torch
+
+
+def snapshot(obj):
+    """Returns a copy of (a nested structure of) tensors on the CPU, which is safe to write while training continues."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def trainable_state_dict(model):
+    """
+    Returns the parameters of the model that require gradients, together with all buffers.
+
+    The buffers are included because the batch norm statistics of the frozen backbone are still
+    updated in training mode. They are tiny compared to the frozen weights.
+    """
+    trainable = {
+        name for name, param in model.named_parameters() if param.requires_grad
+    }
+    buffers = {name for name, _ in model.named_buffers()}
+    return {
+        name: tensor
+        for name, tensor in model.state_dict().items()
+        if name in trainable or name in buffers
+    }
+
+
+def make_checkpoint(
+    model, optimizer, epoch, loss, trainable_only=True, backbone_weights=None, **extra
+):
+    """
+    Creates a snapshot of the training state in the checkpoint format of train.py.
+
+    With trainable_only, the frozen weights are not stored; backbone_weights then names the
+    pretrained weights they have to be restored from.
+    """
+    checkpoint = {
+        "epoch": epoch,
+        "model_state_dict": snapshot(
+            trainable_state_dict(model) if trainable_only else model.state_dict()
+        ),
+        "optimizer_state_dict": snapshot(optimizer.state_dict()) if optimizer else {},
+        "loss": loss,
+        "trainable_only": trainable_only,
+    }
+    if trainable_only:
+        checkpoint["backbone_weights"] = backbone_weights
+    checkpoint.update(extra)
+    return checkpoint
+
+
+def save_atomic(checkpoint, filename):
+    """Writes the checkpoint to a temporary file first and renames it, so readers never see a partial file."""
+    tmp_filename = f"{filename}.tmp"
+    torch.save(checkpoint, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def merge_checkpoint(model, checkpoint, backbone_weights=None):
+    """
+    Loads the model state of a checkpoint into the model.
+
+    Trainable-only checkpoints are merged into the model, whose frozen weights must already be
+    the pretrained backbone weights the checkpoint refers to.
+    """
+    if not checkpoint.get("trainable_only", False):
+        model.load_state_dict(checkpoint["model_state_dict"])
+        return model
+
+    if (
+        backbone_weights is not None
+        and checkpoint.get("backbone_weights") != backbone_weights
+    ):
+        raise ValueError(
+            f"Checkpoint was trained on backbone weights {checkpoint.get('backbone_weights')}, "
+            f"but the model has {backbone_weights}"
+        )
+    missing, unexpected = model.load_state_dict(
+        checkpoint["model_state_dict"], strict=False
+    )
+    frozen = {
+        name for name, param in model.named_parameters() if not param.requires_grad
+    }
+    if unexpected or set(missing) - frozen:
+        raise RuntimeError(
+            f"Checkpoint does not match the model. Unexpected keys: {unexpected}, "
+            f"missing trainable keys: {sorted(set(missing) - frozen)}"
+        )
+    return model
+
+
+class AsyncCheckpointWriter:
+    """
+    Saves checkpoints from a background thread, so training does not stall while writing.
+    The checkpoints passed to save must not be modified afterwards (see make_checkpoint).
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                save_atomic(*item)
+            except Exception as e:  # reported in the training thread by wait()/close()
+                self.error = e
+
+    def save(self, checkpoint, filename):
+        self._raise_error()
+        self.queue.put((checkpoint, filename))
+
+    def close(self):
+        """Waits until all queued checkpoints are written."""
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from self.error
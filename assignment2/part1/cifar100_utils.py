@@ -15,6 +15,7 @@
 ################################################################################
 
 import torch
+import torch.nn.functional as F
 
 from torchvision.datasets import CIFAR100, CIFAR10
 from torch.utils.data import random_split
@@ -61,10 +62,10 @@ class AddGaussianNoise(torch.nn.Module):
         # - Then, you can transform z s.t. it is sampled from N(self.mean, self.std)
         # - Finally, you can add the noise to the image.
 
-        noise = torch.randn(img.shape, dtype=img.dtype)
+        # Adam: don't modify the image in place, and sample the noise on the device of the image
+        noise = torch.randn_like(img)
         noise = noise * self.std + self.mean
-        img += noise
-        return img
+        return img + noise
         #######################
         # END OF YOUR CODE    #
         #######################
@@ -104,7 +105,80 @@ def add_augmentation(augmentation_name, transform_list):
     #######################
 
 
-def get_train_validation_set(data_dir, validation_size=5000, augmentation_name=None):
+class BatchTransform(torch.nn.Module):
+    """
+    Augments, resizes and normalizes a whole batch of uint8 images at once, after collation
+    (and after moving it to the device), instead of transforming every sample separately.
+
+    The augmentations are applied on the uint8 images in their native resolution:
+    - random_hflip flips a random half of the batch with a single vectorised operation,
+    - auto_augment applies one randomly sampled AutoAugment op per sub-batch of sub_batch_size images,
+    - test_noise adds Gaussian noise to the normalized batch.
+    """
+
+    def __init__(
+        self,
+        image_size=224,
+        augmentation_name=None,
+        sub_batch_size=16,
+        mean=(0.5071, 0.4867, 0.4408),
+        std=(0.2675, 0.2565, 0.2761),
+        noise_mean=0.0,
+        noise_std=0.1,
+    ):
+        super().__init__()
+        if augmentation_name not in (None, "auto_augment", "random_hflip", "test_noise"):
+            raise NotImplementedError(f"Augmentation name {augmentation_name}")
+        self.image_size = image_size
+        self.augmentation_name = augmentation_name
+        self.sub_batch_size = sub_batch_size
+        self.noise_mean = noise_mean
+        self.noise_std = noise_std
+        self.auto_augment = transforms.AutoAugment(transforms.AutoAugmentPolicy.CIFAR10)
+        self.register_buffer("mean", torch.tensor(mean).view(1, 3, 1, 1))
+        self.register_buffer("std", torch.tensor(std).view(1, 3, 1, 1))
+
+    def forward(self, images):
+        if self.augmentation_name == "auto_augment":
+            images = torch.cat(
+                [self.auto_augment(chunk) for chunk in images.split(self.sub_batch_size)]
+            )
+        elif self.augmentation_name == "random_hflip":
+            flip = torch.rand(images.shape[0], device=images.device) < 0.5
+            images = torch.where(flip[:, None, None, None], images.flip(-1), images)
+
+        images = images.float().div_(255)
+        if images.shape[-1] != self.image_size:
+            images = F.interpolate(
+                images,
+                size=(self.image_size, self.image_size),
+                mode="bilinear",
+                align_corners=False,
+            )
+        images = (images - self.mean) / self.std
+
+        if self.augmentation_name == "test_noise":
+            images = images + torch.randn_like(images) * self.noise_std + self.noise_mean
+        return images
+
+
+def get_resize_transform(image_size):
+    """
+    Returns the list of transforms to resize the 32x32 CIFAR images to image_size.
+    The list is empty for the native resolution, so no time is wasted on a no-op resize.
+    """
+    if image_size == 32:
+        return []
+    return [transforms.Resize((image_size, image_size))]
+
+
+def get_train_validation_set(
+    data_dir,
+    validation_size=5000,
+    augmentation_name=None,
+    image_size=224,
+    batch_augmentation=False,
+):
     """
     Returns the training and validation set of CIFAR100.
 
@@ -112,6 +186,9 @@ def get_train_validation_set(data_dir, validation_size=5000, augmentation_name=N
         data_dir: Directory where the data should be stored.
         validation_size: Size of the validation size
         augmentation_name: The name of the augmentation to use.
+        image_size: Resolution to resize the images to.
+        batch_augmentation: Only convert the samples to uint8 tensors, the rest of the transformations
+            is left to a BatchTransform applied on the whole batch.
 
     Returns:
         train_dataset: Training dataset of CIFAR100
@@ -121,8 +198,7 @@ def get_train_validation_set(data_dir, validation_size=5000, augmentation_name=N
     mean = (0.5071, 0.4867, 0.4408)
     std = (0.2675, 0.2565, 0.2761)
 
-    train_transform = [
-        transforms.Resize((224, 224)),
+    train_transform = get_resize_transform(image_size) + [
         transforms.ToTensor(),
         transforms.Normalize(mean, std),
     ]
@@ -131,13 +207,16 @@ def get_train_validation_set(data_dir, validation_size=5000, augmentation_name=N
     train_transform = transforms.Compose(train_transform)
 
     val_transform = transforms.Compose(
-        [
-            transforms.Resize((224, 224)),
+        get_resize_transform(image_size)
+        + [
             transforms.ToTensor(),
             transforms.Normalize(mean, std),
         ]
     )
 
+    if batch_augmentation:
+        train_transform = val_transform = transforms.PILToTensor()
+
     # We need to load the dataset twice because we want to use them with different transformations
     dataset = get_dataset(dataset_name)
     train_dataset = dataset(
@@ -169,13 +248,16 @@ def get_train_validation_set(data_dir, validation_size=5000, augmentation_name=N
     return train_dataset, val_dataset
 
 
-def get_test_set(data_dir, test_noise):
+def get_test_set(data_dir, test_noise, image_size=224, batch_augmentation=False):
     """
     Returns the test dataset of CIFAR100.
 
     Args:
         data_dir: Directory where the data should be stored
         test_noise: Whether to add Gaussian noise to the test set.
+        image_size: Resolution to resize the images to.
+        batch_augmentation: Only convert the samples to uint8 tensors, the rest of the transformations
+            (including the noise) is left to a BatchTransform applied on the whole batch.
     Returns:
         test_dataset: The test dataset of CIFAR100.
     """
@@ -183,8 +265,7 @@ def get_test_set(data_dir, test_noise):
     mean = (0.5071, 0.4867, 0.4408)
     std = (0.2675, 0.2565, 0.2761)
 
-    test_transform = [
-        transforms.Resize((224, 224)),
+    test_transform = get_resize_transform(image_size) + [
         transforms.ToTensor(),
         transforms.Normalize(mean, std),
     ]
@@ -192,6 +273,9 @@ def get_test_set(data_dir, test_noise):
         add_augmentation("test_noise", test_transform)
     test_transform = transforms.Compose(test_transform)
 
+    if batch_augmentation:
+        test_transform = transforms.PILToTensor()
+
     dataset = get_dataset(dataset_name)
     test_dataset = dataset(
         root=data_dir, train=False, download=True, transform=test_transform
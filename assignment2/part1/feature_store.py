@@ -0,0 +1,194 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""On-disk store of frozen ResNet18 backbone features for training the classification head."""
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.utils.data as data
+from tqdm import tqdm
+
+
+@contextmanager
+def headless(model):
+    """Temporarily replaces the classification head with an identity, so the model returns the pooled features."""
+    fc = model.fc
+    model.fc = nn.Identity()
+    try:
+        yield model
+    finally:
+        model.fc = fc
+
+
+def feature_cache_name(
+    cache_dir,
+    dataset_name,
+    split,
+    augmentation_name=None,
+    seed=None,
+    max_samples=0,
+    image_size=224,
+):
+    """
+    Returns the file name prefix of a feature cache entry.
+
+    Features are cached per (dataset, split, augmentation, seed). The seed is only part of the key
+    for augmented splits, as the features of non-augmented splits are deterministic.
+    """
+    name = f"{dataset_name}_{split}"
+    if image_size != 224:
+        name += f"_{image_size}px"
+    if augmentation_name is not None:
+        name += f"_{augmentation_name}_seed{seed}"
+    if max_samples > 0:
+        # Adam: partial caches created with --max_batches should never be mixed with full ones
+        name += f"_max{max_samples}"
+    return os.path.join(cache_dir, name)
+
+
+def extract_features(
+    model,
+    dataset,
+    cache_name,
+    batch_size,
+    device,
+    seed=None,
+    max_samples=0,
+    num_workers=0,
+    print_tqdm_interval=1.0,
+):
+    """
+    Runs the frozen backbone once over the dataset and stores the pooled features
+    as a memory-mapped float16 file, together with the labels.
+
+    The backbone runs in eval mode, so its BatchNorm layers use the (ImageNet) running statistics.
+    Training the whole model in train mode instead normalizes with the batch statistics of CIFAR
+    and updates the running statistics, so the accuracy of the cached head differs slightly.
+
+    Args:
+        model: ResNet18 model, whose backbone is used to extract the features.
+        dataset: Dataset to extract the features of.
+        cache_name: File name prefix of the cache entry (see feature_cache_name).
+        batch_size: Batch size to use for the extraction.
+        device: Device to use.
+        seed: Seed for the augmentations of the dataset (if any).
+        max_samples: Only extract the first max_samples samples if positive, to aid testing.
+        num_workers: Number of DataLoader workers.
+        print_tqdm_interval: min and max interval to print the tqdm progress bar.
+    Returns:
+        features: Memory-mapped array of shape (num_samples, num_features).
+        labels: Array of shape (num_samples,).
+    """
+    features_file, labels_file = f"{cache_name}_features.npy", f"{cache_name}_labels.npy"
+    if os.path.isfile(features_file) and os.path.isfile(labels_file):
+        return load_features(cache_name)
+
+    os.makedirs(os.path.dirname(cache_name) or ".", exist_ok=True)
+    num_samples = len(dataset)
+    if max_samples > 0:
+        num_samples = min(num_samples, max_samples)
+        dataset = data.Subset(dataset, range(num_samples))
+
+    if seed is not None:
+        torch.manual_seed(seed)
+    loader = data.DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        drop_last=False,
+        num_workers=num_workers,
+    )
+
+    # Write to temporary files first, so an interrupted extraction never leaves a partial cache behind
+    tmp_features_file = f"{cache_name}_features.tmp.npy"
+    tmp_labels_file = f"{cache_name}_labels.tmp.npy"
+    labels = np.empty(num_samples, dtype=np.int64)
+    features = None
+
+    was_training = model.training
+    model.eval()
+    offset = 0
+    with headless(model), torch.no_grad():
+        for data_t, target_t in tqdm(
+            loader,
+            desc="Extracting features",
+            leave=False,
+            mininterval=print_tqdm_interval,
+            maxinterval=print_tqdm_interval,
+        ):
+            features_t = model(data_t.to(device))
+            if features is None:
+                features = np.lib.format.open_memmap(
+                    tmp_features_file,
+                    mode="w+",
+                    dtype=np.float16,
+                    shape=(num_samples, features_t.shape[1]),
+                )
+            batch_len = features_t.shape[0]
+            features[offset : offset + batch_len] = (
+                features_t.to(torch.float16).cpu().numpy()
+            )
+            labels[offset : offset + batch_len] = target_t.numpy()
+            offset += batch_len
+    model.train(was_training)
+
+    features.flush()
+    del features
+    np.save(tmp_labels_file, labels)
+    os.replace(tmp_features_file, features_file)
+    os.replace(tmp_labels_file, labels_file)
+
+    return load_features(cache_name)
+
+
+def load_features(cache_name):
+    """Loads a cache entry created by extract_features, with the features memory-mapped."""
+    features = np.load(f"{cache_name}_features.npy", mmap_mode="r")
+    labels = np.load(f"{cache_name}_labels.npy")
+    return features, labels
+
+
+class FeatureDataset(data.Dataset):
+    """
+    Dataset of (float32 features, label) pairs that can be used in place of the image dataset.
+    The features stay memory-mapped, only the requested samples are read and converted.
+    """
+
+    def __init__(self, features, labels):
+        self.features = features
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        features = torch.from_numpy(np.asarray(self.features[idx], dtype=np.float32))
+        return features, int(self.labels[idx])
+
+    def tensors(self):
+        """Returns all features (float32) and labels as tensors, for full-batch solvers."""
+        return (
+            torch.from_numpy(np.asarray(self.features, dtype=np.float32)),
+            torch.from_numpy(self.labels),
+        )
+
+
+def get_feature_dataset(features, labels):
+    """Returns a dataset of (float32 features, label) pairs that can be used in place of the image dataset."""
+    return FeatureDataset(features, labels)
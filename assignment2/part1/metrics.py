@@ -0,0 +1,112 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""Training metrics that are aggregated on the device and logged from a background thread."""
+import queue
+import threading
+
+import torch
+
+
+class AsyncScalarWriter:
+    """Forwards add_scalar calls to a SummaryWriter from a background thread."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.writer.add_scalar(*item)
+            except Exception as e:  # reported in the training thread by add_scalar()/close()
+                self.error = e
+
+    def add_scalar(self, tag, value, step):
+        self._raise_error()
+        self.queue.put((tag, value, step))
+
+    def close(self):
+        """Waits until all queued scalars are written."""
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+        self.writer.flush()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError("Writing a scalar failed") from self.error
+
+
+class RunningTrainingMetrics:
+    """
+    Running training loss and accuracy of an epoch.
+
+    The loss and the number of correct predictions are accumulated as tensors on the device, so
+    updating them does not synchronize with the device. Only every flush_every steps the aggregated
+    values are copied to the host (a single synchronization) and logged.
+    """
+
+    def __init__(self, scalar_writer, flush_every, device):
+        self.scalar_writer = scalar_writer
+        self.flush_every = flush_every
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        """Resets the metrics at the start of an epoch."""
+        self.running_loss_t = torch.zeros((), device=self.device)
+        self.correct_t = torch.zeros((), dtype=torch.long, device=self.device)
+        self.processed_samples = 0
+        self.steps_since_flush = 0
+        self.running_loss = 0.0
+        self.running_accuracy = 0.0
+
+    def update(self, loss, outputs, targets, step):
+        """
+        Adds the statistics of a batch.
+
+        Returns:
+            True if the aggregated values have been flushed in this step.
+        """
+        self.running_loss_t += loss.detach()
+        self.correct_t += (outputs.detach().argmax(dim=1) == targets).sum()
+        self.processed_samples += targets.size(0)
+        self.steps_since_flush += 1
+        if self.steps_since_flush >= self.flush_every:
+            self.flush(step)
+            return True
+        return False
+
+    def flush(self, step):
+        """Copies the aggregated values to the host and logs them with the same tags as before."""
+        if self.steps_since_flush == 0:
+            return
+        running_loss, correct = torch.stack(
+            [self.running_loss_t, self.correct_t.to(self.running_loss_t.dtype)]
+        ).tolist()
+        self.running_loss = running_loss / self.processed_samples
+        self.running_accuracy = correct / self.processed_samples
+        self.steps_since_flush = 0
+
+        self.scalar_writer.add_scalar("training accuracy", self.running_accuracy, step)
+        self.scalar_writer.add_scalar("training loss", self.running_loss, step)
@@ -0,0 +1,132 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""Post-training static int8 quantization of the ResNet18 model for evaluation on CPU."""
+import copy
+import os
+
+import torch
+import torch.nn as nn
+import torch.utils.data as data
+import torchvision.models.quantization as quantized_models
+from tqdm import tqdm
+
+
+def get_quantization_backend():
+    """Returns the quantization backend to use, preferring x86 over fbgemm (its predecessor)."""
+    engines = torch.backends.quantized.supported_engines
+    if "x86" in engines:
+        return "x86"
+    if "fbgemm" in engines:
+        return "fbgemm"
+    raise RuntimeError(f"No x86 quantization backend available, only {engines}")
+
+
+def get_quantized_model_name(checkpoint_name):
+    """Returns the file name of the cached quantized model of a checkpoint."""
+    return f"{os.path.splitext(checkpoint_name)[0]}_int8.pt"
+
+
+def build_quantizable_model(model):
+    """Returns a copy of the (fp32, CPU) ResNet18 model with quantization stubs, which can be fused and quantized."""
+    qmodel = quantized_models.resnet18(
+        weights=None, quantize=False, num_classes=model.fc.out_features
+    )
+    # Keep the stem adaptations for small input resolutions (see adapt_stem in train.py)
+    qmodel.conv1.stride = model.conv1.stride
+    if isinstance(model.maxpool, nn.Identity):
+        qmodel.maxpool = nn.Identity()
+    qmodel.load_state_dict(model.state_dict())
+    return qmodel
+
+
+def quantize_model(
+    model,
+    calibration_dataset,
+    batch_size=64,
+    batch_transform=None,
+    print_tqdm_interval=1.0,
+):
+    """
+    Converts the model to a static int8 model.
+    Conv, batch norm and ReLU layers are fused first, then the activation ranges are calibrated
+    on the calibration dataset.
+
+    Args:
+        model: ResNet18 model to quantize, it is not modified.
+        calibration_dataset: Dataset of a few hundred images to calibrate the activation ranges on.
+        batch_size: Batch size for the calibration.
+        batch_transform: Transformation to apply on each calibration batch (see BatchTransform).
+    Returns:
+        qmodel: Quantized TorchScript model.
+    """
+    backend = get_quantization_backend()
+    torch.backends.quantized.engine = backend
+
+    # the model may still be used on its device afterwards, e.g. by evaluate_robustness
+    qmodel = build_quantizable_model(copy.deepcopy(model).cpu())
+    qmodel.eval()
+    qmodel.fuse_model(is_qat=False)
+    qmodel.qconfig = torch.ao.quantization.get_default_qconfig(backend)
+    torch.ao.quantization.prepare(qmodel, inplace=True)
+
+    loader = data.DataLoader(calibration_dataset, batch_size=batch_size, shuffle=False)
+    with torch.no_grad():
+        for images, _ in tqdm(
+            loader,
+            desc="Calibrating",
+            leave=False,
+            mininterval=print_tqdm_interval,
+            maxinterval=print_tqdm_interval,
+        ):
+            if batch_transform is not None:
+                images = batch_transform(images)
+            qmodel(images)
+
+    torch.ao.quantization.convert(qmodel, inplace=True)
+    return torch.jit.script(qmodel)
+
+
+def get_quantized_model(
+    model,
+    checkpoint_name,
+    calibration_dataset,
+    batch_size=64,
+    batch_transform=None,
+    print_tqdm_interval=1.0,
+):
+    """
+    Returns the quantized model of a checkpoint. The quantized model is cached next to the
+    checkpoint, and recreated if the checkpoint is newer than the cache.
+    """
+    quantized_model_name = get_quantized_model_name(checkpoint_name)
+    if os.path.isfile(quantized_model_name) and os.path.getmtime(
+        quantized_model_name
+    ) >= os.path.getmtime(checkpoint_name):
+        torch.backends.quantized.engine = get_quantization_backend()
+        return torch.jit.load(quantized_model_name, map_location="cpu")
+
+    qmodel = quantize_model(
+        model,
+        calibration_dataset,
+        batch_size=batch_size,
+        batch_transform=batch_transform,
+        print_tqdm_interval=print_tqdm_interval,
+    )
+    tmp_name = f"{quantized_model_name}.tmp"
+    torch.jit.save(qmodel, tmp_name)
+    os.replace(tmp_name, quantized_model_name)
+    return qmodel
@@ -0,0 +1,88 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""Prints the accuracy-vs-throughput table of the ResNet18 results saved by train.py."""
+import argparse
+import glob
+import json
+import os
+
+
+COLUMNS = [
+    ("dataset", "{}"),
+    ("augmentation_name", "{}"),
+    ("test_noise", "{}"),
+    ("cached_head", "{}"),
+    ("solver", "{}"),
+    ("sweep", "{}"),
+    ("image_size", "{}"),
+    ("progressive_resize", "{}"),
+    ("progressive_min_image_size", "{}"),
+    ("epochs", "{}"),
+    ("batch_augmentation", "{}"),
+    ("test_accuracy", "{:.4f}"),
+    ("test_throughput", "{:.1f}"),
+    ("quantized_test_accuracy", "{:.4f}"),
+    ("quantized_test_throughput", "{:.1f}"),
+]
+
+
+def load_results(results_dir):
+    """Loads all result files from the given directory."""
+    results = []
+    for fn in sorted(glob.glob(os.path.join(results_dir, "*.json"))):
+        with open(fn) as f:
+            results.append(json.load(f))
+    return results
+
+
+def format_table(results, columns=COLUMNS):
+    """Formats the results as a plain text table, omitting missing values of older result files."""
+    rows = [[name for name, _ in columns]]
+    for result in results:
+        rows.append(
+            [
+                fmt.format(result[name]) if result.get(name) is not None else "-"
+                for name, fmt in columns
+            ]
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths))
+        for row in rows
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--results_dir",
+        default="results_resnet18",
+        type=str,
+        help="directory of the result files saved by train.py",
+    )
+    args = parser.parse_args()
+
+    results = load_results(args.results_dir)
+    results.sort(
+        key=lambda r: (
+            r["dataset"],
+            str(r["augmentation_name"]),
+            r["test_noise"],
+            r.get("image_size", 224),
+        )
+    )
+    print(format_table(results))
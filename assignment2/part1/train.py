@@ -16,6 +16,8 @@
 
 import argparse
 import os
+import sys
+import time
 
 import numpy as np
 import torch
@@ -29,11 +31,39 @@ from tqdm import tqdm
 import json
 
 from cifar100_utils import (
+    BatchTransform,
     get_train_validation_set,
     get_test_set,
     set_dataset,
     get_dataset_name,
 )
+from augmentation_bank import (
+    AugmentationBankDataset,
+    get_bank_dir,
+    get_bank_transform,
+)
+from checkpointing import (
+    AsyncCheckpointWriter,
+    make_checkpoint,
+    merge_checkpoint,
+    save_atomic,
+)
+from metrics import AsyncScalarWriter, RunningTrainingMetrics
+from quantization import get_quantized_model
+from feature_store import (
+    extract_features,
+    feature_cache_name,
+    get_feature_dataset,
+    headless,
+)
+
+# Adam: the DataLoader autotuner is shared by all assignments, it lives in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from loader_autotune import tuned_dataloader  # noqa: E402
+
+
+# Pretrained weights of the frozen backbone, referenced by trainable-only checkpoints
+BACKBONE_WEIGHTS = models.ResNet18_Weights.DEFAULT
 
 
 def set_seed(seed):
@@ -65,12 +95,63 @@ def get_device() -> str:
     return device
 
 
-def get_model(num_classes=100):
+def adapt_stem(model, image_size):
+    """
+    Adapts the stem of the ResNet18 to small input resolutions.
+
+    The stem downsamples the input by 4, which leaves a 1x1 feature map in the last stage already
+    for 64x64 inputs. For these resolutions the max pooling is removed, and for the native 32x32 CIFAR
+    resolution the first convolution is applied with stride 1 as well. The pretrained weights are
+    kept, only the strides change.
+    """
+    if image_size <= 64:
+        model.maxpool = nn.Identity()
+    if image_size <= 32:
+        model.conv1.stride = (1, 1)
+    return model
+
+
+# Adam: first training resolution of the progressive resizing schedule
+PROGRESSIVE_MIN_IMAGE_SIZE = 112
+
+
+def get_progressive_image_size(
+    epoch, epochs, min_image_size=PROGRESSIVE_MIN_IMAGE_SIZE, max_image_size=224
+):
+    """
+    Returns the training resolution for the given (1-based) epoch of a progressive resizing schedule.
+    The resolution grows linearly from min_image_size in steps of 32 pixels over the first two
+    thirds of the epochs, and the remaining epochs are trained at max_image_size.
+    """
+    min_image_size = min(min_image_size, max_image_size)
+    ramp_epochs = max(1, (2 * epochs) // 3)
+    if epoch > ramp_epochs:
+        return max_image_size
+    image_size = min_image_size + (max_image_size - min_image_size) * (epoch - 1) / ramp_epochs
+    return min(max_image_size, int(image_size) // 32 * 32)
+
+
+def get_batch_transforms(image_size, augmentation_name, device, augmentation_bank=False):
+    """
+    Returns the batch transforms of the training and the validation batches (see BatchTransform).
+
+    The training transform is a separate module, as its image size changes with progressive resizing.
+    The images of an augmentation bank are augmented already, so its training transform only resizes
+    and normalizes them.
+    """
+    train_augmentation = None if augmentation_bank else augmentation_name
+    train_batch_transform = BatchTransform(image_size, train_augmentation).to(device)
+    val_batch_transform = BatchTransform(image_size).to(device)
+    return train_batch_transform, val_batch_transform
+
+
+def get_model(num_classes=100, image_size=224):
     """
     Returns a pretrained ResNet18 on ImageNet with the last layer
     replaced by a linear layer with num_classes outputs.
     Args:
         num_classes: Number of classes for the final layer (for CIFAR100 by default 100)
+        image_size: Input resolution, the stem is adapted for small resolutions.
     Returns:
         model: nn.Module object representing the model architecture.
     """
@@ -80,7 +161,7 @@ def get_model(num_classes=100):
 
     # Get the pretrained ResNet18 model on ImageNet from torchvision.models
     # Don't forget pretrained=True as I did first..
-    model = models.resnet18(weights=models.ResNet18_Weights.DEFAULT)
+    model = models.resnet18(weights=BACKBONE_WEIGHTS)
 
     # Randomly initialize and modify the model's last layer for CIFAR100.
     model.requires_grad_(False)  # freeze all layers
@@ -91,6 +172,9 @@ def get_model(num_classes=100):
     model.fc = torch.nn.Linear(model.fc.in_features, num_classes)
     model.fc.weight.data.normal_(0, 0.01)  # initialize as requested in the exercise
 
+    # Adam: avoid upsampling the CIFAR images to 224, adapt the model to the lower resolution instead
+    adapt_stem(model, image_size)
+
     #######################
     # END OF YOUR CODE    #
     #######################
@@ -98,6 +182,66 @@ def get_model(num_classes=100):
     return model
 
 
+def get_feature_datasets(
+    model,
+    data_dir,
+    batch_size,
+    device,
+    augmentation_name=None,
+    seed=None,
+    max_batches=0,
+    feature_cache_dir="save/features",
+    print_tqdm_interval=1.0,
+    image_size=224,
+):
+    """
+    Returns the training and validation datasets as cached features of the frozen backbone.
+    The features are extracted on first use, and loaded from feature_cache_dir afterwards.
+    """
+    train_dataset, val_dataset = get_train_validation_set(
+        data_dir, augmentation_name=augmentation_name, image_size=image_size
+    )
+    max_samples = (max_batches + 1) * batch_size if max_batches > 0 else 0
+    train_dataset = get_feature_dataset(
+        *extract_features(
+            model,
+            train_dataset,
+            feature_cache_name(
+                feature_cache_dir,
+                get_dataset_name(),
+                "train",
+                augmentation_name,
+                seed,
+                max_samples,
+                image_size,
+            ),
+            batch_size,
+            device,
+            seed=seed,
+            max_samples=max_samples,
+            print_tqdm_interval=print_tqdm_interval,
+        )
+    )
+    val_dataset = get_feature_dataset(
+        *extract_features(
+            model,
+            val_dataset,
+            feature_cache_name(
+                feature_cache_dir,
+                get_dataset_name(),
+                "validation",
+                max_samples=max_samples,
+                image_size=image_size,
+            ),
+            batch_size,
+            device,
+            max_samples=max_samples,
+            print_tqdm_interval=print_tqdm_interval,
+        )
+    )
+    return train_dataset, val_dataset
+
+
 def train_model(
     model,
     lr,
@@ -109,6 +253,16 @@ def train_model(
     augmentation_name=None,
     print_tqdm_interval=0.1,
     max_batches=0,
+    cached_head=False,
+    feature_cache_dir="save/features",
+    seed=None,
+    image_size=224,
+    progressive_resize=False,
+    batch_augmentation=False,
+    augmentation_bank_dir=None,
+    log_every=50,
+    trainable_only_checkpoint=True,
+    autotune_loader=False,
 ):
     """
     Trains a given model architecture for the specified hyperparameters.
@@ -122,6 +276,20 @@ def train_model(
         checkpoint_name: Filename to save the best model on validation.
         device: Device to use.
         augmentation_name: Augmentation to use for training.
+        cached_head: Train only the head on features of the frozen backbone, which are extracted once
+            and cached in feature_cache_dir.
+        feature_cache_dir: Directory of the cached backbone features.
+        seed: Seed of the augmentations used for extracting the cached training features.
+        image_size: Input resolution. With progressive_resize, this is the final training resolution.
+        progressive_resize: Train with a resolution growing over the epochs (see get_progressive_image_size).
+        batch_augmentation: Resize, augment and normalize whole batches on the device (see BatchTransform).
+        augmentation_bank_dir: Root directory of precomputed augmentation banks (see augmentation_bank.py).
+            If set, the augmented training epochs are replayed from the bank of the given
+            (dataset, augmentation, seed) instead of being computed.
+        log_every: Number of steps to aggregate the training loss and accuracy over before logging them.
+        trainable_only_checkpoint: Only save the trainable parameters (and buffers) in the checkpoint,
+            the frozen weights are restored from the pretrained backbone when loading it.
+        autotune_loader: Use autotuned worker, prefetching and pinning settings for the data loaders.
     Returns:
         model: Model that has performed best on the validation set.
     """
@@ -129,25 +297,86 @@ def train_model(
     # PUT YOUR CODE HERE  #
     #######################
 
+    if progressive_resize and cached_head:
+        raise ValueError("Progressive resizing is not supported with cached features")
+    if batch_augmentation and cached_head:
+        raise ValueError("Batch augmentation is not supported with cached features")
+    if augmentation_bank_dir is not None and (cached_head or augmentation_name is None):
+        raise ValueError(
+            "An augmentation bank can only be used for augmented runs without cached features"
+        )
+
     # Load the datasets
-    train_dataset, val_dataset = get_train_validation_set(
-        data_dir, augmentation_name=augmentation_name
-    )
-    train_loader = data.DataLoader(
-        dataset=train_dataset, batch_size=batch_size, shuffle=True, drop_last=True
+    # Adam: the backbone is frozen, so instead of pushing every image through it in every epoch,
+    # run it only once and train the last layer directly on the cached features
+    net = model
+    if cached_head:
+        train_dataset, val_dataset = get_feature_datasets(
+            model,
+            data_dir,
+            batch_size,
+            device,
+            augmentation_name=augmentation_name,
+            seed=seed,
+            max_batches=max_batches,
+            feature_cache_dir=feature_cache_dir,
+            print_tqdm_interval=print_tqdm_interval,
+            image_size=image_size,
+        )
+        net = model.fc
+    else:
+        train_dataset, val_dataset = get_train_validation_set(
+            data_dir,
+            augmentation_name=augmentation_name,
+            image_size=image_size,
+            batch_augmentation=batch_augmentation,
+        )
+
+    # Adam: with batch augmentation, the workers only decode the images and the rest is done per batch
+    train_batch_transform, val_batch_transform = None, None
+    if batch_augmentation:
+        train_batch_transform, val_batch_transform = get_batch_transforms(
+            image_size,
+            augmentation_name,
+            device,
+            augmentation_bank=augmentation_bank_dir is not None,
+        )
+
+    # Adam: replay the augmentations from the bank, they are already applied on the stored images
+    if augmentation_bank_dir is not None:
+        train_dataset = AugmentationBankDataset(
+            get_bank_dir(
+                augmentation_bank_dir, get_dataset_name(), augmentation_name, seed
+            ),
+            transform=None if batch_augmentation else get_bank_transform(image_size),
+        )
+
+    train_loader = tuned_dataloader(
+        train_dataset,
+        batch_size=batch_size,
+        enabled=autotune_loader,
+        shuffle=True,
+        drop_last=True,
     )
-    val_loader = data.DataLoader(
-        dataset=val_dataset,
+    val_loader = tuned_dataloader(
+        val_dataset,
         batch_size=batch_size,
+        enabled=autotune_loader,
         shuffle=False,
         drop_last=False,
     )
 
     writer = SummaryWriter("runs/")
+    # Adam: aggregate the training statistics on the device and log them from a background thread,
+    # instead of synchronizing and writing to TensorBoard in every step
+    scalar_writer = AsyncScalarWriter(writer)
+    training_metrics = RunningTrainingMetrics(scalar_writer, log_every, device)
+    # Adam: write the checkpoints in the background instead of blocking the training
+    checkpoint_writer = AsyncCheckpointWriter()
 
     # Initialize the optimizer (Adam) to train the last layer of the model.
     loss_module = nn.CrossEntropyLoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    optimizer = torch.optim.Adam(net.parameters(), lr=lr)
 
     # Training loop with validation after each epoch. Save the best model.
     best_model_accuracy = -np.inf
@@ -163,11 +392,39 @@ def train_model(
     ):
         epoch_pbar.set_description(f"Epoch: {epoch}")
 
-        running_loss = 0.0
+        if progressive_resize and batch_augmentation:
+            epoch_image_size = get_progressive_image_size(
+                epoch, epochs, max_image_size=image_size
+            )
+            train_batch_transform.image_size = epoch_image_size
+            scalar_writer.add_scalar("training image size", epoch_image_size, epoch)
+        elif progressive_resize:
+            epoch_image_size = get_progressive_image_size(
+                epoch, epochs, max_image_size=image_size
+            )
+            if augmentation_bank_dir is not None:
+                train_dataset.transform = get_bank_transform(epoch_image_size)
+            else:
+                train_dataset, _ = get_train_validation_set(
+                    data_dir,
+                    augmentation_name=augmentation_name,
+                    image_size=epoch_image_size,
+                )
+            train_loader = tuned_dataloader(
+                train_dataset,
+                batch_size=batch_size,
+                enabled=autotune_loader,
+                shuffle=True,
+                drop_last=True,
+            )
+            scalar_writer.add_scalar("training image size", epoch_image_size, epoch)
 
-        correct = 0
-        processed_samples = 0
-        model.train()
+        if augmentation_bank_dir is not None:
+            train_dataset.set_epoch(epoch - 1)
+
+        training_metrics.reset()
+        net.train()
+        epoch_start_time = time.time()
         for batch_idx, (data_, target_) in (
             batch_pbar := tqdm(
                 enumerate(train_loader),
@@ -182,9 +439,11 @@ def train_model(
                 break
 
             data_, target_ = data_.to(device), target_.to(device)
+            if train_batch_transform is not None:
+                data_ = train_batch_transform(data_)
 
             # log some debug info in the very first batch
-            if epoch == 1 and batch_idx == 0:
+            if epoch == 1 and batch_idx == 0 and not cached_head:
                 # save model
                 writer.add_graph(model, data_)
 
@@ -198,62 +457,63 @@ def train_model(
             optimizer.zero_grad()
 
             # forward + backward + optimize
-            outputs = model(data_)
+            outputs = net(data_)
             loss = loss_module(outputs, target_)
             loss.backward()
             optimizer.step()
 
             # calculate statistics
-            running_loss += loss.item()
-            _, pred = torch.max(outputs, dim=1)
-            correct += torch.sum(pred == target_).item()
-            processed_samples += target_.size(0)
-
-            running_training_accuracy = correct / processed_samples
-            writer.add_scalar(
-                "training accuracy",
-                running_training_accuracy,
-                epoch * len(train_loader) + batch_idx,
-            )
-            running_training_loss = running_loss / processed_samples
-            writer.add_scalar(
-                "training loss",
-                running_training_loss,
-                epoch * len(train_loader) + batch_idx,
+            flushed = training_metrics.update(
+                loss, outputs, target_, epoch * len(train_loader) + batch_idx
             )
 
             batch_pbar.set_description(f"Train batch: {batch_idx:3}", refresh=False)
-            batch_pbar.set_postfix(
-                {
-                    "Batch loss": f"{loss:.2f}",
-                    "Running training loss": running_training_loss,
-                    "Running training accuracy": running_training_accuracy,
-                },
-                refresh=False,
-            )
+            if flushed:
+                batch_pbar.set_postfix(
+                    {
+                        "Running training loss": training_metrics.running_loss,
+                        "Running training accuracy": training_metrics.running_accuracy,
+                    },
+                    refresh=False,
+                )
+
+        training_metrics.flush(epoch * len(train_loader) + batch_idx)
+        running_training_loss = training_metrics.running_loss
+        running_training_accuracy = training_metrics.running_accuracy
+
+        training_throughput = training_metrics.processed_samples / (
+            time.time() - epoch_start_time
+        )
+        scalar_writer.add_scalar("training throughput", training_throughput, epoch)
 
         val_accuracy = evaluate_model(
-            model, val_loader, device, max_batches=max_batches
+            net,
+            val_loader,
+            device,
+            max_batches=max_batches,
+            batch_transform=val_batch_transform,
         )
         # writer.add_scalar(
         #     "validation loss",
         #     val_metrics["accuracy"],
         #     epoch * len(train_loader) + batch_idx,
         # )
-        writer.add_scalar(
+        scalar_writer.add_scalar(
             "validation accuracy",
             val_accuracy,
             epoch * len(train_loader) + batch_idx,
         )
 
         if best_model_accuracy < val_accuracy:
-            torch.save(
-                {
-                    "epoch": epoch,
-                    "model_state_dict": model.state_dict(),
-                    "optimizer_state_dict": optimizer.state_dict(),
-                    "loss": running_training_loss,
-                },
+            checkpoint_writer.save(
+                make_checkpoint(
+                    model,
+                    optimizer,
+                    epoch,
+                    running_training_loss,
+                    trainable_only=trainable_only_checkpoint,
+                    backbone_weights=str(BACKBONE_WEIGHTS),
+                ),
                 checkpoint_name,
             )
             best_model_accuracy = val_accuracy
@@ -264,12 +524,15 @@ def train_model(
                 "Tr acc": f"{running_training_accuracy:.2f}",
                 # "val loss": f"{val_metrics['loss']:.2f}",
                 "val acc": f"{val_accuracy:.2f}",
+                "Tr img/s": f"{training_throughput:.0f}",
             },
             refresh=False,
         )
 
-        model.train()
+        net.train()
 
+    scalar_writer.close()
+    checkpoint_writer.close()
     print(
         f"Best model trained in epoch {best_model_in_epoch} with accuracy: {best_model_accuracy}"
     )
@@ -284,10 +547,351 @@ def train_model(
     return model
 
 
+def train_head_lbfgs(
+    model,
+    batch_size,
+    data_dir,
+    checkpoint_name,
+    device,
+    augmentation_name=None,
+    weight_decays=(1e-2, 1e-3, 1e-4, 1e-5, 1e-6),
+    max_iter=200,
+    print_tqdm_interval=1.0,
+    max_batches=0,
+    seed=None,
+    image_size=224,
+    trainable_only_checkpoint=True,
+):
+    """
+    Fits the last layer of the model with full-batch L-BFGS on the cached features of the frozen backbone.
+    The L2 strength is selected from weight_decays based on the validation accuracy.
+
+    Args:
+        model: Model to train.
+        batch_size: Batch size used for extracting the features.
+        data_dir: Directory where the dataset should be loaded from or downloaded to.
+        checkpoint_name: Filename to save the best model on validation.
+        device: Device to use.
+        augmentation_name: Augmentation to use for the training features.
+        weight_decays: L2 strengths to search over.
+        max_iter: Maximal number of L-BFGS iterations per L2 strength.
+        image_size: Input resolution of the backbone.
+        trainable_only_checkpoint: Only save the trainable parameters (and buffers) in the checkpoint.
+    Returns:
+        model: Model with the head that has performed best on the validation set.
+    """
+    train_dataset, val_dataset = get_feature_datasets(
+        model,
+        data_dir,
+        batch_size,
+        device,
+        augmentation_name=augmentation_name,
+        seed=seed,
+        max_batches=max_batches,
+        print_tqdm_interval=print_tqdm_interval,
+        image_size=image_size,
+    )
+    train_features, train_labels = (t.to(device) for t in train_dataset.tensors())
+    val_features, val_labels = (t.to(device) for t in val_dataset.tensors())
+
+    head = model.fc
+    best_val_accuracy, best_weight_decay, best_state_dict, best_loss = -np.inf, None, None, None
+
+    # Start with the strongest regularization, and warm start each fit from the previous solution
+    for weight_decay in sorted(weight_decays, reverse=True):
+        optimizer = torch.optim.LBFGS(
+            head.parameters(),
+            lr=1,
+            max_iter=max_iter,
+            history_size=20,
+            line_search_fn="strong_wolfe",
+        )
+
+        def closure():
+            optimizer.zero_grad()
+            loss = F.cross_entropy(head(train_features), train_labels)
+            loss = loss + 0.5 * weight_decay * head.weight.pow(2).sum()
+            loss.backward()
+            return loss
+
+        loss = optimizer.step(closure).item()
+
+        with torch.no_grad():
+            val_accuracy = (
+                (head(val_features).argmax(dim=1) == val_labels).float().mean().item()
+            )
+        print(
+            f"L-BFGS with weight decay {weight_decay}: training loss {loss:.4f}, validation accuracy {val_accuracy}"
+        )
+
+        if best_val_accuracy < val_accuracy:
+            best_val_accuracy = val_accuracy
+            best_weight_decay = weight_decay
+            best_state_dict = {k: v.clone() for k, v in head.state_dict().items()}
+            best_loss = loss
+
+    print(
+        f"Best head fitted with weight decay {best_weight_decay} with accuracy: {best_val_accuracy}"
+    )
+    head.load_state_dict(best_state_dict)
+
+    # Use the same checkpoint format as train_model, so the model can be evaluated later the same way
+    save_atomic(
+        make_checkpoint(
+            model,
+            None,
+            1,
+            best_loss,
+            trainable_only=trainable_only_checkpoint,
+            backbone_weights=str(BACKBONE_WEIGHTS),
+            weight_decay=best_weight_decay,
+        ),
+        checkpoint_name,
+    )
+
+    return model
+
+
+def get_head_name(lr, batch_size, loss_scale=1.0):
+    """Returns the name of the training setting of a head, as used in its checkpoint and TensorBoard tags."""
+    name = f"{lr}_{batch_size}"
+    if loss_scale != 1.0:
+        name += f"_ls{loss_scale}"
+    return name
+
+
+def train_heads_sweep(
+    model,
+    heads,
+    epochs,
+    data_dir,
+    get_checkpoint_name,
+    device,
+    augmentation_name=None,
+    print_tqdm_interval=1.0,
+    max_batches=0,
+    cached_head=False,
+    seed=None,
+    image_size=224,
+    batch_augmentation=False,
+    trainable_only_checkpoint=True,
+    autotune_loader=False,
+):
+    """
+    Trains several independent heads on top of a single frozen backbone at the same time.
+
+    Every backbone forward pass feeds all heads, so a sweep over H settings costs about one run.
+    Each head has its own Adam optimizer, learning rate and loss scale. Larger batch sizes are
+    emulated with gradient accumulation over several loader batches, so the batch sizes have to
+    be multiples of the smallest one. The backbone runs in evaluation mode, as with cached_head.
+
+    Args:
+        model: Model with the frozen backbone. Its head is replaced by the best head in the end.
+        heads: List of dictionaries with the lr, batch_size and loss_scale of each head.
+        epochs: Number of epochs to train the heads for.
+        data_dir: Directory where the dataset should be loaded from or downloaded to.
+        get_checkpoint_name: Function mapping (lr, batch_size, loss_scale) to the checkpoint file of a head.
+        device: Device to use.
+        cached_head: Train the heads on the cached features of the frozen backbone.
+        batch_augmentation: Resize, augment and normalize whole batches on the device (see BatchTransform).
+        autotune_loader: Use autotuned worker, prefetching and pinning settings for the data loaders.
+    Returns:
+        model: Model with the head that has performed best on the validation set.
+        results: List of dictionaries with the setting, best epoch and validation curve of each head.
+        best_checkpoint_name: Checkpoint file of the best head.
+    """
+    base_batch_size = min(head["batch_size"] for head in heads)
+    for head in heads:
+        if head["batch_size"] % base_batch_size != 0:
+            raise ValueError(
+                f"Batch size {head['batch_size']} is not a multiple of the smallest batch size {base_batch_size}"
+            )
+    if batch_augmentation and cached_head:
+        raise ValueError("Batch augmentation is not supported with cached features")
+
+    if cached_head:
+        train_dataset, val_dataset = get_feature_datasets(
+            model,
+            data_dir,
+            base_batch_size,
+            device,
+            augmentation_name=augmentation_name,
+            seed=seed,
+            max_batches=max_batches,
+            print_tqdm_interval=print_tqdm_interval,
+            image_size=image_size,
+        )
+    else:
+        train_dataset, val_dataset = get_train_validation_set(
+            data_dir,
+            augmentation_name=augmentation_name,
+            image_size=image_size,
+            batch_augmentation=batch_augmentation,
+        )
+    train_batch_transform, val_batch_transform = None, None
+    if batch_augmentation:
+        train_batch_transform, val_batch_transform = get_batch_transforms(
+            image_size, augmentation_name, device
+        )
+
+    train_loader = tuned_dataloader(
+        train_dataset,
+        batch_size=base_batch_size,
+        enabled=autotune_loader,
+        shuffle=True,
+        drop_last=True,
+    )
+    val_loader = tuned_dataloader(
+        val_dataset,
+        batch_size=base_batch_size,
+        enabled=autotune_loader,
+        shuffle=False,
+        drop_last=False,
+    )
+
+    def get_features(data_, batch_transform):
+        data_ = data_.to(device)
+        if cached_head:
+            return data_
+        if batch_transform is not None:
+            data_ = batch_transform(data_)
+        with torch.no_grad(), headless(model):
+            return model(data_)
+
+    in_features, num_classes = model.fc.in_features, model.fc.out_features
+    fcs = nn.ModuleList(
+        [nn.Linear(in_features, num_classes) for _ in heads]
+    ).to(device)
+    for fc in fcs:
+        fc.weight.data.normal_(0, 0.01)
+    optimizers = [
+        torch.optim.Adam(fc.parameters(), lr=head["lr"]) for fc, head in zip(fcs, heads)
+    ]
+    accumulation_steps = [head["batch_size"] // base_batch_size for head in heads]
+    loss_weights = torch.tensor(
+        [head.get("loss_scale", 1.0) / k for head, k in zip(heads, accumulation_steps)],
+        device=device,
+    )
+    tags = [
+        get_head_name(head["lr"], head["batch_size"], head.get("loss_scale", 1.0))
+        for head in heads
+    ]
+
+    writer = SummaryWriter("runs/")
+    scalar_writer = AsyncScalarWriter(writer)
+    checkpoint_writer = AsyncCheckpointWriter()
+    results = [
+        dict(head, best_epoch=-1, best_val_accuracy=-np.inf, val_accuracies=[])
+        for head in heads
+    ]
+
+    model.eval()
+    for epoch in tqdm(
+        range(1, epochs + 1),
+        desc="Sweep epoch",
+        mininterval=print_tqdm_interval,
+        maxinterval=print_tqdm_interval,
+    ):
+        fcs.train()
+        running_losses = torch.zeros(len(heads), device=device)
+        num_steps = 0
+        for optimizer in optimizers:
+            optimizer.zero_grad()
+        for batch_idx, (data_, target_) in enumerate(
+            tqdm(
+                train_loader,
+                leave=False,
+                mininterval=print_tqdm_interval,
+                maxinterval=print_tqdm_interval,
+            )
+        ):
+            # Adam: break loop requested, to speed up testing locally
+            if 0 < max_batches < batch_idx:
+                break
+
+            features = get_features(data_, train_batch_transform)
+            target_ = target_.to(device)
+            # The heads are independent, so a single backward of the weighted sum
+            # gives every head the gradient of its own (scaled) loss
+            losses = torch.stack(
+                [F.cross_entropy(fc(features), target_) for fc in fcs]
+            )
+            (losses * loss_weights).sum().backward()
+            running_losses += losses.detach()
+            num_steps += 1
+
+            for optimizer, k in zip(optimizers, accumulation_steps):
+                if (batch_idx + 1) % k == 0:
+                    optimizer.step()
+                    optimizer.zero_grad()
+
+        fcs.eval()
+        correct = torch.zeros(len(heads), dtype=torch.long, device=device)
+        num_samples = 0
+        with torch.no_grad():
+            for batch_idx, (data_, target_) in enumerate(val_loader):
+                if 0 < max_batches < batch_idx:
+                    break
+                features = get_features(data_, val_batch_transform)
+                target_ = target_.to(device)
+                preds = torch.stack([fc(features).argmax(dim=1) for fc in fcs])
+                correct += (preds == target_.unsqueeze(0)).sum(dim=1)
+                num_samples += target_.size(0)
+        val_accuracies = (correct.double() / num_samples).tolist()
+        running_losses = (running_losses / max(num_steps, 1)).tolist()
+
+        for h, (head, fc, optimizer, result) in enumerate(
+            zip(heads, fcs, optimizers, results)
+        ):
+            val_accuracy = val_accuracies[h]
+            result["val_accuracies"].append(val_accuracy)
+            scalar_writer.add_scalar(f"validation accuracy/{tags[h]}", val_accuracy, epoch)
+            scalar_writer.add_scalar(
+                f"training loss/{tags[h]}", running_losses[h], epoch
+            )
+            if result["best_val_accuracy"] < val_accuracy:
+                result["best_val_accuracy"] = val_accuracy
+                result["best_epoch"] = epoch
+                # Save every head in the checkpoint format of a separate run with its settings
+                model.fc = fc
+                checkpoint_writer.save(
+                    make_checkpoint(
+                        model,
+                        optimizer,
+                        epoch,
+                        running_losses[h],
+                        trainable_only=trainable_only_checkpoint,
+                        backbone_weights=str(BACKBONE_WEIGHTS),
+                    ),
+                    get_checkpoint_name(
+                        head["lr"], head["batch_size"], head.get("loss_scale", 1.0)
+                    ),
+                )
+
+    scalar_writer.close()
+    checkpoint_writer.close()
+
+    for result in results:
+        print(
+            f"Head lr {result['lr']}, batch size {result['batch_size']}, loss scale {result.get('loss_scale', 1.0)}: "
+            f"best accuracy {result['best_val_accuracy']} in epoch {result['best_epoch']}"
+        )
+    best = max(results, key=lambda r: r["best_val_accuracy"])
+    model.fc = nn.Linear(in_features, num_classes).to(device)
+    best_checkpoint_name = get_checkpoint_name(
+        best["lr"], best["batch_size"], best.get("loss_scale", 1.0)
+    )
+    model, _ = load_model(best_checkpoint_name, model)
+    return model, results, best_checkpoint_name
+
+
 def load_model(checkpoint_name, model):
-    """Load model from a given checkpoint"""
+    """
+    Load model from a given checkpoint.
+    Trainable-only checkpoints are merged into the pretrained backbone of the given model.
+    """
     checkpoint = torch.load(checkpoint_name)
-    model.load_state_dict(checkpoint["model_state_dict"])
+    merge_checkpoint(model, checkpoint, backbone_weights=str(BACKBONE_WEIGHTS))
     # FIXME we should also load the optimizer if we plan to continue training
     # Now I only use model loading for evaluation, and the optimizer wasn't immediately available
     # at all places where I call this function, so I skipped this
@@ -297,7 +901,14 @@ def load_model(checkpoint_name, model):
     return model, epoch
 
 
-def evaluate_model(model, data_loader, device, max_batches):
+def evaluate_model(
+    model,
+    data_loader,
+    device,
+    max_batches,
+    return_throughput=False,
+    batch_transform=None,
+):
     """
     Evaluates a trained model on a given dataset.
 
@@ -305,8 +916,11 @@ def evaluate_model(model, data_loader, device, max_batches):
         model: Model architecture to evaluate.
         data_loader: The data loader of the dataset to evaluate on.
         device: Device to use for training.
+        return_throughput: Also return the number of evaluated images per second.
+        batch_transform: Transformation to apply on each batch on the device (see BatchTransform).
     Returns:
         accuracy: The accuracy on the dataset.
+        throughput: The number of evaluated images per second, only if return_throughput is set.
 
     """
     #######################
@@ -323,6 +937,7 @@ def evaluate_model(model, data_loader, device, max_batches):
 
     loss_module = nn.CrossEntropyLoss()
 
+    start_time = time.time()
     with torch.no_grad():
         for batch_idx, (data_t, target_t) in (
             batch_pbar := tqdm(
@@ -338,6 +953,8 @@ def evaluate_model(model, data_loader, device, max_batches):
                 break
 
             data_t, target_t = data_t.to(device), target_t.to(device)
+            if batch_transform is not None:
+                data_t = batch_transform(data_t)
             outputs_t = model(data_t)
             loss_t = loss_module(outputs_t, target_t)
             batch_losses.append(loss_t.item())
@@ -350,14 +967,99 @@ def evaluate_model(model, data_loader, device, max_batches):
     epoch_labels = np.concatenate(epoch_labels)
     correct_preds = epoch_preds == epoch_labels
     accuracy = correct_preds.sum() / len(epoch_labels)
+    throughput = len(epoch_labels) / (time.time() - start_time)
 
     #######################
     # END OF YOUR CODE    #
     #######################
 
+    if return_throughput:
+        return accuracy, throughput
     return accuracy
 
 
+# Corruptions of the robustness sweep. Each maps a batch of normalized images and a tensor of
+# L severities to a tensor of shape (L, *batch.shape), with one corrupted copy per severity.
+CORRUPTIONS = {
+    "gaussian_noise": lambda x, s: x.unsqueeze(0)
+    + torch.randn((len(s),) + x.shape, device=x.device, dtype=x.dtype)
+    * s.view(-1, 1, 1, 1, 1),
+    # reduces the contrast towards the mean image of the dataset (which is 0 after normalization)
+    "contrast": lambda x, s: x.unsqueeze(0) * (1 - s.view(-1, 1, 1, 1, 1)),
+}
+
+
+def evaluate_robustness(
+    model,
+    data_loader,
+    device,
+    severities,
+    max_batches=0,
+    batch_transform=None,
+    print_tqdm_interval=1.0,
+):
+    """
+    Evaluates the model on the clean data and on several corrupted versions of it in a single pass.
+
+    Each batch is loaded only once; the corrupted versions are generated on the device as extra
+    slices of the batch, and the clean and corrupted slices go through the model in one forward pass.
+
+    Args:
+        model: Model to evaluate.
+        data_loader: Data loader of the clean dataset.
+        device: Device to use.
+        severities: Dictionary of corruption name (see CORRUPTIONS) to a list of severities,
+            e.g. standard deviations for gaussian_noise.
+        batch_transform: Transformation to apply on each batch on the device (see BatchTransform).
+    Returns:
+        results: List of dictionaries with the corruption, severity and accuracy, starting with the clean data.
+    """
+    model.eval()
+    levels = [("clean", 0.0)] + [
+        (name, severity) for name, values in severities.items() for severity in values
+    ]
+    correct = torch.zeros(len(levels), dtype=torch.long, device=device)
+    num_samples = 0
+
+    with torch.no_grad():
+        for batch_idx, (data_t, target_t) in enumerate(
+            tqdm(
+                data_loader,
+                leave=False,
+                mininterval=print_tqdm_interval,
+                maxinterval=print_tqdm_interval,
+            )
+        ):
+            # Adam: break loop requested, to speed up testing locally
+            if 0 < max_batches < batch_idx:
+                break
+
+            data_t, target_t = data_t.to(device), target_t.to(device)
+            if batch_transform is not None:
+                data_t = batch_transform(data_t)
+
+            variants = [data_t.unsqueeze(0)]
+            for name, values in severities.items():
+                if values:
+                    variants.append(
+                        CORRUPTIONS[name](
+                            data_t, torch.tensor(values, device=device, dtype=data_t.dtype)
+                        )
+                    )
+            variants = torch.cat(variants)
+
+            outputs_t = model(variants.flatten(0, 1))
+            preds_t = outputs_t.argmax(dim=1).view(len(levels), -1)
+            correct += (preds_t == target_t.unsqueeze(0)).sum(dim=1)
+            num_samples += target_t.size(0)
+
+    accuracies = (correct.double() / num_samples).tolist()
+    return [
+        {"corruption": name, "severity": severity, "accuracy": accuracy}
+        for (name, severity), accuracy in zip(levels, accuracies)
+    ]
+
+
 def main(
     lr,
     batch_size,
@@ -370,6 +1072,24 @@ def main(
     evaluate=False,
     resume_best=False,
     max_batches=0,
+    cached_head=False,
+    solver="adam",
+    l2_grid=(1e-2, 1e-3, 1e-4, 1e-5, 1e-6),
+    image_size=224,
+    progressive_resize=False,
+    batch_augmentation=False,
+    augmentation_bank_dir=None,
+    log_every=50,
+    full_checkpoint=False,
+    quantized_eval=False,
+    num_calibration_images=512,
+    robustness_sweep=False,
+    noise_stds=(0.05, 0.1, 0.2, 0.3, 0.5),
+    contrast_levels=(),
+    sweep_lrs=None,
+    sweep_batch_sizes=None,
+    sweep_loss_scales=None,
+    autotune_loader=False,
 ):
     """
     Main function for training and testing the model.
@@ -381,6 +1101,24 @@ def main(
         data_dir: Directory where the CIFAR10 dataset should be loaded from or downloaded to.
         seed: Seed for reproducibility.
         augmentation_name: Name of the augmentation to use.
+        cached_head: Train the last layer on cached features of the frozen backbone.
+        solver: Train the last layer with mini-batch Adam, or fit it with full-batch L-BFGS.
+        l2_grid: L2 strengths to search over with the L-BFGS solver.
+        image_size: Input resolution. With progressive_resize, this is the final training resolution.
+        progressive_resize: Train with a resolution growing over the epochs.
+        batch_augmentation: Resize, augment and normalize whole batches on the device.
+        augmentation_bank_dir: Root directory of precomputed augmentation banks to replay the training epochs from.
+        log_every: Number of steps to aggregate the training loss and accuracy over before logging them.
+        full_checkpoint: Save the full model in the checkpoints, instead of only the trainable parameters.
+        quantized_eval: Also evaluate a static int8 quantized version of the model on the CPU.
+        num_calibration_images: Number of validation images to calibrate the quantized model on.
+        robustness_sweep: Evaluate the accuracy on the clean and corrupted test set in a single pass.
+        noise_stds: Standard deviations of the Gaussian noise levels of the robustness sweep.
+        contrast_levels: Contrast reduction levels (between 0 and 1) of the robustness sweep.
+        sweep_lrs: Learning rates to train heads for simultaneously on one backbone (see train_heads_sweep).
+        sweep_batch_sizes: Batch sizes to train heads for, multiples of the smallest one.
+        sweep_loss_scales: Loss scales to train heads for.
+        autotune_loader: Use autotuned worker, prefetching and pinning settings for the data loaders.
     """
     #######################
     # PUT YOUR CODE HERE  #
@@ -394,10 +1132,38 @@ def main(
     # Set up checkpoint to save to or load from
     model_dir = "save/models"
     os.makedirs(model_dir, exist_ok=True)
-    checkpoint_name = f"{model_dir}/restnet18_best_model_{get_dataset_name()}_{augmentation_name}_{lr}_{batch_size}.pt"
+    resolution_suffix = ""
+    if image_size != 224:
+        resolution_suffix += f"_{image_size}px"
+    if progressive_resize:
+        resolution_suffix += "_progressive"
+    if batch_augmentation:
+        resolution_suffix += "_batchaug"
+    if augmentation_bank_dir is not None:
+        resolution_suffix += "_bank"
+    # the cached head trains on eval mode features (see extract_features), so it gets its own
+    # checkpoints and results
+    if cached_head:
+        resolution_suffix += "_cached"
+
+    # the heads of a sweep are trained with the backbone in eval mode (see train_heads_sweep),
+    # so they get their own checkpoints
+    is_sweep = bool(sweep_lrs or sweep_batch_sizes or sweep_loss_scales)
+
+    def get_checkpoint_name(lr, batch_size, loss_scale=1.0):
+        name = f"{model_dir}/restnet18_best_model_{get_dataset_name()}_{augmentation_name}_{get_head_name(lr, batch_size, loss_scale)}"
+        if is_sweep:
+            name += "_sweep"
+        return f"{name}{resolution_suffix}.pt"
+
+    if solver == "lbfgs":
+        # the learning rate and batch size have no effect on the L-BFGS solution
+        checkpoint_name = f"{model_dir}/restnet18_best_model_{get_dataset_name()}_{augmentation_name}_lbfgs{resolution_suffix}.pt"
+    else:
+        checkpoint_name = get_checkpoint_name(lr, batch_size)
 
     # Load the model
-    model = get_model().to(device)
+    model = get_model(image_size=image_size).to(device)
 
     # Load best previously trained model if required
     if resume_best:
@@ -405,7 +1171,59 @@ def main(
         model, best_epoch = load_model(checkpoint_name, model)
 
     # Train the model, unless we are in evaluation-only mode
-    if not evaluate:
+    if not evaluate and solver == "lbfgs":
+        model = train_head_lbfgs(
+            model=model,
+            batch_size=batch_size,
+            data_dir=data_dir,
+            checkpoint_name=checkpoint_name,
+            device=device,
+            augmentation_name=augmentation_name,
+            weight_decays=l2_grid,
+            print_tqdm_interval=print_tqdm_interval,
+            max_batches=max_batches,
+            seed=seed,
+            image_size=image_size,
+            trainable_only_checkpoint=not full_checkpoint,
+        )
+    elif not evaluate and is_sweep:
+        # Adam: train all settings of the sweep at once, sharing the backbone forward passes
+        if progressive_resize or augmentation_bank_dir is not None:
+            raise ValueError(
+                "Progressive resizing and augmentation banks are not supported in a sweep"
+            )
+        heads = [
+            {"lr": head_lr, "batch_size": head_batch_size, "loss_scale": loss_scale}
+            for head_lr in sweep_lrs or [lr]
+            for head_batch_size in sweep_batch_sizes or [batch_size]
+            for loss_scale in sweep_loss_scales or [1.0]
+        ]
+        model, sweep_results, checkpoint_name = train_heads_sweep(
+            model=model,
+            heads=heads,
+            epochs=epochs,
+            data_dir=data_dir,
+            get_checkpoint_name=get_checkpoint_name,
+            device=device,
+            augmentation_name=augmentation_name,
+            print_tqdm_interval=print_tqdm_interval,
+            max_batches=max_batches,
+            cached_head=cached_head,
+            seed=seed,
+            image_size=image_size,
+            batch_augmentation=batch_augmentation,
+            trainable_only_checkpoint=not full_checkpoint,
+            autotune_loader=autotune_loader,
+        )
+        # not in results_resnet18, which only contains test results (see summarize_results.py)
+        sweep_dir = "results_resnet18_sweep"
+        os.makedirs(sweep_dir, exist_ok=True)
+        with open(
+            f"{sweep_dir}/sweep_{get_dataset_name()}_{augmentation_name}{resolution_suffix}.json",
+            "w",
+        ) as f:
+            json.dump(sweep_results, f)
+    elif not evaluate:
         # Get the augmentation to use
         # ..we just pass the name here, nothing to do
 
@@ -421,25 +1239,160 @@ def main(
             augmentation_name=augmentation_name,
             print_tqdm_interval=print_tqdm_interval,
             max_batches=max_batches,
+            cached_head=cached_head,
+            seed=seed,
+            image_size=image_size,
+            progressive_resize=progressive_resize,
+            batch_augmentation=batch_augmentation,
+            augmentation_bank_dir=augmentation_bank_dir,
+            log_every=log_every,
+            trainable_only_checkpoint=not full_checkpoint,
+            autotune_loader=autotune_loader,
         )
 
     # Evaluate the model on the test set
-    test_dataset = get_test_set(data_dir, test_noise)
-    test_loader = data.DataLoader(
-        dataset=test_dataset, batch_size=batch_size, shuffle=False, drop_last=False
+    test_dataset = get_test_set(
+        data_dir, test_noise, image_size=image_size, batch_augmentation=batch_augmentation
+    )
+    test_loader = tuned_dataloader(
+        test_dataset,
+        batch_size=batch_size,
+        enabled=autotune_loader,
+        shuffle=False,
+        drop_last=False,
+    )
+    test_batch_transform = None
+    if batch_augmentation:
+        test_batch_transform = BatchTransform(
+            image_size, "test_noise" if test_noise else None
+        ).to(device)
+    test_accuracy, test_throughput = evaluate_model(
+        model,
+        test_loader,
+        device,
+        max_batches=max_batches,
+        return_throughput=True,
+        batch_transform=test_batch_transform,
     )
-    test_accuracy = evaluate_model(model, test_loader, device, max_batches=max_batches)
     print(f"Test accuracy of best model: {test_accuracy}")
+    print(f"Test throughput: {test_throughput:.1f} images/s")
 
     results_dir = "results_resnet18"
     os.makedirs(results_dir, exist_ok=True)
-    fn = f"resnet_{get_dataset_name()}_{augmentation_name}_{test_noise}.json"
+    # the L-BFGS solver and the best head of a sweep get their own results
+    result_suffix = resolution_suffix
+    if solver == "lbfgs":
+        result_suffix += "_lbfgs"
+    elif is_sweep:
+        result_suffix += "_sweep"
+    if progressive_resize:
+        # the resolution schedule depends on the number of epochs
+        result_suffix += f"_from{PROGRESSIVE_MIN_IMAGE_SIZE}px_{epochs}ep"
+    fn = f"resnet_{get_dataset_name()}_{augmentation_name}_{test_noise}{result_suffix}.json"
     result = {
         "dataset": get_dataset_name(),
         "augmentation_name": augmentation_name,
         "test_noise": test_noise,
+        "cached_head": cached_head,
+        "solver": solver,
+        "sweep": is_sweep,
         "test_accuracy": test_accuracy,
+        "image_size": image_size,
+        "progressive_resize": progressive_resize,
+        "progressive_min_image_size": PROGRESSIVE_MIN_IMAGE_SIZE if progressive_resize else None,
+        "epochs": epochs,
+        "test_throughput": test_throughput,
+        "batch_augmentation": batch_augmentation,
+        "device": device,
     }
+
+    # Adam: compare against a static int8 model, which is a lot faster on the CPU nodes
+    if quantized_eval:
+        if device != "cpu":
+            print(
+                f"Warning: the fp32 model was evaluated on {device}, "
+                f"so its throughput is not comparable to the int8 model on the CPU"
+            )
+        cpu_batch_transform = None
+        if batch_augmentation:
+            cpu_batch_transform = BatchTransform(image_size)
+        _, calibration_dataset = get_train_validation_set(
+            data_dir, image_size=image_size, batch_augmentation=batch_augmentation
+        )
+        calibration_dataset = data.Subset(
+            calibration_dataset,
+            range(min(num_calibration_images, len(calibration_dataset))),
+        )
+        qmodel = get_quantized_model(
+            model,
+            checkpoint_name,
+            calibration_dataset,
+            batch_size=batch_size,
+            batch_transform=cpu_batch_transform,
+            print_tqdm_interval=print_tqdm_interval,
+        )
+        if batch_augmentation:
+            cpu_batch_transform = BatchTransform(
+                image_size, "test_noise" if test_noise else None
+            )
+        quantized_accuracy, quantized_throughput = evaluate_model(
+            qmodel,
+            test_loader,
+            "cpu",
+            max_batches=max_batches,
+            return_throughput=True,
+            batch_transform=cpu_batch_transform,
+        )
+        print(
+            f"Test accuracy of int8 model: {quantized_accuracy} "
+            f"(delta {quantized_accuracy - test_accuracy:+.4f})"
+        )
+        print(
+            f"Test throughput of int8 model: {quantized_throughput:.1f} images/s "
+            f"(speed-up {quantized_throughput / test_throughput:.2f}x)"
+        )
+        result.update(
+            {
+                "quantized_test_accuracy": quantized_accuracy,
+                "quantized_test_throughput": quantized_throughput,
+                "quantized_accuracy_delta": quantized_accuracy - test_accuracy,
+            }
+        )
+
+    # Adam: evaluate all noise levels in one pass instead of rerunning everything per --test_noise setting
+    if robustness_sweep:
+        clean_loader = test_loader
+        clean_batch_transform = test_batch_transform
+        if test_noise:
+            clean_loader = data.DataLoader(
+                dataset=get_test_set(
+                    data_dir,
+                    False,
+                    image_size=image_size,
+                    batch_augmentation=batch_augmentation,
+                ),
+                batch_size=batch_size,
+                shuffle=False,
+                drop_last=False,
+            )
+            if batch_augmentation:
+                clean_batch_transform = BatchTransform(image_size).to(device)
+        robustness = evaluate_robustness(
+            model,
+            clean_loader,
+            device,
+            {"gaussian_noise": list(noise_stds), "contrast": list(contrast_levels)},
+            max_batches=max_batches,
+            batch_transform=clean_batch_transform,
+            print_tqdm_interval=print_tqdm_interval,
+        )
+        print("Accuracy vs. severity:")
+        for level in robustness:
+            print(
+                f"  {level['corruption']:15} {level['severity']:5.2f}  {level['accuracy']:.4f}"
+            )
+        result["robustness"] = robustness
+
     with open(f"{results_dir}/{fn}", "w") as f:
         json.dump(result, f)
 
@@ -505,6 +1458,124 @@ if __name__ == "__main__":
         default=0,
         help="limit number of batches in each training and evaluation loop to aid testing",
     )
+    # Adam: option to train the head on cached backbone features, which is a lot faster
+    parser.add_argument(
+        "--cached_head",
+        default=False,
+        action="store_true",
+        help="extract the features of the frozen backbone once and train the last layer on the cached features",
+    )
+    parser.add_argument(
+        "--solver",
+        default="adam",
+        type=str,
+        choices=["adam", "lbfgs"],
+        help="train the last layer with mini-batch Adam, or fit it on cached features with full-batch L-BFGS",
+    )
+    parser.add_argument(
+        "--l2_grid",
+        nargs="+",
+        type=float,
+        default=[1e-2, 1e-3, 1e-4, 1e-5, 1e-6],
+        help="L2 strengths to select from on the validation set with the L-BFGS solver",
+    )
+    # Adam: upsampling the 32x32 images to 224 is a lot of overhead for fast iteration runs
+    parser.add_argument(
+        "--image_size",
+        default=224,
+        type=int,
+        help="input resolution (e.g. 32, 64, 112 or 224), the stem of the model is adapted for 64 and below",
+    )
+    parser.add_argument(
+        "--progressive_resize",
+        default=False,
+        action="store_true",
+        help="train with a resolution growing from 112 to --image_size over the epochs",
+    )
+    parser.add_argument(
+        "--batch_augmentation",
+        default=False,
+        action="store_true",
+        help="resize, augment and normalize whole batches of uint8 images on the device instead of per sample",
+    )
+    parser.add_argument(
+        "--augmentation_bank_dir",
+        default=None,
+        type=str,
+        help="replay the augmented epochs from the banks in this directory, created with augmentation_bank.py",
+    )
+    parser.add_argument(
+        "--log_every",
+        default=50,
+        type=int,
+        help="number of training steps to aggregate the loss and accuracy over before logging them",
+    )
+    # Adam: by default only the trainable layer is saved, which is ~1% of the full model
+    parser.add_argument(
+        "--full_checkpoint",
+        default=False,
+        action="store_true",
+        help="save the full model in the checkpoints instead of only the trainable parameters",
+    )
+    parser.add_argument(
+        "--quantized_eval",
+        default=False,
+        action="store_true",
+        help="also evaluate a static int8 version of the model on the CPU, cached next to the checkpoint",
+    )
+    parser.add_argument(
+        "--num_calibration_images",
+        default=512,
+        type=int,
+        help="number of validation images to calibrate the int8 model on",
+    )
+    parser.add_argument(
+        "--sweep_lrs",
+        nargs="+",
+        type=float,
+        default=None,
+        help="learning rates to train heads for simultaneously on one backbone forward pass",
+    )
+    parser.add_argument(
+        "--sweep_batch_sizes",
+        nargs="+",
+        type=int,
+        default=None,
+        help="batch sizes of the sweep heads, multiples of the smallest one (emulated with gradient accumulation)",
+    )
+    parser.add_argument(
+        "--sweep_loss_scales",
+        nargs="+",
+        type=float,
+        default=None,
+        help="loss scales of the sweep heads",
+    )
+    parser.add_argument(
+        "--autotune_loader",
+        default=False,
+        action="store_true",
+        help="autotune the data loader settings on first use and reuse them in later runs",
+    )
+    parser.add_argument(
+        "--robustness_sweep",
+        default=False,
+        action="store_true",
+        help="evaluate the accuracy on the clean test set and on all corruption levels in a single pass",
+    )
+    parser.add_argument(
+        "--noise_stds",
+        nargs="+",
+        type=float,
+        default=[0.05, 0.1, 0.2, 0.3, 0.5],
+        help="standard deviations of the Gaussian noise levels of the robustness sweep",
+    )
+    parser.add_argument(
+        "--contrast_levels",
+        nargs="*",
+        type=float,
+        default=[],
+        help="optional contrast reduction levels (between 0 and 1) of the robustness sweep",
+    )
 
     args = parser.parse_args()
     kwargs = vars(args)
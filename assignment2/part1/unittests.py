@@ -0,0 +1,318 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.utils.data as data
+import torchvision
+
+from checkpointing import AsyncCheckpointWriter, make_checkpoint, merge_checkpoint
+from feature_store import extract_features, feature_cache_name, get_feature_dataset
+from metrics import AsyncScalarWriter
+from quantization import quantize_model
+from train import get_batch_transforms, get_head_name, get_progressive_image_size
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from loader_autotune import get_cache_key, get_candidates, tuned_dataloader  # noqa: E402
+
+
+class TinyNet(nn.Module):
+    """Backbone with a classification head in model.fc, like the ResNet18."""
+
+    def __init__(self, in_features=8, num_features=4, num_classes=3):
+        super().__init__()
+        self.body = nn.Sequential(nn.Linear(in_features, num_features), nn.BatchNorm1d(num_features))
+        self.fc = nn.Linear(num_features, num_classes)
+
+    def forward(self, x):
+        return self.fc(self.body(x))
+
+
+class TestFeatureStore(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(42)
+        self.model = TinyNet()
+        self.dataset = data.TensorDataset(torch.randn(10, 8), torch.randint(0, 3, (10,)))
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_name = feature_cache_name(self.tmp_dir.name, "tiny", "train")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def extract(self, model):
+        return extract_features(model, self.dataset, self.cache_name, batch_size=4, device="cpu")
+
+    @torch.no_grad()
+    def test_round_trip(self):
+        self.model.train()
+        features, labels = self.extract(self.model)
+        self.assertTrue(self.model.training, msg="The training mode of the model must be restored")
+        self.assertIsInstance(features, np.memmap, msg="The features must be memory-mapped")
+        self.assertEqual(features.dtype, np.float16)
+        self.assertEqual(features.shape, (10, 4))
+
+        self.model.eval()
+        expected = self.model.body(self.dataset.tensors[0])
+        dataset = get_feature_dataset(features, labels)
+        self.assertEqual(len(dataset), 10)
+        for i in range(len(dataset)):
+            x, y = dataset[i]
+            self.assertEqual(x.dtype, torch.float32)
+            self.assertTrue(torch.allclose(x, expected[i], atol=1e-2))
+            self.assertEqual(y, self.dataset.tensors[1][i].item())
+
+        x, y = next(iter(data.DataLoader(dataset, batch_size=4)))
+        self.assertEqual(x.shape, (4, 4))
+        self.assertEqual(y.dtype, torch.int64)
+
+    @torch.no_grad()
+    def test_cache_hit(self):
+        features, labels = self.extract(self.model)
+        self.assertFalse(
+            any(name.endswith(".tmp.npy") for name in os.listdir(self.tmp_dir.name)),
+            msg="No temporary files may be left behind",
+        )
+
+        class Failing(nn.Module):
+            def forward(self, x):
+                raise AssertionError("The backbone must not run for cached features")
+
+        cached_features, cached_labels = self.extract(Failing())
+        self.assertTrue(np.array_equal(features, cached_features))
+        self.assertTrue(np.array_equal(labels, cached_labels))
+
+
+class RecordingWriter:
+    """SummaryWriter stand-in that records the scalars, and fails for the tag "fail"."""
+
+    def __init__(self):
+        self.scalars = []
+        self.flushed = False
+
+    def add_scalar(self, tag, value, step):
+        if tag == "fail":
+            raise OSError("disk full")
+        self.scalars.append((tag, value, step))
+
+    def flush(self):
+        self.flushed = True
+
+
+class TestAsyncScalarWriter(unittest.TestCase):
+
+    def test_writes_in_order(self):
+        writer = RecordingWriter()
+        scalar_writer = AsyncScalarWriter(writer)
+        for step in range(100):
+            scalar_writer.add_scalar("loss", float(step), step)
+        scalar_writer.close()
+        self.assertEqual(writer.scalars, [("loss", float(step), step) for step in range(100)])
+        self.assertTrue(writer.flushed)
+
+    def test_error_is_raised(self):
+        writer = RecordingWriter()
+        scalar_writer = AsyncScalarWriter(writer)
+        scalar_writer.add_scalar("fail", 0.0, 0)
+        with self.assertRaises(RuntimeError, msg="A failed write must be raised by close()") as cm:
+            scalar_writer.close()
+        self.assertIsInstance(cm.exception.__cause__, OSError)
+        with self.assertRaises(RuntimeError, msg="Later writes must raise the error as well"):
+            scalar_writer.add_scalar("loss", 1.0, 1)
+
+
+class TestCheckpointing(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(42)
+        self.model = TinyNet()
+        self.model.body[0].requires_grad_(False)
+        self.optimizer = torch.optim.SGD(self.model.fc.parameters(), lr=0.1)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, "model.pt")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def new_model(self):
+        """Returns a model with the same frozen weights, but a different head and batch norm statistics."""
+        model = TinyNet()
+        model.body[0].load_state_dict(self.model.body[0].state_dict())
+        model.body[0].requires_grad_(False)
+        return model
+
+    def test_round_trip(self):
+        # updates the batch norm statistics, which are part of the trainable-only state
+        self.model.train()
+        self.model(torch.randn(16, 8)).sum().backward()
+        self.optimizer.step()
+
+        writer = AsyncCheckpointWriter()
+        writer.save(
+            make_checkpoint(self.model, self.optimizer, 3, 0.5, backbone_weights="tiny"),
+            self.filename,
+        )
+        # the checkpoint is a snapshot, later updates must not end up in the file
+        expected = {k: v.clone() for k, v in self.model.state_dict().items()}
+        with torch.no_grad():
+            self.model.fc.weight.add_(1.0)
+        writer.close()
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["model.pt"], msg="No temporary files may be left behind")
+
+        checkpoint = torch.load(self.filename)
+        self.assertEqual(checkpoint["epoch"], 3)
+        self.assertNotIn("body.0.weight", checkpoint["model_state_dict"], msg="Frozen weights must not be saved")
+        model = merge_checkpoint(self.new_model(), checkpoint, backbone_weights="tiny")
+        for name, tensor in model.state_dict().items():
+            self.assertTrue(torch.equal(tensor, expected[name]), msg=f"{name} differs after loading")
+
+    def test_backbone_mismatch(self):
+        checkpoint = make_checkpoint(self.model, self.optimizer, 1, 0.0, backbone_weights="tiny")
+        with self.assertRaises(ValueError):
+            merge_checkpoint(self.new_model(), checkpoint, backbone_weights="other")
+
+    def test_error_is_raised(self):
+        writer = AsyncCheckpointWriter()
+        writer.save(
+            make_checkpoint(self.model, self.optimizer, 1, 0.0),
+            os.path.join(self.tmp_dir.name, "missing", "model.pt"),
+        )
+        with self.assertRaises(RuntimeError):
+            writer.close()
+
+
+class TestQuantization(unittest.TestCase):
+
+    def test_model_is_not_modified(self):
+        torch.manual_seed(42)
+        model = torchvision.models.resnet18(weights=None, num_classes=10)
+        model.train()
+        expected = {k: v.clone() for k, v in model.state_dict().items()}
+        weight = model.fc.weight
+        calibration_dataset = data.TensorDataset(torch.randn(4, 3, 64, 64), torch.zeros(4))
+
+        qmodel = quantize_model(model, calibration_dataset, batch_size=2, print_tqdm_interval=60)
+        with torch.no_grad():
+            self.assertEqual(qmodel(torch.randn(2, 3, 64, 64)).shape, (2, 10))
+
+        self.assertTrue(model.training, msg="The model must stay in training mode")
+        self.assertIs(model.fc.weight, weight, msg="The parameters of the model must not be replaced")
+        for name, tensor in model.state_dict().items():
+            self.assertTrue(torch.equal(tensor, expected[name]), msg=f"{name} has been modified")
+
+
+class TestBatchTransforms(unittest.TestCase):
+
+    def test_progressive_resize_with_augmentation_bank(self):
+        images = torch.randint(0, 256, (4, 3, 32, 32), dtype=torch.uint8)
+        train_batch_transform, val_batch_transform = get_batch_transforms(
+            224, "random_hflip", "cpu", augmentation_bank=True
+        )
+        self.assertIsNot(train_batch_transform, val_batch_transform)
+        self.assertIsNone(train_batch_transform.augmentation_name,
+                          msg="The images of the bank are augmented already")
+
+        # the first epoch of a progressive run, as in train_model
+        epoch_image_size = get_progressive_image_size(1, 6)
+        self.assertLess(epoch_image_size, 224)
+        train_batch_transform.image_size = epoch_image_size
+        self.assertEqual(train_batch_transform(images).shape[-1], epoch_image_size)
+        self.assertEqual(val_batch_transform(images).shape[-1], 224,
+                         msg="The validation must run at the final image size")
+
+    def test_augmentation(self):
+        train_batch_transform, val_batch_transform = get_batch_transforms(64, "random_hflip", "cpu")
+        self.assertEqual(train_batch_transform.augmentation_name, "random_hflip")
+        self.assertIsNone(val_batch_transform.augmentation_name)
+
+
+class TestHeadName(unittest.TestCase):
+
+    def test_names_are_unique(self):
+        settings = [(lr, bs, ls) for lr in [1e-3, 1e-2] for bs in [64, 128] for ls in [0.5, 1.0, 2.0]]
+        names = {get_head_name(*setting) for setting in settings}
+        self.assertEqual(len(names), len(settings), msg="Every head needs its own checkpoint and tags")
+        # the names of regular runs are kept
+        self.assertEqual(get_head_name(1e-3, 64), "0.001_64")
+
+
+class EpochDataset(data.Dataset):
+    """Dataset that changes between epochs, like the AugmentationBankDataset."""
+
+    def __init__(self):
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, idx):
+        return self.epoch
+
+
+class TestLoaderAutotune(unittest.TestCase):
+
+    def test_candidates(self):
+        self.assertTrue(any(c.get("persistent_workers") for c in get_candidates(4)))
+        self.assertFalse(any(c.get("persistent_workers") for c in get_candidates(4, persistent_workers=False)))
+
+    def test_no_persistent_workers_with_set_epoch(self):
+        dataset = EpochDataset()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # settings cached for the dataset before persistent workers were excluded
+            cache_file = os.path.join(tmp_dir, "cache.json")
+            settings = {"num_workers": 1, "prefetch_factor": 2, "persistent_workers": True, "pin_memory": False}
+            with open(cache_file, "w") as f:
+                json.dump({get_cache_key(dataset, 2): {"settings": settings, "throughput": 1.0}}, f)
+
+            loader = tuned_dataloader(dataset, batch_size=2, cache_file=cache_file)
+            self.assertFalse(loader.persistent_workers)
+            for epoch in range(3):
+                dataset.set_epoch(epoch)
+                self.assertTrue(all((batch == epoch).all() for batch in loader),
+                                msg="The workers must see the epoch set in the main process")
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFeatureStore)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestAsyncScalarWriter)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCheckpointing)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestQuantization)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestBatchTransforms)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestHeadName)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestLoaderAutotune)
+    unittest.TextTestRunner(verbosity=2).run(suite)
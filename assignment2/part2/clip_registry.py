@@ -0,0 +1,101 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""
+Process-wide registry of the pretrained CLIP models.
+
+Every model is loaded and built only once per process, and all callers share the same frozen
+instance. The weights are read from a plain state dict that is converted once from the JIT
+archive and memory-mapped afterwards. The preprocessing is created without loading any weights.
+"""
+import os
+
+import torch
+from clip import clip
+
+
+# Input resolution of the pretrained models, to create the preprocessing without loading them
+INPUT_RESOLUTIONS = {
+    "RN50": 224,
+    "RN101": 224,
+    "RN50x4": 288,
+    "RN50x16": 384,
+    "RN50x64": 448,
+    "ViT-B/32": 224,
+    "ViT-B/16": 224,
+    "ViT-L/14": 224,
+    "ViT-L/14@336px": 336,
+}
+
+_models = {}
+
+
+def get_model_path(arch, root=None):
+    """Downloads the JIT archive of the pretrained model if needed and returns its path."""
+    if root is None:
+        root = os.path.expanduser("~/.cache/clip")
+    return clip._download(clip._MODELS[arch], root)
+
+
+def load_state_dict(arch, root=None):
+    """
+    Returns the state dict of the pretrained model.
+
+    The JIT archive can only be read completely into memory. Its state dict is therefore stored
+    once next to it as a regular checkpoint, which is memory-mapped on all later loads.
+    """
+    model_path = get_model_path(arch, root)
+    state_dict_path = f"{model_path}.state_dict.pt"
+    if not os.path.isfile(state_dict_path):
+        try:
+            # loading JIT archive
+            state_dict = torch.jit.load(model_path, map_location="cpu").eval().state_dict()
+        except RuntimeError:
+            state_dict = torch.load(model_path, map_location="cpu")
+        tmp_path = f"{state_dict_path}.{os.getpid()}.tmp"
+        torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, state_dict_path)
+        del state_dict
+    return torch.load(state_dict_path, map_location="cpu", mmap=True, weights_only=True)
+
+
+def get_clip_model(arch, root=None):
+    """
+    Returns the shared, frozen CLIP model of the given architecture.
+
+    The model is built on the CPU on first use. Callers may move it to their device or convert it
+    to another dtype (see precision.prepare_clip_model), which then applies to the shared instance,
+    but must not modify its weights.
+    """
+    if arch not in _models:
+        model = clip.build_model(load_state_dict(arch, root))
+        model.eval()
+        model.requires_grad_(False)
+        _models[arch] = model
+    return _models[arch]
+
+
+def get_preprocess(arch, input_resolution=None):
+    """
+    Returns the image preprocessing of the pretrained model, without loading the model.
+    With an input_resolution, the images are resized to it instead of the resolution of the model
+    (see vit.py for running the model at other resolutions).
+    """
+    if input_resolution is not None:
+        return clip._transform(input_resolution)
+    if arch in _models:
+        return clip._transform(_models[arch].visual.input_resolution)
+    return clip._transform(INPUT_RESOLUTIONS[arch])
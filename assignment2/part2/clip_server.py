@@ -0,0 +1,387 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""
+Local HTTP server for zero-shot CLIP classification.
+
+The model and the text features are loaded once. Requests from all clients are coalesced into
+dynamic batches: a batch is run as soon as it is full or the oldest image in it has waited
+--max_latency_ms. Endpoints:
+
+    POST /classify  {"images": [base64 encoded image files], "top_k": 5}
+                    -> {"predictions": [[{"class": name, "probability": p}, ...], ...]}
+    POST /classes   {"class_names": [...], "template": "This is a photo of a {}"}
+                    -> replaces the classes (the text features come from the text feature cache)
+    GET  /stats     -> request, image and batch counters, p50/p99 latency and throughput
+
+See load_generator.py for a client that measures the server under load.
+"""
+import argparse
+import base64
+import io
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from PIL import Image
+
+from clipzs import ZeroshotCLIP, load_dataset
+from clip_registry import get_preprocess
+from text_features import get_text_features
+
+
+def parse_option():
+    parser = argparse.ArgumentParser("Zero-shot CLIP server")
+
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument(
+        "--max_batch_size", type=int, default=64, help="maximum number of images in a batch"
+    )
+    parser.add_argument(
+        "--max_latency_ms",
+        type=float,
+        default=10.0,
+        help="maximum time an image waits for other images to fill its batch",
+    )
+    parser.add_argument(
+        "--stats_window",
+        type=int,
+        default=10000,
+        help="number of most recent requests of the latency percentiles",
+    )
+
+    # model
+    parser.add_argument("--arch", type=str, default="ViT-B/32", choices=["ViT-B/32", "ViT-B/16"])
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="auto",
+        choices=["auto", "fp32", "fp16", "bf16"],
+        help="precision of the frozen CLIP weights and the forward passes; auto uses fp16 on the GPU and fp32 otherwise",
+    )
+    parser.add_argument(
+        "--input_resolution",
+        type=int,
+        default=None,
+        help="resize the images to this resolution instead of the resolution of the pretrained model",
+    )
+    parser.add_argument(
+        "--token_schedule",
+        type=str,
+        default=None,
+        help="number of tokens to merge/prune before every transformer layer (see clipzs.py)",
+    )
+    parser.add_argument(
+        "--token_reduction", type=str, default="merge", choices=["merge", "prune"]
+    )
+
+    # classes
+    parser.add_argument("--root", type=str, default="./data", help="dataset")
+    parser.add_argument(
+        "--dataset", type=str, default="cifar10", help="dataset of the initial classes"
+    )
+    parser.add_argument(
+        "--prompt_template", type=str, default="This is a photo of a {}"
+    )
+    parser.add_argument(
+        "--class_names",
+        nargs="+",
+        type=str,
+        default=None,
+        help="(space separated) initial classes; defaults to all classes in the dataset",
+    )
+
+    args = parser.parse_args()
+    args.device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    return args
+
+
+def parse_classes_request(request):
+    """Returns the class names and the prompt template of a /classes request, or raises a ValueError."""
+    if not isinstance(request, dict) or "class_names" not in request:
+        raise ValueError('the request must be an object with "class_names"')
+    class_names = request["class_names"]
+    template = request.get("template", "This is a photo of a {}")
+    if not isinstance(class_names, list) or not class_names:
+        raise ValueError("class_names must be a non-empty list")
+    if not all(isinstance(c, str) for c in class_names):
+        raise ValueError("class_names must be strings")
+    if not isinstance(template, str):
+        raise ValueError("template must be a string")
+    try:
+        template.format("class")
+    except (IndexError, KeyError, ValueError) as e:
+        raise ValueError(f"template must have a single {{}} placeholder: {e!r}") from e
+    return class_names, template
+
+
+def parse_classify_request(request):
+    """Returns the encoded images and the top_k of a /classify request, or raises a ValueError."""
+    if not isinstance(request, dict) or "images" not in request:
+        raise ValueError('the request must be an object with "images"')
+    images = request["images"]
+    top_k = request.get("top_k", 5)
+    if not isinstance(images, list) or not all(isinstance(image, str) for image in images):
+        raise ValueError("images must be a list of base64 encoded strings")
+    # bool is a subclass of int
+    if not isinstance(top_k, int) or isinstance(top_k, bool) or top_k < 1:
+        raise ValueError("top_k must be a positive integer")
+    return images, top_k
+
+
+class ServerStats:
+    """Request, image and batch counters, and the latencies of the most recent requests."""
+
+    def __init__(self, window):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests = 0
+        self.images = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=window)
+        self.finish_times = deque(maxlen=window)
+
+    def record_batch(self):
+        with self.lock:
+            self.batches += 1
+
+    def record_request(self, num_images, latency, error=False):
+        with self.lock:
+            self.requests += 1
+            self.images += num_images
+            self.errors += int(error)
+            self.latencies.append(latency)
+            self.finish_times.append(time.time())
+
+    def summary(self):
+        with self.lock:
+            latencies = np.asarray(self.latencies) * 1000
+            uptime = time.time() - self.start_time
+            recent_seconds = (
+                self.finish_times[-1] - self.finish_times[0]
+                if len(self.finish_times) > 1
+                else 0.0
+            )
+            return {
+                "uptime_seconds": uptime,
+                "requests": self.requests,
+                "images": self.images,
+                "batches": self.batches,
+                "errors": self.errors,
+                "mean_batch_size": self.images / self.batches if self.batches else 0.0,
+                "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+                "requests_per_second": len(self.finish_times) / recent_seconds
+                if recent_seconds > 0
+                else None,
+                "images_per_second": self.images / uptime,
+            }
+
+
+class DynamicBatcher:
+    """
+    Runs the zero-shot model on batches of the images of all pending requests, in a single thread.
+
+    A batch starts with the oldest pending image and is run when it holds max_batch_size images or
+    the oldest image has waited max_latency seconds.
+    """
+
+    def __init__(self, clipzs, arch, device, stats, max_batch_size=64, max_latency=0.01):
+        self.clipzs = clipzs
+        self.arch = arch
+        self.device = device
+        self.stats = stats
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        # held while the classes are used or replaced, so a batch never mixes two class sets
+        self.classes_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image, top_k):
+        """Queues a preprocessed image and returns a future of its top-k predictions."""
+        if top_k < 1:
+            raise ValueError(f"top_k must be positive, not {top_k}")
+        future = Future()
+        self.queue.put((time.perf_counter(), image, top_k, future))
+        return future
+
+    def set_classes(self, class_names, template):
+        """Replaces the classes of the model, the text features are read from the text feature cache if possible."""
+        prompts = [template.format(c.replace("_", " ")) for c in class_names]
+        text_features = get_text_features(
+            self.clipzs.clip_model, self.arch, prompts, self.device
+        )
+        with self.classes_lock:
+            self.clipzs.text_features = text_features
+            self.clipzs.class_names = list(class_names)
+
+    def _next_batch(self):
+        items = [self.queue.get()]
+        deadline = items[0][0] + self.max_latency
+        while len(items) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                items.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._next_batch()
+            try:
+                images = torch.stack([image for _, image, _, _ in items]).to(self.device)
+                with self.classes_lock:
+                    probs = self.clipzs.model_inference(images).float().softmax(dim=-1)
+                    class_names = self.clipzs.class_names
+                max_k = min(max(top_k for _, _, top_k, _ in items), len(class_names))
+                top_probs, top_idx = probs.topk(max_k, dim=-1)
+                top_probs, top_idx = top_probs.cpu().tolist(), top_idx.cpu().tolist()
+            except Exception as e:  # reported to all requests of the batch
+                for _, _, _, future in items:
+                    future.set_exception(e)
+                continue
+            self.stats.record_batch()
+            for (_, _, top_k, future), p, idx in zip(items, top_probs, top_idx):
+                future.set_result(
+                    [
+                        {"class": class_names[i], "probability": prob}
+                        for i, prob in zip(idx[:top_k], p[:top_k])
+                    ]
+                )
+
+
+def make_handler(batcher, preprocess, stats):
+    """Returns the request handler class of the server."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status, obj):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length))
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send_json(200, stats.summary())
+            else:
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            start = time.perf_counter()
+            try:
+                request = self._read_json()
+            except (ValueError, json.JSONDecodeError) as e:
+                self._send_json(400, {"error": f"invalid json: {e}"})
+                return
+
+            if self.path == "/classes":
+                try:
+                    class_names, template = parse_classes_request(request)
+                except ValueError as e:
+                    self._send_json(400, {"error": f"invalid request: {e}"})
+                    return
+                try:
+                    batcher.set_classes(class_names, template)
+                except Exception as e:
+                    self._send_json(500, {"error": str(e)})
+                    return
+                self._send_json(200, {"classes": len(class_names)})
+            elif self.path == "/classify":
+                try:
+                    images, top_k = parse_classify_request(request)
+                    images = [
+                        preprocess(Image.open(io.BytesIO(base64.b64decode(image))))
+                        for image in images
+                    ]
+                except Exception as e:
+                    stats.record_request(0, time.perf_counter() - start, error=True)
+                    self._send_json(400, {"error": f"invalid request: {e}"})
+                    return
+                futures = [batcher.submit(image, top_k) for image in images]
+                try:
+                    predictions = [future.result() for future in futures]
+                except Exception as e:
+                    stats.record_request(len(images), time.perf_counter() - start, error=True)
+                    self._send_json(500, {"error": str(e)})
+                    return
+                stats.record_request(len(images), time.perf_counter() - start)
+                self._send_json(200, {"predictions": predictions})
+            else:
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+
+        def log_message(self, format, *args):
+            # one line per request would flood the log under load
+            pass
+
+    return Handler
+
+
+def main():
+    args = parse_option()
+    print(args)
+
+    preprocess = get_preprocess(args.arch, args.input_resolution)
+    dataset = None
+    if args.class_names is None:
+        dataset = load_dataset(args.dataset, args.root, "test", preprocess)
+    clipzs = ZeroshotCLIP(args=args, dataset=dataset, template=args.prompt_template)
+    clipzs.eval()
+
+    stats = ServerStats(args.stats_window)
+    batcher = DynamicBatcher(
+        clipzs,
+        args.arch,
+        args.device,
+        stats,
+        max_batch_size=args.max_batch_size,
+        max_latency=args.max_latency_ms / 1000,
+    )
+
+    server = ThreadingHTTPServer(
+        (args.host, args.port), make_handler(batcher, preprocess, stats)
+    )
+    print(f"Serving zero-shot CLIP on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(stats.summary(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
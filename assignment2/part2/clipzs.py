@@ -22,14 +22,21 @@ import matplotlib.pyplot as plt
 
 import torch
 import numpy as np
-from clip import clip
 
 from torchvision.datasets import CIFAR10, CIFAR100
-from torch.utils.data import DataLoader
+from torchvision.transforms import Compose
 from tqdm import tqdm
 import torch.nn as nn
 from utils import AverageMeter, set_seed
+from dataset import AddGaussianNoise, construct_dataloader
+from text_features import get_text_features, text_feature_cache_name
+from clip_registry import get_clip_model, get_preprocess
+from precision import autocast, get_precision, prepare_clip_model
+from token_reduction import TokenReduction
+from vit import encode_image
+from large_vocab import PQIndex, chunked_topk
 import re
+import time
 import json
 
 
@@ -45,6 +52,56 @@ def parse_option():
     parser.add_argument(
         "--num_workers", type=int, default=16, help="num of workers to use"
     )
+    parser.add_argument(
+        "--autotune_loader",
+        action="store_true",
+        help="autotune the dataloader settings on first use and reuse them afterwards, instead of num_workers",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="auto",
+        choices=["auto", "fp32", "fp16", "bf16"],
+        help="precision of the frozen CLIP weights and the forward passes; auto uses fp16 on the GPU and fp32 otherwise",
+    )
+
+    # Adam: speed up the vision transformer by removing tokens between its blocks
+    parser.add_argument(
+        "--token_schedule",
+        type=str,
+        default=None,
+        help="number of tokens to merge/prune before every transformer layer, either one number for all layers "
+        "or a comma separated number per layer; disabled by default",
+    )
+    parser.add_argument(
+        "--token_reduction",
+        type=str,
+        default="merge",
+        choices=["merge", "prune"],
+        help="merge similar tokens (ToMe) or prune the tokens with the lowest class token attention",
+    )
+    # Adam: run the vision transformer at a lower resolution than it was trained on
+    parser.add_argument(
+        "--input_resolution",
+        type=int,
+        default=None,
+        help="resize the images to this resolution and interpolate the positional embedding of the vision "
+        "transformer to match, instead of using the resolution of the pretrained model",
+    )
+    parser.add_argument(
+        "--resolution_sweep",
+        type=int,
+        nargs="+",
+        default=None,
+        help="evaluate the accuracy and throughput at these input resolutions",
+    )
+    parser.add_argument(
+        "--token_reduction_sweep",
+        type=int,
+        nargs="+",
+        default=None,
+        help="evaluate the accuracy and throughput with these numbers of tokens removed before every layer",
+    )
 
     # model
     parser.add_argument("--model", type=str, default="clip")
@@ -87,6 +144,78 @@ def parse_option():
         help="(space separated) labels to use for the prompts; defaults to all classes in the dataset",
         # e.g. --class_names red blue green
     )
+    # Adam: zero-shot classification over large vocabularies of class names
+    parser.add_argument(
+        "--label_file",
+        type=str,
+        default=None,
+        help="text file with one class name per line, used instead of --class_names",
+    )
+    parser.add_argument(
+        "--streaming_topk",
+        default=False,
+        action="store_true",
+        help="compute the top-1 and top-5 accuracy over chunks of the class names without the full logit "
+        "matrix; the dataset classes are looked up by name in the class names",
+    )
+    parser.add_argument(
+        "--topk_chunk_size",
+        type=int,
+        default=8192,
+        help="number of class names per chunk of the streaming top-k",
+    )
+    parser.add_argument(
+        "--pq_subspaces",
+        type=int,
+        default=0,
+        help="search a product quantization index of the text features with this many subspaces "
+        "(e.g. 16 or 32) in the streaming top-k; disabled by default",
+    )
+    parser.add_argument(
+        "--pq_rerank",
+        type=int,
+        default=10,
+        help="number of candidates per requested class that the exact features re-rank in the PQ search",
+    )
+
+    # Adam: evaluate many prompts at once on cached image features
+    parser.add_argument(
+        "--template_sweep",
+        default=False,
+        action="store_true",
+        help="evaluate all templates and class name sets on cached image features and print an accuracy table",
+    )
+    parser.add_argument(
+        "--prompt_templates",
+        nargs="+",
+        type=str,
+        default=None,
+        help="templates to evaluate in the template sweep; defaults to --prompt_template",
+    )
+    parser.add_argument(
+        "--prompt_template_file",
+        type=str,
+        default=None,
+        help="text file with one additional template per line for the template sweep",
+    )
+    parser.add_argument(
+        "--class_name_sets",
+        type=str,
+        default=None,
+        help="json file mapping names to alternative lists of class names (one per class of the dataset) for the template sweep",
+    )
+    parser.add_argument(
+        "--template_ensemble",
+        default=False,
+        action="store_true",
+        help="also evaluate the ensemble of all templates (averaged text features) in the template sweep",
+    )
+    parser.add_argument(
+        "--image_feature_cache_dir",
+        type=str,
+        default="save/image_features",
+        help="directory of the cached image features of the template sweep",
+    )
 
     # visualization
     parser.add_argument(
@@ -114,6 +243,10 @@ def parse_option():
     args = parser.parse_args()
     args.device = "cuda" if torch.cuda.is_available() else "cpu"
 
+    if args.label_file is not None:
+        with open(args.label_file) as f:
+            args.class_names = [line.strip() for line in f if line.strip()]
+
     return args
 
 
@@ -135,17 +268,22 @@ class ZeroshotCLIP(nn.Module):
         clip_model = self.load_clip_to_cpu(args)
         clip_model.to(args.device)
 
-        # if device is CPU, then make model as float() (This is a CLIP hack)
-        if args.device == "cpu" or args.device == "mps":
-            clip_model = clip_model.float()
+        # Adam: store the frozen weights in the precision of the policy, instead of always upcasting on the CPU
+        self.precision = get_precision(args)
+        clip_model = prepare_clip_model(clip_model, self.precision)
 
         prompts = [template.format(c.replace("_", " ")) for c in classnames]
         print()
         print()
         print("List of prompts:")
-        pprint(prompts)
+        if len(prompts) > 100:
+            pprint(prompts[:10] + ["..."] + prompts[-10:])
+        else:
+            pprint(prompts)
+        self.prompts = prompts
 
         print("Precomputing text features")
+        self.arch = args.arch
         text_features = self.precompute_text_features(clip_model, prompts, args.device)
 
         self.class_names = classnames
@@ -153,6 +291,11 @@ class ZeroshotCLIP(nn.Module):
         self.clip_model = clip_model
         self.logit_scale = self.clip_model.logit_scale.exp().detach()
 
+        # Adam: optional token merging/pruning in the vision transformer (see token_reduction.py)
+        self.token_reduction = None
+        if getattr(args, "token_schedule", None):
+            self.token_reduction = TokenReduction.from_args(args, self.num_layers())
+
     def precompute_text_features(self, clip_model, prompts, device):
         """
         Precomputes text features for the given prompts.
@@ -187,13 +330,8 @@ class ZeroshotCLIP(nn.Module):
         # - Read the CLIP API documentation for more details:
         #   https://github.com/openai/CLIP#api
 
-        with torch.no_grad():
-            tokenized_prompts = torch.cat([clip.tokenize(p) for p in prompts]).to(
-                device
-            )
-            text_features = clip_model.encode_text(tokenized_prompts)
-            text_features /= text_features.norm(dim=-1, keepdim=True)
-            return text_features
+        # Adam: the text features only depend on the prompts and the weights, so they are cached on disk
+        return get_text_features(clip_model, self.arch, prompts, device)
         #######################
         # END OF YOUR CODE    #
         #######################
@@ -230,9 +368,9 @@ class ZeroshotCLIP(nn.Module):
         # - Read the CLIP API documentation for more details:
         #   https://github.com/openai/CLIP#api
 
-        with torch.no_grad():
-            image_features = self.clip_model.encode_image(images)
-            image_features /= image_features.norm(dim=-1, keepdim=True)
+        with torch.no_grad(), autocast(self.device, self.precision):
+            # Adam: the same as clip_model.encode_image, but also at other input resolutions and with token reduction
+            image_features = self.image_features(images)
             # do NOT use self.clip_model.logit_scale
             similarity = self.logit_scale * image_features @ self.text_features.T
             return similarity
@@ -243,18 +381,48 @@ class ZeroshotCLIP(nn.Module):
 
     def load_clip_to_cpu(self, args):
         """Loads CLIP model to CPU."""
-        backbone_name = args.arch
-        url = clip._MODELS[backbone_name]
-        model_path = clip._download(url, args.root)
-        try:
-            # loading JIT archive
-            model = torch.jit.load(model_path, map_location="cpu").eval()
-            state_dict = None
-        except RuntimeError:
-            state_dict = torch.load(model_path, map_location="cpu")
-
-        model = clip.build_model(state_dict or model.state_dict())
-        return model
+        # Adam: the model is loaded only once per process and shared (see clip_registry.py)
+        return get_clip_model(args.arch, args.root)
+
+    def image_features(self, images):
+        """Returns the normalized image features of the images (see model_inference)."""
+        with torch.no_grad(), autocast(self.device, self.precision):
+            image_features = encode_image(
+                self.clip_model.visual, images, self.token_reduction
+            )
+            return image_features / image_features.norm(dim=-1, keepdim=True)
+
+    def build_pq_index(self, num_subspaces, cache_dir="save/text_features"):
+        """Builds (or loads) a product quantization index of the text features for model_topk."""
+        cache_name = text_feature_cache_name(
+            cache_dir, self.arch, self.prompts, self.clip_model.dtype
+        )
+        self.pq_index = PQIndex.build(
+            self.text_features, num_subspaces, f"{cache_name[:-4]}_pq{num_subspaces}.npz"
+        )
+
+    def model_topk(self, images, k, chunk_size=8192, rerank=10):
+        """
+        Returns the top-k logits of the images and the indices of their classes, both of shape
+        (batch size, k), without computing the logits of all classes at once.
+        """
+        image_features = self.image_features(images)
+        with torch.no_grad():
+            if getattr(self, "pq_index", None) is not None:
+                scores, indices = self.pq_index.search(
+                    image_features, k, rerank=rerank, chunk_size=chunk_size
+                )
+            else:
+                scores, indices = chunked_topk(
+                    image_features, self.text_features, k, chunk_size=chunk_size
+                )
+        return self.logit_scale * scores, indices
+
+    def num_layers(self):
+        """Returns the number of transformer layers of the vision transformer."""
+        if not hasattr(self.clip_model.visual, "transformer"):
+            raise ValueError("Token reduction is only supported for the ViT backbones")
+        return len(self.clip_model.visual.transformer.resblocks)
 
     def num_params(self):
         """Prints number of parameters in the model."""
@@ -337,6 +505,372 @@ def visualize_predictions(images, logits, classnames, fig_file):
     plt.savefig(fig_file)
 
 
+def image_feature_cache_name(
+    cache_dir,
+    arch,
+    dataset,
+    split,
+    test_noise,
+    seed,
+    max_batches=0,
+    input_resolution=None,
+    token_reduction=None,
+    precision="fp32",
+):
+    """
+    Returns the file name prefix of the cached image features of a (arch, dataset, split, noise) image set,
+    encoded at the input resolution, with the token reduction and in the precision of the model.
+    """
+    name = f"{arch.replace('/', '-')}_{dataset}_{split}"
+    if input_resolution is not None:
+        name += f"_res{input_resolution}"
+    if token_reduction is not None:
+        name += f"_{token_reduction.method}{'-'.join(str(r) for r in token_reduction.schedule)}"
+    if precision != "fp32":
+        name += f"_{precision}"
+    if test_noise:
+        # the noise is random, so the features depend on the seed
+        name += f"_noise_seed{seed}"
+    if max_batches > 0:
+        name += f"_max{max_batches}"
+    return os.path.join(cache_dir, name)
+
+
+def extract_image_features(clipzs, loader, cache_name, device, max_batches=0, print_tqdm_interval=1.0):
+    """
+    Encodes the images of the loader once and stores the normalized image features as a
+    memory-mapped float16 file, together with the labels. If the features are already cached,
+    they are loaded instead.
+
+    The images are encoded by ZeroshotCLIP.image_features, so the features are those of the
+    configured model (input resolution, token reduction and precision).
+
+    Returns:
+        features (np.ndarray): memory-mapped image features of shape (num_images, 512)
+        labels (np.ndarray): labels of shape (num_images,)
+    """
+    features_file, labels_file = f"{cache_name}_features.npy", f"{cache_name}_labels.npy"
+    if os.path.isfile(features_file) and os.path.isfile(labels_file):
+        return np.load(features_file, mmap_mode="r"), np.load(labels_file)
+
+    num_images = len(loader.dataset)
+    if max_batches > 0:
+        num_images = min(num_images, (max_batches + 1) * loader.batch_size)
+    embedding_dimension = clipzs.clip_model.visual.output_dim
+
+    os.makedirs(os.path.dirname(cache_name) or ".", exist_ok=True)
+    tmp_features_file = f"{cache_name}_features.{os.getpid()}.tmp.npy"
+    features = np.lib.format.open_memmap(
+        tmp_features_file, mode="w+", dtype=np.float16, shape=(num_images, embedding_dimension)
+    )
+    labels = np.empty(num_images, dtype=np.int64)
+    offset = 0
+    with torch.no_grad():
+        for batch_idx, (images, targets) in enumerate(
+            tqdm(
+                loader,
+                desc="Encoding images",
+                leave=False,
+                mininterval=print_tqdm_interval,
+                maxinterval=print_tqdm_interval,
+            )
+        ):
+            if offset >= num_images:
+                break
+            image_features = clipzs.image_features(images.to(device))
+            n = min(len(targets), num_images - offset)
+            features[offset : offset + n] = image_features[:n].cpu().float().numpy()
+            labels[offset : offset + n] = targets[:n].numpy()
+            offset += n
+    features.flush()
+    del features
+
+    tmp_labels_file = f"{cache_name}_labels.{os.getpid()}.tmp.npy"
+    np.save(tmp_labels_file, labels)
+    os.replace(tmp_labels_file, labels_file)
+    os.replace(tmp_features_file, features_file)
+    return np.load(features_file, mmap_mode="r"), labels
+
+
+def template_sweep(image_features, labels, text_features, device, chunk_size=8192):
+    """
+    Computes the accuracy of several text feature sets on the same image features.
+
+    All text features are stacked, so every chunk of images is scored against all of them
+    with a single matmul.
+
+    Args:
+        image_features (np.ndarray): normalized image features of shape (num_images, 512)
+        labels (np.ndarray): labels of shape (num_images,)
+        text_features (list): list of normalized text features of shape (num_classes, 512)
+        device (str): device to use for computation
+
+    Returns:
+        accuracies (list): accuracy of each text feature set
+    """
+    sizes = [len(t) for t in text_features]
+    stacked = torch.cat([t.float() for t in text_features]).to(device)
+    correct = torch.zeros(len(text_features), dtype=torch.long, device=device)
+    with torch.no_grad():
+        for start in range(0, len(labels), chunk_size):
+            features = torch.from_numpy(
+                np.asarray(image_features[start : start + chunk_size], dtype=np.float32)
+            ).to(device)
+            targets = torch.from_numpy(labels[start : start + chunk_size]).to(device)
+            similarity = features @ stacked.T
+            # the logit scale does not change the predictions, so it is left out
+            for i, block in enumerate(similarity.split(sizes, dim=1)):
+                correct[i] += (block.argmax(dim=1) == targets).sum()
+    return (correct.double() / len(labels)).tolist()
+
+
+def run_template_sweep(args, clipzs, loader, classnames):
+    """Evaluates all templates and class name sets of the arguments on the cached image features."""
+    templates = list(args.prompt_templates or [args.prompt_template])
+    if args.prompt_template_file is not None:
+        with open(args.prompt_template_file) as f:
+            templates += [line.rstrip("\n") for line in f if line.strip()]
+
+    class_name_sets = {"default": list(classnames)}
+    if args.class_name_sets is not None:
+        with open(args.class_name_sets) as f:
+            class_name_sets.update(json.load(f))
+    for name, names in class_name_sets.items():
+        if len(names) != len(classnames):
+            raise ValueError(
+                f"Class name set {name} has {len(names)} names, but {args.dataset} has {len(classnames)} classes"
+            )
+
+    image_features, labels = extract_image_features(
+        clipzs,
+        loader,
+        image_feature_cache_name(
+            args.image_feature_cache_dir,
+            args.arch,
+            args.dataset,
+            args.split,
+            args.test_noise,
+            args.seed,
+            args.max_batches,
+            args.input_resolution,
+            clipzs.token_reduction,
+            clipzs.precision,
+        ),
+        args.device,
+        max_batches=args.max_batches,
+        print_tqdm_interval=args.print_tqdm_interval,
+    )
+
+    rows, text_features = [], []
+    for set_name, names in class_name_sets.items():
+        set_features = []
+        for template in templates:
+            prompts = [template.format(c.replace("_", " ")) for c in names]
+            features = get_text_features(clipzs.clip_model, args.arch, prompts, args.device)
+            set_features.append(features.float())
+            rows.append((template, set_name))
+            text_features.append(features)
+        if args.template_ensemble and len(templates) > 1:
+            ensemble = torch.stack(set_features).mean(dim=0)
+            ensemble /= ensemble.norm(dim=-1, keepdim=True)
+            rows.append((f"ensemble of {len(templates)} templates", set_name))
+            text_features.append(ensemble)
+
+    accuracies = template_sweep(image_features, labels, text_features, args.device)
+
+    width = max(len(template) for template, _ in rows)
+    print(f"{'template':{width}}  {'class names':12}  accuracy")
+    for (template, set_name), accuracy in zip(rows, accuracies):
+        print(f"{template:{width}}  {set_name:12}  {accuracy * 100:.2f}")
+
+    # not in results_zs, which holds one result per file for evaluate.ipynb
+    results_dir = "results_zs_sweep"
+    os.makedirs(results_dir, exist_ok=True)
+    with open(
+        f"{results_dir}/template_sweep_{args.dataset}_{args.split}_{args.test_noise}.json", "w"
+    ) as f:
+        json.dump(
+            [
+                {
+                    "dataset": args.dataset,
+                    "set": args.split,
+                    "test_noise": args.test_noise,
+                    "template": template,
+                    "class_names": set_name,
+                    "accuracy": accuracy * 100,
+                }
+                for (template, set_name), accuracy in zip(rows, accuracies)
+            ],
+            f,
+        )
+
+
+def evaluate_throughput(args, clipzs, loader, desc=None):
+    """
+    Returns the top-1 accuracy (in %) and the throughput (images per second) of the model on the loader.
+    Only the model is timed, not the data loading.
+    """
+    correct, num_images, inference_time = 0, 0, 0.0
+    for batch_idx, (data, label) in enumerate(
+        tqdm(
+            loader,
+            desc=desc,
+            leave=False,
+            mininterval=args.print_tqdm_interval,
+            maxinterval=args.print_tqdm_interval,
+        )
+    ):
+        if 0 < args.max_batches <= batch_idx:
+            break
+        data, label = data.to(args.device), label.to(args.device)
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        logits = clipzs.model_inference(data)
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        inference_time += time.perf_counter() - start
+        correct += (logits.argmax(dim=-1) == label).sum().item()
+        num_images += label.shape[0]
+    return correct / num_images * 100, num_images / inference_time
+
+
+def run_resolution_sweep(args, clipzs):
+    """Evaluates the accuracy and the throughput of the model at every input resolution in the sweep."""
+    rows = []
+    for input_resolution in args.resolution_sweep:
+        preprocess = get_preprocess(args.arch, input_resolution)
+        if args.test_noise:
+            preprocess = Compose(preprocess.transforms + [AddGaussianNoise()])
+        dataset = load_dataset(args.dataset, args.root, args.split, preprocess)
+        loader = construct_dataloader(args, dataset)
+        accuracy, images_per_second = evaluate_throughput(
+            args, clipzs, loader, desc=f"{input_resolution}px"
+        )
+        rows.append(
+            {
+                "arch": args.arch,
+                "dataset": args.dataset,
+                "set": args.split,
+                "input_resolution": input_resolution,
+                "accuracy": accuracy,
+                "images_per_second": images_per_second,
+            }
+        )
+
+    print(f"{'resolution':>10}  {'accuracy':>8}  {'images/s':>9}")
+    for row in rows:
+        print(
+            f"{row['input_resolution']:>10}  {row['accuracy']:8.2f}  {row['images_per_second']:9.1f}"
+        )
+
+    # not in results_zs, which holds one result per file for evaluate.ipynb
+    results_dir = "results_zs_resolution"
+    os.makedirs(results_dir, exist_ok=True)
+    with open(
+        f"{results_dir}/{args.arch.replace('/', '-')}_{args.dataset}_{args.split}_{args.test_noise}.json",
+        "w",
+    ) as f:
+        json.dump(rows, f)
+
+
+def run_token_reduction_sweep(args, clipzs, loader):
+    """Evaluates the accuracy and the throughput of the model with every number of tokens in the sweep."""
+    num_layers = clipzs.num_layers()
+    rows = []
+    for r in args.token_reduction_sweep:
+        clipzs.token_reduction = (
+            TokenReduction([r] * num_layers, args.token_reduction) if r > 0 else None
+        )
+        accuracy, images_per_second = evaluate_throughput(
+            args, clipzs, loader, desc=f"r={r}"
+        )
+        rows.append(
+            {
+                "dataset": args.dataset,
+                "set": args.split,
+                "method": args.token_reduction,
+                "r": r,
+                "accuracy": accuracy,
+                "images_per_second": images_per_second,
+            }
+        )
+
+    print(f"{'r':>4}  {'accuracy':>8}  {'images/s':>9}")
+    for row in rows:
+        print(f"{row['r']:>4}  {row['accuracy']:8.2f}  {row['images_per_second']:9.1f}")
+
+    # not in results_zs, which holds one result per file for evaluate.ipynb
+    results_dir = "results_zs_token_reduction"
+    os.makedirs(results_dir, exist_ok=True)
+    with open(
+        f"{results_dir}/{args.dataset}_{args.split}_{args.token_reduction}.json", "w"
+    ) as f:
+        json.dump(rows, f)
+
+
+def run_streaming_topk(args, clipzs, loader, dataset_classes):
+    """Computes the top-1 and top-5 accuracy over the class names of the model with a streaming top-k."""
+    class_index = {name: i for i, name in enumerate(clipzs.class_names)}
+    missing = [name for name in dataset_classes if name not in class_index]
+    if missing:
+        print(
+            f"Warning: {len(missing)} classes of {args.dataset} are not in the class names and count as errors: {missing}"
+        )
+    # -1 never matches a predicted index
+    targets = torch.tensor(
+        [class_index.get(name, -1) for name in dataset_classes], device=args.device
+    )
+
+    if args.pq_subspaces > 0:
+        print(f"Building product quantization index with {args.pq_subspaces} subspaces")
+        clipzs.build_pq_index(args.pq_subspaces)
+
+    top1 = AverageMeter("Acc@1", ":6.2f")
+    top5 = AverageMeter("Acc@5", ":6.2f")
+    for batch_idx, (data, label) in enumerate(
+        tqdm(
+            loader,
+            leave=False,
+            mininterval=args.print_tqdm_interval,
+            maxinterval=args.print_tqdm_interval,
+        )
+    ):
+        if 0 < args.max_batches <= batch_idx:
+            break
+        data, target = data.to(args.device), targets[label.to(args.device)]
+        _, indices = clipzs.model_topk(
+            data, 5, chunk_size=args.topk_chunk_size, rerank=args.pq_rerank
+        )
+        hits = indices == target[:, None]
+        top1.update(hits[:, 0].float().mean().item(), label.shape[0])
+        top5.update(hits.any(dim=1).float().mean().item(), label.shape[0])
+
+    print(
+        f"Zero-shot CLIP on {args.dataset}/{args.split} over {len(clipzs.class_names)} classes: "
+        f"top-1 accuracy {top1.avg * 100:.2f}, top-5 accuracy {top5.avg * 100:.2f}"
+    )
+
+    # not in results_zs, which holds one result per file for evaluate.ipynb
+    results_dir = "results_zs_large_vocab"
+    os.makedirs(results_dir, exist_ok=True)
+    with open(
+        f"{results_dir}/{args.dataset}_{args.split}_{len(clipzs.class_names)}_pq{args.pq_subspaces}.json",
+        "w",
+    ) as f:
+        json.dump(
+            {
+                "dataset": args.dataset,
+                "set": args.split,
+                "num_classes": len(clipzs.class_names),
+                "pq_subspaces": args.pq_subspaces,
+                "top1_accuracy": top1.avg * 100,
+                "top5_accuracy": top5.avg * 100,
+            },
+            f,
+        )
+
+
 def main():
     # Part 0.0: Read options from command line & fix seed
     args = parse_option()
@@ -347,17 +881,32 @@ def main():
     args.num_workers = min(args.num_workers, os.cpu_count())
 
     # Part 1. Load dataset and create dataloader
-    _, preprocess = clip.load(args.arch)
+    preprocess = get_preprocess(args.arch, args.input_resolution)
+    if args.test_noise:
+        preprocess = Compose(preprocess.transforms + [AddGaussianNoise()])
     dataset = load_dataset(args.dataset, args.root, args.split, preprocess)
 
-    loader = DataLoader(
-        dataset=dataset, batch_size=args.batch_size, num_workers=args.num_workers
-    )
+    loader = construct_dataloader(args, dataset)
 
     # Part 2. Initialize the inference class: ZeroshotCLIP
     print("Using prompt template:", args.prompt_template)
     clipzs = ZeroshotCLIP(args=args, dataset=dataset, template=args.prompt_template)
 
+    # Adam: the image features do not depend on the prompts, encode them once and evaluate all prompts on them
+    if args.template_sweep:
+        run_template_sweep(args, clipzs, loader, dataset.classes)
+        return
+
+    # Adam: accuracy vs. throughput curve of the input resolution
+    if args.resolution_sweep:
+        run_resolution_sweep(args, clipzs)
+        return
+
+    # Adam: accuracy vs. throughput curve of the token reduction
+    if args.token_reduction_sweep:
+        run_token_reduction_sweep(args, clipzs, loader)
+        return
+
     # define the metric tracker for top1 accuracy
     top1 = AverageMeter("Acc@1", ":6.2f")
 
@@ -380,6 +929,11 @@ def main():
         fig_file = f"images/{args.dataset}-{args.split}_{c_names}_{prompt}.png"
         visualize_predictions(images, logits, clipzs.class_names, fig_file)
 
+    # Adam: top-k over (large vocabularies of) class names, the dataset classes are looked up by name
+    if args.streaming_topk:
+        run_streaming_topk(args, clipzs, loader, dataset.classes)
+        return
+
     if args.class_names is not None:
         # No point in running evaluation if we don't use the dataset's class names
         return
@@ -18,11 +18,8 @@
 import os
 import argparse
 import torch
-from learner import Learner
-from clip import clip
-from dataset import load_dataset, construct_dataloader
-from pprint import pprint
-from utils import DummyArgs
+from multi_eval import MultiDatasetEvaluator, parse_eval_sets
+from main import set_model_folder
 import json
 
 
@@ -42,6 +39,18 @@ def parse_option():
     parser.add_argument(
         "--num_workers", type=int, default=16, help="num of workers to use"
     )
+    parser.add_argument(
+        "--autotune_loader",
+        action="store_true",
+        help="autotune the dataloader settings on first use and reuse them afterwards, instead of num_workers",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="auto",
+        choices=["auto", "fp32", "fp16", "bf16"],
+        help="precision of the frozen CLIP weights and the forward passes; auto uses fp16 on the GPU and fp32 otherwise",
+    )
     parser.add_argument(
         "--epochs", type=int, default=1000, help="number of training epochs"
     )
@@ -124,6 +133,14 @@ def parse_option():
     parser.add_argument("--root", type=str, default="./data", help="dataset")
     parser.add_argument("--dataset", type=str, default="cifar100", help="dataset")
     parser.add_argument("--image_size", type=int, default=224, help="image size")
+    # Adam: run the vision transformer at a lower resolution than it was trained on
+    parser.add_argument(
+        "--input_resolution",
+        type=int,
+        default=None,
+        help="resize the images to this resolution and interpolate the positional embedding of the vision "
+        "transformer to match, instead of using the resolution of the pretrained model",
+    )
     parser.add_argument(
         "--test_noise",
         default=False,
@@ -161,6 +178,15 @@ def parse_option():
     parser.add_argument(
         "--evaluate", default=False, action="store_true", help="evaluate model test set"
     )
+    # Adam: data sets to evaluate on together, in a merged label space
+    parser.add_argument(
+        "--eval_sets",
+        type=str,
+        nargs="+",
+        default=["cifar10:test:0", "cifar100:test:10"],
+        help="dataset:split[:label_offset] entries to evaluate on; without an offset, the classes of a "
+        "dataset follow the classes of the earlier datasets",
+    )
     parser.add_argument("--gpu", type=int, default=None, help="gpu to use")
     parser.add_argument(
         "--use_wandb", default=False, action="store_true", help="whether to use wandb"
@@ -168,33 +194,11 @@ def parse_option():
 
     args = parser.parse_args()
 
-    args.filename = "{}_{}_{}_{}_{}_{}_{}_{}_{}_{}_lr_{}_decay_{}_bsz_{}_warmup_{}_trial_{}".format(
-        args.prompt_type,  # Adam: add prompt type to avoid visual and deep prompting models overwriting each other
-        args.method,
-        args.prompt_size,
-        args.injection_layer,
-        args.prompt_num,
-        args.prompt_init_method,
-        args.dataset,
-        args.model,
-        args.arch,
-        args.optim,
-        args.learning_rate,
-        args.weight_decay,
-        args.batch_size,
-        args.warmup,
-        args.trial,
-    )
-
     args.device = "cuda" if torch.cuda.is_available() else "cpu"
-    args.model_folder = os.path.join(args.model_dir, args.filename)
-    if not os.path.isdir(args.model_folder):
-        os.makedirs(args.model_folder)
-
-    # Adam: option to easily resume from the best saved model for the given parameters to do additional evaluation
-    # without manually specifying the default file name in the job file
-    if args.resume_best:
-        args.resume = os.path.join(args.model_folder, "model_best.pth.tar")
+    if args.input_resolution is not None:
+        args.image_size = args.input_resolution
+    # Adam: same model folder as the training run in main.py, to find its checkpoints
+    set_model_folder(args)
 
     return args
 
@@ -208,136 +212,30 @@ def main():
         args.resume
     ), "Set argument --resume to set the path to the best saved model checkpoint"
 
-    learn = Learner(args)
-
-    if args.evaluate:
-        # Load clip image transformation
-        _, preprocess = clip.load(args.arch)
-
-        # 2. Load the test datset from CIFAR10
-        dummy_args = DummyArgs()
-        dummy_args.test_noise = args.test_noise
-        dummy_args.root = args.root
-        dummy_args.dataset = "cifar10"
-        _, _, cifar10_test = load_dataset(dummy_args, preprocess)
-
-        # 3. Load the test dataset from CIFAR100
-        dummy_args = DummyArgs()
-        dummy_args.test_noise = args.test_noise
-        dummy_args.root = args.root
-        dummy_args.dataset = "cifar100"
-        _, _, cifar100_test = load_dataset(dummy_args, preprocess)
-
-        # 4. Combine the classnames from CIFAR10 and CIFAR100.
-        #######################
-        # PUT YOUR CODE HERE  #
-        #######################
-        # TODO: Define `classnames` as a list of 10 + 100 class labels from CIFAR10 and CIFAR100
-
-        # Already done in the next line, nothing to do
-        #######################
-        # END OF YOUR CODE    #
-        #######################
-
-        classnames = cifar10_test.classes + cifar100_test.classes
-
-        # 5. Load the clip model
-        print(f"Loading CLIP (backbone: {args.arch})")
-        clip_model = learn.clip.load_clip_to_cpu(args)
-        clip_model.to(args.device)
-        # Hack to make model as float() (This is a CLIP hack)
-        if args.device == "cpu":
-            clip_model = clip_model.float()
-
-        # 6. Construct text prompts
-        template = args.text_prompt_template
-        prompts = [template.format(c.replace("_", " ")) for c in classnames]
-        print("List of prompts:")
-        pprint(prompts)
-
-        # 7. Compute the text features
-        #######################
-        # PUT YOUR CODE HERE  #
-        #######################
-        # TODO: Compute the text features (for each of the prompts defined above) using CLIP
-        # Note: This is similar to the code you wrote in `clipzs.py`
-
-        with torch.no_grad():
-            tokenized_prompts = torch.cat([clip.tokenize(p) for p in prompts]).to(
-                args.device
-            )
-            text_features = clip_model.encode_text(tokenized_prompts)
-            text_features /= text_features.norm(dim=-1, keepdim=True)
-        #######################
-        # END OF YOUR CODE    #
-        #######################
-
-        # 8. Set the text_features of pre-trained model to the calculated text features
-        learn.clip.text_features = text_features
-
-        # 9. Offset the target labels of CIFAR100 by 10
-        #######################
-        # PUT YOUR CODE HERE  #
-        #######################
-        # TODO: Add an offset of 10 to the targets of CIFAR100
-        # That is, if a class in CIFAR100 corresponded to '4', it should now correspond to '14'
-        # Set the result of this to the attribute cifar100_test.targets to override them
-
-        cifar100_test.targets = [target + 10 for target in cifar100_test.targets]
-        #######################
-        # END OF YOUR CODE    #
-        #######################
-
-        # 10. Define the dataloader for CIFAR10
-        cifar10_loader = construct_dataloader(args, cifar10_test)
-
-        # 11. Define the dataloader for CIFAR100
-        cifar100_loader = construct_dataloader(args, cifar100_test)
-
-        # 12. Update the test loader of learner to CIFAR10
-        learn.test_loader = cifar10_loader
-
-        # 13. Evaluate the performance of the model
-        acc_cifar10 = learn.evaluate("test")
-
-        # 14. Update the test loader of learner to CIFAR100
-        learn.test_loader = cifar100_loader
-
-        # 15. Evaluate the performance of the model
-        acc_cifar100 = learn.evaluate("test")
-
-        # 16. Compute the weighted average (or total performance)
-        #######################
-        # PUT YOUR CODE HERE  #
-        #######################
-        # TODO: Compute the weighted average of the above two accuracies
-
-        # Hint:
-        # - accurary_all = acc_cifar10 * (% of cifar10 samples) \
-        #                  + acc_cifar100 * (% of cifar100 samples)
-
-        accuracy_all = (
-            acc_cifar10 * len(cifar10_test) + acc_cifar100 * len(cifar100_test)
-        ) / (len(cifar10_test) + len(cifar100_test))
-        #######################
-        # END OF YOUR CODE    #
-        #######################
-
-        print(f"TOP1 Accuracy on cifra10 + cifar100 is: {accuracy_all}")
-
-        # Adam: save results into a single directory to make it easier to plot in the end
-        results_dir = "results_cross_data"
-        os.makedirs(results_dir, exist_ok=True)
-
-        result = vars(args)
-        result["top1_test_acc_cross_data"] = accuracy_all
-        fn = f"cross_data_{args.dataset}_{args.prompt_type}_{args.method}_{args.prompt_num}_{args.injection_layer}_{args.prompt_size}_{args.prompt_init_method}_{args.test_noise}.json"
-        with open(f"{results_dir}/{fn}", "w") as f:
-            json.dump(result, f)
-
-    else:
+    if not args.evaluate:
         raise ValueError("Enable flag --evaluate!")
 
+    # Adam: the prompted model is evaluated on all data sets in one pass, in the merged label space of
+    # their classes (CIFAR100 is offset by the 10 classes of CIFAR10), without building a training Learner
+    evaluator = MultiDatasetEvaluator(args, parse_eval_sets(args.eval_sets))
+    accuracies = evaluator.run()
+    accuracy_all = accuracies["pooled"]
+
+    print(f"TOP1 Accuracy on {' + '.join(args.eval_sets)} is: {accuracy_all}")
+
+    # Adam: save results into a single directory to make it easier to plot in the end
+    results_dir = "results_cross_data"
+    os.makedirs(results_dir, exist_ok=True)
+
+    result = vars(args)
+    result["top1_test_acc_cross_data"] = accuracy_all
+    result["top1_test_acc_per_data"] = {
+        name: accuracy for name, accuracy in accuracies.items() if name != "pooled"
+    }
+    fn = f"cross_data_{args.dataset}_{args.prompt_type}_{args.method}_{args.prompt_num}_{args.injection_layer}_{args.prompt_size}_{args.prompt_init_method}_{args.test_noise}.json"
+    with open(f"{results_dir}/{fn}", "w") as f:
+        json.dump(result, f)
+
 
 if __name__ == "__main__":
     main()
@@ -15,11 +15,18 @@
 ################################################################################
 
 """Defines helper functions for loading data and constructing dataloaders."""
+import os
+import sys
+
 from torchvision.datasets import CIFAR10, CIFAR100
 from torchvision.transforms import Compose
-from torch.utils.data import DataLoader, random_split
+from torch.utils.data import random_split
 import torch
 
+# Adam: the DataLoader autotuner is shared by all assignments, it lives in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from loader_autotune import tuned_dataloader  # noqa: E402
+
 DATASET = {"cifar10": CIFAR10, "cifar100": CIFAR100}
 
 
@@ -69,7 +76,13 @@ def load_dataset(args, preprocess):
     ratio = 0.2
     valid_size = int(len(train_dataset) * ratio)
     train_size = int(len(train_dataset) - valid_size)
-    train_dataset, val_dataset = random_split(train_dataset, [train_size, valid_size])
+    # Adam: all processes of a distributed run must use the same split
+    generator = None
+    if getattr(args, "distributed", False):
+        generator = torch.Generator().manual_seed(args.seed)
+    train_dataset, val_dataset = random_split(
+        train_dataset, [train_size, valid_size], generator=generator
+    )
 
     test_dataset = DATASET[args.dataset](
         args.root, transform=test_transform, download=True, train=False
@@ -78,9 +91,12 @@ def load_dataset(args, preprocess):
     return train_dataset, val_dataset, test_dataset
 
 
-def construct_dataloader(args, dataset):
-    return DataLoader(
-        dataset=dataset,
+def construct_dataloader(args, dataset, sampler=None):
+    # Adam: with --autotune_loader, the worker, prefetching and pinning settings are tuned instead
+    return tuned_dataloader(
+        dataset,
         batch_size=args.batch_size,
+        enabled=getattr(args, "autotune_loader", False),
         num_workers=args.num_workers,
+        sampler=sampler,
     )
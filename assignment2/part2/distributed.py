@@ -0,0 +1,97 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""
+Data-parallel training of the prompts on several CPU processes with torch.distributed (gloo).
+
+Start with torchrun, e.g. `torchrun --nproc_per_node=4 main.py --distributed ...`. Every process
+holds the frozen CLIP model and trains on its share of the training set. Only the gradients of the
+prompts are all-reduced, as the rest of the model is frozen. Without --distributed, all helpers
+behave as for a single process.
+"""
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(args):
+    """
+    Joins the process group of torchrun if --distributed is set, and sets args.rank and
+    args.world_size. The intra-op threads are divided between the processes of a node.
+    """
+    args.rank, args.world_size = 0, 1
+    if not getattr(args, "distributed", False):
+        return
+    if "RANK" not in os.environ:
+        raise RuntimeError("--distributed requires starting the processes with torchrun")
+    dist.init_process_group(backend="gloo")
+    args.rank, args.world_size = dist.get_rank(), dist.get_world_size()
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", args.world_size))
+    torch.set_num_threads(max(1, os.cpu_count() // local_world_size))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process():
+    """Whether this process writes the checkpoints, logs and results."""
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_parameters(parameters):
+    """Copies the parameters of rank 0 to all processes, so all of them start from the same prompts."""
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for param in parameters:
+            dist.broadcast(param.data, src=0)
+
+
+def all_reduce_gradients(parameters):
+    """Averages the gradients of the parameters over all processes, in a single all-reduce."""
+    if not is_distributed():
+        return
+    grads = [param.grad for param in parameters if param.grad is not None]
+    if not grads:
+        return
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset : offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+
+def all_reduce_sum(values):
+    """Returns the sums of a list of numbers over all processes."""
+    if not is_distributed():
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
@@ -1,33 +1,21 @@
 """Defines the VisualPrompting model (based on CLIP)"""
 from pprint import pprint
-import matplotlib.pyplot as plt
 
 import torch
 import torch.nn as nn
 
-from clip import clip
-from clip.simple_tokenizer import SimpleTokenizer as _Tokenizer
+from text_features import get_text_features
+from clip_registry import get_clip_model
+from precision import get_precision, prepare_clip_model
+from token_reduction import TokenReduction
+from vit import embed_patches
 
 import warnings
 
 
 def load_clip_to_cpu(cfg):
     """Loads CLIP model to CPU."""
-    backbone_name = cfg.MODEL.BACKBONE.NAME
-    url = clip._MODELS[backbone_name]
-    model_path = clip._download(url)
-
-    try:
-        # loading JIT archive
-        model = torch.jit.load(model_path, map_location="cpu").eval()
-        state_dict = None
-
-    except RuntimeError:
-        state_dict = torch.load(model_path, map_location="cpu")
-
-    model = clip.build_model(state_dict or model.state_dict())
-
-    return model
+    return get_clip_model(cfg.MODEL.BACKBONE.NAME)
 
 
 class DeepPromptCLIP(nn.Module):
@@ -41,17 +29,14 @@ class DeepPromptCLIP(nn.Module):
         clip_model = self.load_clip_to_cpu(args)
         clip_model.to(args.device)
 
-        # hack to make model as float() (This is a CLIP hack)
-        if args.device == "cpu" or args.device == "mps":
-            clip_model = clip_model.float()
+        # Adam: store the frozen weights in the precision of the policy, instead of always upcasting on the CPU
+        self.precision = get_precision(args)
+        clip_model = prepare_clip_model(clip_model, self.precision)
 
         prompts = [template.format(c.replace("_", " ")) for c in classnames]
         print("List of prompts:")
         pprint(prompts)
 
-        prompts = torch.cat([clip.tokenize(p) for p in prompts])
-        prompts = prompts.to(args.device)
-
         #######################
         # PUT YOUR CODE HERE  #
         #######################
@@ -63,9 +48,8 @@ class DeepPromptCLIP(nn.Module):
         # - Given a list of prompts, compute the text features for each prompt.
         # - Return a tensor of shape (num_prompts, 512).
 
-        with torch.no_grad():
-            text_features = clip_model.encode_text(prompts)
-            text_features /= text_features.norm(dim=-1, keepdim=True)
+        # Adam: the text features only depend on the prompts and the weights, so they are cached on disk
+        text_features = get_text_features(clip_model, args.arch, prompts, args.device)
 
         #######################
         # END OF YOUR CODE    #
@@ -93,13 +77,10 @@ class DeepPromptCLIP(nn.Module):
         # Note: I had to explicitly create the tensor on the given device.
         # If I simply moved it to the device using .to(device) then it didn't get registered
         # as something that needs gradients to be calculated
+        # Adam: the deep prompt is a float32 master copy, it is cast to the precision of the model when injected
         embedding_dimension = 768
         self.deep_prompt = nn.Parameter(
-            torch.randn(
-                args.prompt_num, 1, embedding_dimension, device=args.device
-            ).type(
-                torch.float16
-            )  # hard-coded fp16
+            torch.randn(args.prompt_num, 1, embedding_dimension, device=args.device)
         )
 
         num_transformer_layers = len(self.clip_model.visual.transformer.resblocks)
@@ -108,6 +89,8 @@ class DeepPromptCLIP(nn.Module):
                 f"This CLIP implementation has {num_transformer_layers} transformer layers, "
                 f"specifying an injection layer of {self.injection_layer} is invalid."
             )
+        # Adam: optional token merging/pruning between the blocks at inference time (see token_reduction.py)
+        self.token_reduction = TokenReduction.from_args(args, num_transformer_layers)
 
         #######################
         # END OF YOUR CODE    #
@@ -146,27 +129,49 @@ class DeepPromptCLIP(nn.Module):
 
     def custom_encode_image(self, x):
         """Encode image using CLIP model and add deep prompts."""
+        # Adam: the token reduction only speeds up inference, training always sees all tokens
+        if self.token_reduction is not None and not self.training:
+            x, size = self._encode_prefix(x, self.token_reduction)
+            return self._encode_from_prefix(x, size, self.token_reduction)
+        return self.encode_from_prefix(self.encode_prefix(x))
+
+    def encode_prefix(self, x):
+        """
+        Runs the frozen part of the image encoder below the injection layer.
+
+        The result does not depend on the deep prompt, so it can be cached (see prefix_cache.py).
+
+        Returns:
+            torch.Tensor: residual stream at the injection layer of shape (batch_size, grid ** 2 + 1, width)
+        """
+        return self._encode_prefix(x)[0]
+
+    def _encode_prefix(self, x, token_reduction=None):
+        """encode_prefix with an optional token reduction, also returns the token sizes of the reduction."""
         # cf. https://github.com/openai/CLIP/blob/main/clip/model.py#L223
+        # Adam: the positional embedding is interpolated for other input resolutions (see vit.py)
+        image_encoder = self.clip_model.visual
+        x = embed_patches(image_encoder, x)
 
+        x = x.permute(1, 0, 2)  # NLD -> LND
+        resblocks = image_encoder.transformer.resblocks[: self.injection_layer]
+        size = None
+        if token_reduction is None:
+            for transformer_layer in resblocks:
+                x = transformer_layer(x)
+        else:
+            x, size = token_reduction.run(resblocks, x)
+        return x.permute(1, 0, 2), size  # LND -> NLD
+
+    def encode_from_prefix(self, x):
+        """Injects the deep prompt into the residual stream of encode_prefix and runs the remaining layers."""
+        return self._encode_from_prefix(x)
+
+    def _encode_from_prefix(self, x, size=None, token_reduction=None):
+        """encode_from_prefix with an optional token reduction, continuing from the token sizes of _encode_prefix."""
         x = x.type(self.clip_model.dtype)
         image_encoder = self.clip_model.visual
 
-        x = image_encoder.conv1(x)  # shape = [*, width, grid, grid]
-        x = x.reshape(x.shape[0], x.shape[1], -1)  # shape = [*, width, grid ** 2]
-        x = x.permute(0, 2, 1)  # shape = [*, grid ** 2, width]
-        x = torch.cat(
-            [
-                image_encoder.class_embedding.to(x.dtype)
-                + torch.zeros(
-                    x.shape[0], 1, x.shape[-1], dtype=x.dtype, device=x.device
-                ),
-                x,
-            ],
-            dim=1,
-        )  # shape = [*, grid ** 2 + 1, width]
-        x = x + image_encoder.positional_embedding.to(x.dtype)
-        x = image_encoder.ln_pre(x)
-
         x = x.permute(1, 0, 2)  # NLD -> LND
 
         #######################
@@ -183,12 +188,28 @@ class DeepPromptCLIP(nn.Module):
 
         # Hint: Beware of the batch size (the deep prompt is the same for all images in the batch).
         batch_size = x.shape[1]
-        for i, transformer_layer in enumerate(image_encoder.transformer.resblocks):
-            if i == self.injection_layer:
-                # x = x + self.deep_prompt  # This is similar to what we did with the visual prompts, directly modifying
-                # the input. This is NOT what we want to do with the deep prompts
-                x = torch.cat([x, self.deep_prompt.repeat(1, batch_size, 1)], dim=0)
-            x = transformer_layer(x)
+        # Adam: the layers below the injection layer are run in encode_prefix
+        # x = x + self.deep_prompt  # This is similar to what we did with the visual prompts, directly modifying
+        # the input. This is NOT what we want to do with the deep prompts
+        x = torch.cat(
+            [x, self.deep_prompt.to(x.dtype).repeat(1, batch_size, 1)], dim=0
+        )
+        resblocks = image_encoder.transformer.resblocks[self.injection_layer :]
+        if token_reduction is None:
+            for transformer_layer in resblocks:
+                x = transformer_layer(x)
+        else:
+            # the deep prompts are appended at the end and never merged or pruned
+            prompt_num = self.deep_prompt.shape[0]
+            if size is not None:
+                size = torch.cat([size, size.new_ones(batch_size, prompt_num, 1)], dim=1)
+            x, _ = token_reduction.run(
+                resblocks,
+                x,
+                size,
+                first_layer=self.injection_layer,
+                protect_last=prompt_num,
+            )
         #######################
         # END OF YOUR CODE    #
         #######################
@@ -202,20 +223,16 @@ class DeepPromptCLIP(nn.Module):
 
         return x
 
+    def forward_from_prefix(self, prefix):
+        """Forward pass of the model on the cached output of encode_prefix."""
+        image_features = self.encode_from_prefix(prefix)
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        return self.logit_scale * image_features @ self.text_features.T
+
     def load_clip_to_cpu(self, args):
         """Loads CLIP model to CPU."""
-        backbone_name = args.arch
-        url = clip._MODELS[backbone_name]
-        model_path = clip._download(url, args.root)
-        try:
-            # loading JIT archive
-            model = torch.jit.load(model_path, map_location="cpu").eval()
-            state_dict = None
-        except RuntimeError:
-            state_dict = torch.load(model_path, map_location="cpu")
-
-        model = clip.build_model(state_dict or model.state_dict())
-        return model
+        # Adam: the model is loaded only once per process and shared (see clip_registry.py)
+        return get_clip_model(args.arch, args.root)
 
     @torch.no_grad()
     def visualize_prompt(self, method):
@@ -0,0 +1,195 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""
+Top-k zero-shot classification over large vocabularies of class names.
+
+The similarities to the text features are computed chunk by chunk and merged into a running top-k,
+so only a (batch size, chunk size) block of logits exists at any time. Optionally the text features
+are compressed with product quantization (PQ): the approximate scores of all classes are computed
+from small lookup tables, and only the best candidates are re-ranked with the exact features.
+"""
+import os
+
+import numpy as np
+import torch
+
+
+def merge_topk(scores, indices, new_scores, new_indices, k):
+    """Merges two top-k lists of shape (batch_size, *) into one of shape (batch_size, k)."""
+    if scores is None:
+        scores, indices = new_scores, new_indices
+    else:
+        scores = torch.cat([scores, new_scores], dim=1)
+        indices = torch.cat([indices, new_indices], dim=1)
+    k = min(k, scores.shape[1])
+    scores, position = scores.topk(k, dim=1)
+    return scores, indices.gather(dim=1, index=position)
+
+
+def chunked_topk(image_features, text_features, k, chunk_size=8192):
+    """
+    Returns the top-k similarities between the image features and the text features, and the
+    indices of the classes, both of shape (batch_size, k).
+
+    The text features may live on another device (or be memory-mapped), only one chunk at a time
+    is moved to the device of the image features.
+    """
+    scores, indices = None, None
+    for start in range(0, text_features.shape[0], chunk_size):
+        chunk = text_features[start : start + chunk_size]
+        chunk = torch.as_tensor(chunk).to(
+            device=image_features.device, dtype=image_features.dtype
+        )
+        chunk_scores = image_features @ chunk.T
+        chunk_scores, chunk_indices = chunk_scores.topk(
+            min(k, chunk_scores.shape[1]), dim=1
+        )
+        scores, indices = merge_topk(
+            scores, indices, chunk_scores, chunk_indices + start, k
+        )
+    return scores, indices
+
+
+def kmeans(x, num_clusters, iterations=20, seed=0, chunk_size=65536):
+    """Returns the centroids of the k-means clustering of x, of shape (num_clusters, dim)."""
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    num_clusters = min(num_clusters, x.shape[0])
+    centroids = x[torch.randperm(x.shape[0], generator=generator)[:num_clusters].to(x.device)]
+    for _ in range(iterations):
+        assignment = torch.cat(
+            [
+                torch.cdist(x[start : start + chunk_size], centroids).argmin(dim=1)
+                for start in range(0, x.shape[0], chunk_size)
+            ]
+        )
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, x)
+        counts = torch.bincount(assignment, minlength=num_clusters)
+        # empty clusters keep their previous centroid
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+    return centroids
+
+
+class ProductQuantizer:
+    """
+    Product quantization of vectors for inner product search.
+
+    The vectors are split into num_subspaces parts, and every part is replaced by the index of the
+    closest of num_centroids centroids (one byte for 256 centroids).
+    """
+
+    def __init__(self, centroids):
+        # shape (num_subspaces, num_centroids, subspace dimension)
+        self.centroids = centroids
+
+    @classmethod
+    def fit(cls, x, num_subspaces, num_centroids=256, iterations=20, seed=0):
+        """Learns the centroids of every subspace with k-means."""
+        dim = x.shape[1]
+        if dim % num_subspaces != 0:
+            raise ValueError(
+                f"The feature dimension {dim} is not divisible by {num_subspaces} subspaces"
+            )
+        x = x.float()
+        subspaces = x.view(x.shape[0], num_subspaces, dim // num_subspaces)
+        centroids = torch.stack(
+            [
+                kmeans(subspaces[:, m], num_centroids, iterations, seed + m)
+                for m in range(num_subspaces)
+            ]
+        )
+        return cls(centroids)
+
+    @property
+    def num_subspaces(self):
+        return self.centroids.shape[0]
+
+    def encode(self, x, chunk_size=65536):
+        """Returns the codes of the vectors, of shape (num_vectors, num_subspaces)."""
+        codes = []
+        for start in range(0, x.shape[0], chunk_size):
+            chunk = x[start : start + chunk_size].float().to(self.centroids.device)
+            chunk = chunk.view(chunk.shape[0], self.num_subspaces, -1).transpose(0, 1)
+            codes.append(torch.cdist(chunk, self.centroids).argmin(dim=2).T)
+        return torch.cat(codes).to(torch.uint8 if self.centroids.shape[1] <= 256 else torch.int16)
+
+    def lookup_tables(self, queries):
+        """Inner products of the query parts with all centroids, of shape (batch_size, num_subspaces, num_centroids)."""
+        queries = queries.float().view(queries.shape[0], self.num_subspaces, -1)
+        return torch.einsum("bmd,mcd->bmc", queries, self.centroids)
+
+    def topk(self, queries, codes, k, chunk_size=8192):
+        """Returns the top-k approximate inner products of the queries with the encoded vectors and their indices."""
+        tables = self.lookup_tables(queries)
+        subspace = torch.arange(self.num_subspaces, device=tables.device)
+        scores, indices = None, None
+        for start in range(0, codes.shape[0], chunk_size):
+            chunk = codes[start : start + chunk_size].to(tables.device).long()
+            # sum over the subspaces of the table entries of the codes, shape (batch_size, chunk size)
+            chunk_scores = tables[:, subspace[None, :], chunk].sum(dim=-1)
+            chunk_scores, chunk_indices = chunk_scores.topk(
+                min(k, chunk_scores.shape[1]), dim=1
+            )
+            scores, indices = merge_topk(
+                scores, indices, chunk_scores, chunk_indices + start, k
+            )
+        return scores, indices
+
+
+class PQIndex:
+    """
+    Product quantization index of the text features.
+    The candidates of the approximate search are re-ranked with the exact text features.
+    """
+
+    def __init__(self, quantizer, codes, text_features):
+        self.quantizer = quantizer
+        self.codes = codes
+        self.text_features = text_features
+
+    @classmethod
+    def build(cls, text_features, num_subspaces, cache_name=None, num_centroids=256):
+        """Builds the index, or loads it from cache_name (.npz) if it exists."""
+        if cache_name is not None and os.path.isfile(cache_name):
+            stored = np.load(cache_name)
+            quantizer = ProductQuantizer(
+                torch.from_numpy(stored["centroids"]).to(text_features.device)
+            )
+            return cls(quantizer, torch.from_numpy(stored["codes"]), text_features)
+
+        quantizer = ProductQuantizer.fit(text_features, num_subspaces, num_centroids)
+        codes = quantizer.encode(text_features).cpu()
+        if cache_name is not None:
+            os.makedirs(os.path.dirname(cache_name) or ".", exist_ok=True)
+            tmp_name = f"{cache_name}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_name, centroids=quantizer.centroids.cpu().numpy(), codes=codes.numpy())
+            os.replace(tmp_name, cache_name)
+        return cls(quantizer, codes, text_features)
+
+    def search(self, image_features, k, rerank=10, chunk_size=8192):
+        """
+        Returns the top-k similarities between the image features and the text features, and the
+        indices of the classes. The best k * rerank classes of the approximate search are re-ranked.
+        """
+        _, candidates = self.quantizer.topk(image_features, self.codes, k * rerank, chunk_size)
+        candidate_features = self.text_features[candidates.to(self.text_features.device)]
+        candidate_features = candidate_features.to(
+            device=image_features.device, dtype=image_features.dtype
+        )
+        scores = torch.einsum("bd,bcd->bc", image_features, candidate_features)
+        scores, position = scores.topk(min(k, scores.shape[1]), dim=1)
+        return scores, candidates.gather(dim=1, index=position)
@@ -21,63 +21,188 @@ import torch
 import torch.nn as nn
 import numpy as np
 import random
-from clip import clip
-from torch.cuda.amp import GradScaler
 import time
-
+from torch.utils.data import Subset
+from torch.utils.data.distributed import DistributedSampler
+from torch.utils.tensorboard import SummaryWriter
 
 from tqdm import tqdm
-from vpt_model import VisualPromptCLIP
+from vpt_model import VisualPromptCLIP, MultiVisualPromptCLIP
 from dpt_model import DeepPromptCLIP
 from utils import (
     cosine_lr,
     AverageMeter,
     ProgressMeter,
     accuracy,
-    save_checkpoint,
     set_seed,
+    trainable_state_dict,
+    AsyncCheckpointWriter,
+    PhaseTimer,
 )
 from dataset import load_dataset, construct_dataloader
+from clip_registry import get_preprocess
+from prefix_cache import get_prefix_dataset
+from precision import autocast, get_grad_scaler, get_precision
+from distributed import (
+    all_reduce_gradients,
+    all_reduce_sum,
+    barrier,
+    broadcast_parameters,
+    is_main_process,
+)
+
+
+def load_trainable_state_dict(model, state_dict):
+    """Merges the prompts of a trainable-only checkpoint into the model with the pretrained CLIP weights."""
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    missing_prompts = [k for k in missing if not k.startswith("clip_model.")]
+    if unexpected or missing_prompts:
+        raise RuntimeError(
+            f"Checkpoint does not match the model. Unexpected keys: {unexpected}, "
+            f"missing prompt keys: {missing_prompts}"
+        )
+
+
+def load_prompt_checkpoint(model, prompt_type, checkpoint):
+    """Loads the prompts of a checkpoint (see Learner.checkpoint_state) into a prompted CLIP model."""
+    if prompt_type == "visual_prompt":
+        model.prompt_learner.load_state_dict(checkpoint["state_dict"])
+    elif checkpoint.get("trainable_only", False):
+        load_trainable_state_dict(model, checkpoint["state_dict"])
+    else:
+        # checkpoints of older runs contain the whole CLIP model
+        model.load_state_dict(checkpoint["state_dict"])
 
 
 class Learner:
-    """Trainer for prompt-learning using CLIP."""
+    """
+    Trainer for prompt-learning using CLIP.
 
-    def __init__(self, args):
+    The trainer keeps the optimizer, learning rate schedule, best accuracy, early stopping and
+    checkpoints per prompter, so MultiPromptLearner trains several prompters with the same loop.
+    A Learner has a single prompter, with the arguments of the run.
+    """
+
+    TRAIN_PHASES = ["data", "h2d", "forward", "loss", "backward", "optimizer", "logging"]
+
+    def __init__(self, args, prompter_args=None):
         self.args = args
         self.device = args.device
-        self.best_acc1 = 0
-        self.best_epoch = -1  # Adam: also save best epoch for evaluation later
+        # the arguments of every prompter, with its model folder for the checkpoints
+        self.prompter_args = [args] if prompter_args is None else list(prompter_args)
+        self.best_acc1s = [0] * len(self.prompter_args)
+        # Adam: also save best epoch for evaluation later
+        self.best_epochs = [-1] * len(self.prompter_args)
 
         # Load clip image transformation
-        _, preprocess = clip.load(args.arch)
+        # Adam: without loading the model, it is loaded only once when building the custom CLIP
+        preprocess = get_preprocess(args.arch, getattr(args, "input_resolution", None))
 
         self.train_dataset, self.val_dataset, self.test_dataset = load_dataset(
             args, preprocess
         )
-        self.train_loader = construct_dataloader(args, self.train_dataset)
-        self.val_loader = construct_dataloader(args, self.val_dataset)
-        self.test_loader = construct_dataloader(args, self.test_dataset)
+        self.train_sampler = None
+        self.train_loader = self.construct_train_loader(self.train_dataset)
+        self.val_loader = construct_dataloader(args, self.shard(self.val_dataset))
+        self.test_loader = construct_dataloader(args, self.shard(self.test_dataset))
 
-        PROMPT_TEMPLATE = args.text_prompt_template
-
-        print("Building custom CLIP")
-        if args.prompt_type == "visual_prompt":
-            self.clip = VisualPromptCLIP(
-                args, self.test_dataset, template=PROMPT_TEMPLATE
-            )
-        elif args.prompt_type == "deep_prompt":
-            self.clip = DeepPromptCLIP(
-                args, self.test_dataset, template=PROMPT_TEMPLATE
-            )
-        else:
-            raise NotImplementedError(f"{args.prompt_type} is not supported :)!")
+        self.clip = self.build_clip()
 
         # Optionally resume from a checkpoint
-        if self.args.resume:
-            self.resume_checkpoint()
+        for k, p_args in enumerate(self.prompter_args):
+            if p_args.resume:
+                self.resume_checkpoint(k)
 
         print("Turning off gradients in both the image and the text encoder")
+        self.freeze_clip()
+
+        # Double check
+        enabled = set()
+        for name, param in self.clip.named_parameters():
+            if param.requires_grad:
+                enabled.add(name)
+        print(f"Parameters to be updated:")
+        pprint(f"Parameters to be updated: {enabled}")
+
+        # Print number of parameters
+        num_params = sum(p.numel() for p in self.clip.parameters() if p.requires_grad)
+        print("Number of prompt parameters: ", num_params)
+
+        self.clip.to(self.device)
+
+        # Adam: the layers below the injection layer do not depend on the deep prompt,
+        # so their activations are computed once and training starts from them
+        self.prefix_cache = getattr(args, "prefix_cache", False) and not getattr(
+            args, "evaluate", False
+        )
+        if self.prefix_cache:
+            if args.prompt_type != "deep_prompt":
+                raise ValueError("The prefix cache is only supported for deep prompts")
+            # the first process fills the cache, the others read it afterwards
+            if is_main_process():
+                prefix_dataset = get_prefix_dataset(self.clip, self.train_dataset, args)
+            barrier()
+            if not is_main_process():
+                prefix_dataset = get_prefix_dataset(self.clip, self.train_dataset, args)
+            self.train_loader = self.construct_train_loader(prefix_dataset)
+
+        # Adam: the prompts are initialized before the seed is set, so all processes start from those of rank 0
+        self.trainable_params = [p for p in self.clip.parameters() if p.requires_grad]
+        broadcast_parameters(self.trainable_params)
+
+        # Define criterion and optimizer (one per prompter)
+        self.optimizers = [
+            torch.optim.SGD(
+                filter(lambda p: p.requires_grad, parameters),
+                lr=args.learning_rate,
+                momentum=args.momentum,
+                weight_decay=args.weight_decay,
+            )
+            for parameters in self.prompter_parameters()
+        ]
+
+        # Adam: per prompter losses, they are summed for a single backward pass
+        self.criterion = nn.CrossEntropyLoss(reduction="none")
+        # Adam: the scaler is only enabled for fp16, the prompts themselves are float32 master copies.
+        # A single scaler can be shared by several optimizers.
+        self.precision = get_precision(args)
+        self.scaler = get_grad_scaler(self.precision)
+
+        # Define scheduler (in a distributed run, an epoch has the steps of one process)
+        total_steps = len(self.train_loader) * args.epochs
+        self.schedulers = [
+            cosine_lr(optimizer, args.learning_rate, args.warmup, total_steps)
+            for optimizer in self.optimizers
+        ]
+        self.reproduceability(args)
+
+        # Adam: where the time of the training steps goes, summarized per epoch (see train_one_epoch)
+        self.phase_timer = PhaseTimer(self.TRAIN_PHASES, self.device)
+        self.phase_times = []
+        self.summary_writer = None
+
+    @property
+    def best_acc1(self):
+        return self.best_acc1s[0]
+
+    @property
+    def best_epoch(self):
+        return self.best_epochs[0]
+
+    def build_clip(self):
+        """Returns the prompted CLIP model."""
+        PROMPT_TEMPLATE = self.args.text_prompt_template
+
+        print("Building custom CLIP")
+        if self.args.prompt_type == "visual_prompt":
+            return VisualPromptCLIP(self.args, self.test_dataset, template=PROMPT_TEMPLATE)
+        elif self.args.prompt_type == "deep_prompt":
+            return DeepPromptCLIP(self.args, self.test_dataset, template=PROMPT_TEMPLATE)
+        else:
+            raise NotImplementedError(f"{self.args.prompt_type} is not supported :)!")
+
+    def freeze_clip(self):
+        """Turns off the gradients of the CLIP model, apart from the prompts."""
         #######################
         # PUT YOUR CODE HERE  #
         #######################
@@ -102,137 +227,200 @@ class Learner:
         # END OF YOUR CODE    #
         #######################
 
-        # Double check
-        enabled = set()
-        for name, param in self.clip.named_parameters():
-            if param.requires_grad:
-                enabled.add(name)
-        print(f"Parameters to be updated:")
-        pprint(f"Parameters to be updated: {enabled}")
+    def prompter_parameters(self):
+        """Returns the parameters of every prompter, each prompter gets its own optimizer."""
+        return [self.clip.parameters()]
 
-        # Print number of parameters
-        num_params = sum(p.numel() for p in self.clip.parameters() if p.requires_grad)
-        print("Number of prompt parameters: ", num_params)
-
-        self.clip.to(self.device)
-
-        # Define criterion and optimizer
-        self.optimizer = torch.optim.SGD(
-            filter(lambda p: p.requires_grad, self.clip.parameters()),
-            lr=args.learning_rate,
-            momentum=args.momentum,
-            weight_decay=args.weight_decay,
-        )
-
-        self.criterion = nn.CrossEntropyLoss()
-        self.scaler = GradScaler()
+    def prompter_outputs(self, images, active):
+        """
+        Forward pass of the prompters with the given indices.
 
-        # Define scheduler
-        total_steps = len(self.train_loader) * args.epochs
-        self.scheduler = cosine_lr(
-            self.optimizer, args.learning_rate, args.warmup, total_steps
+        Returns:
+            logits of shape (number of prompters, batch size, number of classes)
+        """
+        return self.clip(images).unsqueeze(0)
+
+    def construct_train_loader(self, dataset):
+        """In a distributed run, every process loads its own part of the training set."""
+        if not getattr(self.args, "distributed", False):
+            return construct_dataloader(self.args, dataset)
+        self.train_sampler = DistributedSampler(
+            dataset,
+            num_replicas=self.args.world_size,
+            rank=self.args.rank,
+            shuffle=False,
         )
-        self.reproduceability(args)
+        return construct_dataloader(self.args, dataset, sampler=self.train_sampler)
 
-    def resume_checkpoint(self):
-        """Resumes training from a checkpoint."""
-
-        if os.path.isfile(self.args.resume):
-            print("=> loading checkpoint '{}'".format(self.args.resume))
+    def shard(self, dataset):
+        """
+        Every process evaluates every world_size-th sample of an evaluation set. Unlike the
+        DistributedSampler, no samples are repeated, so the all-reduced accuracy is exact.
+        """
+        if not getattr(self.args, "distributed", False):
+            return dataset
+        return Subset(dataset, range(self.args.rank, len(dataset), self.args.world_size))
+
+    def resume_checkpoint(self, k=0):
+        """Resumes prompter k (the only one of a Learner) from the checkpoint in its --resume."""
+        p_args = self.prompter_args[k]
+        if os.path.isfile(p_args.resume):
+            print("=> loading checkpoint '{}'".format(p_args.resume))
             if self.args.gpu is None:
-                checkpoint = torch.load(self.args.resume)
+                checkpoint = torch.load(p_args.resume)
             else:
                 # Map model to be loaded to specified single gpu.
                 loc = "cuda:{}".format(self.args.gpu)
-                checkpoint = torch.load(self.args.resume, map_location=loc)
-            self.args.start_epoch = checkpoint["epoch"]
+                checkpoint = torch.load(p_args.resume, map_location=loc)
+            p_args.start_epoch = checkpoint["epoch"]
             best_acc1 = checkpoint["best_acc1"]
             if self.args.gpu is not None:
                 # best_acc1 may be from a checkpoint from a different GPU
                 best_acc1 = best_acc1.to(self.args.gpu)
-            if self.args.prompt_type == "visual_prompt":
-                self.clip.prompt_learner.load_state_dict(checkpoint["state_dict"])
-            else:
-                self.clip.load_state_dict(checkpoint["state_dict"])
+            self.load_prompter_checkpoint(k, checkpoint)
             print(
                 "=> loaded checkpoint '{}' (epoch {})".format(
-                    self.args.resume, checkpoint["epoch"]
+                    p_args.resume, checkpoint["epoch"]
                 )
             )
-            self.best_epoch = checkpoint["epoch"]
+            self.best_epochs[k] = checkpoint["epoch"]
         else:
-            print("=> no checkpoint found at '{}'".format(self.args.resume))
+            print("=> no checkpoint found at '{}'".format(p_args.resume))
+
+    def load_prompter_checkpoint(self, k, checkpoint):
+        """Loads the prompts of a checkpoint into prompter k."""
+        load_prompt_checkpoint(self.clip, self.args.prompt_type, checkpoint)
+
+    def load_trainable_state_dict(self, state_dict):
+        """Merges the prompts of a trainable-only checkpoint into the model with the pretrained CLIP weights."""
+        load_trainable_state_dict(self.clip, state_dict)
+
+    def prompter_state_dict(self, k):
+        """Returns the prompts of prompter k to save in a checkpoint."""
+        if self.args.prompt_type == "visual_prompt":
+            return self.clip.prompt_learner.state_dict()
+        return trainable_state_dict(self.clip)
+
+    def checkpoint_state(self, epoch, k=0):
+        """
+        Returns the state of prompter k to save in a checkpoint.
+        Only the prompts are saved, the frozen CLIP weights are restored from the pretrained model.
+        """
+        return {
+            "epoch": epoch,
+            "state_dict": self.prompter_state_dict(k),
+            "trainable_only": self.prompter_args[k].prompt_type != "visual_prompt",
+            "best_acc1": self.best_acc1s[k],
+            "optimizer": self.optimizers[k].state_dict(),
+        }
 
     def resume_best_checkpoint(self):
-        """Resume best saved checkpoint"""
+        """Resume best saved checkpoint (of every prompter)"""
         # Modifying the arguments is not very elegant, but checkpoint loading is tied to the args
         # and I didn't want to modify that
-        self.args.resume = os.path.join(self.args.model_folder, "model_best.pth.tar")
         print(f"Resuming best checkpoint..")
-        self.resume_checkpoint()
+        for k, p_args in enumerate(self.prompter_args):
+            p_args.resume = os.path.join(p_args.model_folder, "model_best.pth.tar")
+            self.resume_checkpoint(k)
 
     def reproduceability(self, args):
         """Fixes the seed for reproducibility."""
         if args.seed is not None:
             set_seed(args.seed)
 
+    def run_name(self):
+        """Returns the name of the TensorBoard run."""
+        return self.args.filename
+
     def run(self):
         """Runs training for the specified number of epochs."""
-        epochs_since_improvement = 0
+        # Adam: write the checkpoints in the background instead of blocking the training
+        self.checkpoint_writer = AsyncCheckpointWriter()
+        if is_main_process():
+            self.summary_writer = SummaryWriter(os.path.join("runs", self.run_name()))
+        try:
+            self._run_epochs()
+        finally:
+            self.checkpoint_writer.close()
+            if self.summary_writer is not None:
+                self.summary_writer.close()
+        # the other processes resume the best checkpoint only once it is written
+        barrier()
+
+    def _run_epochs(self):
+        """Training loop of run, with validation and early stopping of every prompter."""
+        epochs_since_improvement = [0] * len(self.prompter_args)
+        active = list(range(len(self.prompter_args)))
 
         for epoch in range(self.args.epochs):
             # Train for one epoch
-            self.train_one_epoch(epoch)
+            self.train_one_epoch(epoch, active)
 
             # Evaluate on validation set
-            acc1 = self.evaluate()
-
-            # Remember best acc@1 and save checkpoint
-            is_best = acc1 > self.best_acc1
-            self.best_acc1 = max(acc1, self.best_acc1)
-            if is_best:
-                self.best_epoch = epoch + 1
-
-            save_checkpoint(
-                {
-                    "epoch": epoch + 1,
-                    "state_dict": self.clip.prompt_learner.state_dict()
-                    if self.args.prompt_type == "visual_prompt"
-                    else self.clip.state_dict(),
-                    "best_acc1": self.best_acc1,
-                    "optimizer": self.optimizer.state_dict(),
-                },
-                self.args,
-                is_best=is_best,
-            )
+            acc1s = self.evaluate_prompters(active=active)
+
+            for k, acc1 in zip(list(active), acc1s):
+                # Remember best acc@1 and save checkpoint
+                is_best = acc1 > self.best_acc1s[k]
+                self.best_acc1s[k] = max(acc1, self.best_acc1s[k])
+                if is_best:
+                    self.best_epochs[k] = epoch + 1
+
+                if is_main_process():
+                    self.checkpoint_writer.save(
+                        self.checkpoint_state(epoch + 1, k),
+                        self.prompter_args[k],
+                        is_best=is_best,
+                    )
+
+                if is_best:
+                    epochs_since_improvement[k] = 0
+                else:
+                    epochs_since_improvement[k] += 1
+                    print(
+                        f"{self.prompter_name(k)}There's no improvement for {epochs_since_improvement[k]} epochs."
+                    )
+
+                    if epochs_since_improvement[k] >= self.args.patience:
+                        print(f"{self.prompter_name(k)}The training halted by early stopping criterion.")
+                        active.remove(k)
+
+            if not active:
+                break
 
-            if is_best:
-                epochs_since_improvement = 0
-            else:
-                epochs_since_improvement += 1
-                print(f"There's no improvement for {epochs_since_improvement} epochs.")
+    def prompter_name(self, k):
+        """Returns the prefix of the messages about prompter k, empty for a single prompter."""
+        if len(self.prompter_args) == 1:
+            return ""
+        return f"{self.prompter_args[k].filename}: "
 
-                if epochs_since_improvement >= self.args.patience:
-                    print("The training halted by early stopping criterion.")
-                    break
+    def meter_name(self, name, k):
+        """Returns the name of the meter of prompter k."""
+        if len(self.prompter_args) == 1:
+            return name
+        return f"{name}[{k}]"
 
-    def train_one_epoch(self, epoch):
+    def train_one_epoch(self, epoch, active=None):
         """
         Updates (prompt) parameters for one epoch.
 
         Args:
             epoch (int): current epoch number
+            active (list): indices of the prompters to train, all by default
 
         Returns:
-            tuple: (train_loss averaged across batch, train_acc across batch)
+            tuple: (train loss averaged across batch, train acc across batch), with a list of
+                the active prompters each
         """
+        if active is None:
+            active = list(range(len(self.prompter_args)))
         batch_time = AverageMeter("Time", ":6.3f")
         data_time = AverageMeter("Data", ":6.3f")
-        losses = AverageMeter("Loss", ":.4e")
-        top1 = AverageMeter("Acc@1", ":6.2f")
+        losses = [AverageMeter(self.meter_name("Loss", k), ":.4e") for k in active]
+        top1s = [AverageMeter(self.meter_name("Acc@1", k), ":6.2f") for k in active]
         progress = ProgressMeter(
             len(self.train_loader),
-            [batch_time, data_time, losses, top1],
+            [batch_time, data_time] + losses + top1s,
             prefix="Epoch: [{}]".format(epoch),
         )
 
@@ -240,21 +428,28 @@ class Learner:
         self.clip.train()
 
         num_batches_per_epoch = len(self.train_loader)
+        if self.train_sampler is not None:
+            self.train_sampler.set_epoch(epoch)
 
+        self.phase_timer.reset()
+        self.phase_timer.start()
         end = time.time()
         for i, (images, target) in enumerate(
             tqdm(
                 self.train_loader,
                 mininterval=self.args.print_tqdm_interval,
                 maxinterval=self.args.print_tqdm_interval,
+                disable=not is_main_process(),
             )
         ):
             # Measure data loading time
             data_time.update(time.time() - end)
+            self.phase_timer.lap("data")
 
             # Adjust learning rate
             step = num_batches_per_epoch * epoch + i
-            self.scheduler(step)
+            for k in active:
+                self.schedulers[k](step)
 
             #######################
             # PUT YOUR CODE HERE  #
@@ -274,54 +469,101 @@ class Learner:
             if 0 < self.args.max_batches < i:
                 break
 
-            with torch.autograd.set_detect_anomaly(True):
-                self.optimizer.zero_grad()
+            # Adam: anomaly detection slows down the backward pass a lot, so it is only enabled with --debug
+            with torch.autograd.set_detect_anomaly(getattr(self.args, "debug", False)):
                 images, target = images.to(self.device), target.to(self.device)
-                output = self.clip(images)
-                loss = self.criterion(output, target)
-                loss.backward()
-                self.optimizer.step()
+                self.phase_timer.lap("h2d")
+                with autocast(self.device, self.precision):
+                    if self.prefix_cache:
+                        # the "images" are the cached activations at the injection layer
+                        output = self.clip.forward_from_prefix(images).unsqueeze(0)
+                    else:
+                        output = self.prompter_outputs(images, active)
+                    self.phase_timer.lap("forward")
+                    prompter_losses = self.prompter_losses(output, target)
+                self.phase_timer.lap("loss")
+                # the prompters do not share parameters, so the gradient of the sum is the gradient
+                # of each prompter's own loss
+                self.scaler.scale(prompter_losses.sum()).backward()
+                # Adam: only the prompts have gradients, so only those are averaged over the processes
+                all_reduce_gradients(self.trainable_params)
+                self.phase_timer.lap("backward")
+                for k in active:
+                    self.scaler.step(self.optimizers[k])
+                self.scaler.update()
+                for k in active:
+                    self.optimizers[k].zero_grad()
+                self.phase_timer.lap("optimizer")
 
             #######################
             # END OF YOUR CODE    #
             #######################
 
             # Measure accuracy
-            acc1 = accuracy(output, target, topk=(1,))
-            losses.update(loss.item(), images.size(0))
-            top1.update(acc1[0].item(), images.size(0))
+            for loss_meter, top1, prompter_output, loss in zip(
+                losses, top1s, output, prompter_losses.tolist()
+            ):
+                acc1 = accuracy(prompter_output, target, topk=(1,))
+                loss_meter.update(loss, images.size(0))
+                top1.update(acc1[0].item(), images.size(0))
 
             # Measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
 
-            if i % self.args.print_freq == 0:
-                progress.display(i)
-
-            if i % self.args.save_freq == 0:
-                save_checkpoint(
-                    {
-                        "epoch": epoch + 1,
-                        "state_dict": self.clip.prompt_learner.state_dict()
-                        if self.args.prompt_type == "visual_prompt"
-                        else self.clip.state_dict(),
-                        "best_acc1": self.best_acc1,
-                        "optimizer": self.optimizer.state_dict(),
-                    },
-                    self.args,
-                )
+            if is_main_process():
+                if i % self.args.print_freq == 0:
+                    progress.display(i)
 
-        return losses.avg, top1.avg
+                if i % self.args.save_freq == 0:
+                    for k in active:
+                        self.checkpoint_writer.save(
+                            self.checkpoint_state(epoch + 1, k), self.prompter_args[k]
+                        )
+            self.phase_timer.lap("logging")
+
+        if is_main_process():
+            self.log_phase_times(epoch)
+        return [meter.avg for meter in losses], [top1.avg for top1 in top1s]
+
+    def prompter_losses(self, output, target):
+        """Returns the loss of every prompter, for the logits of prompter_outputs."""
+        return (
+            self.criterion(output.flatten(0, 1), target.repeat(output.shape[0]))
+            .view(output.shape[0], -1)
+            .mean(dim=1)
+        )
+
+    def log_phase_times(self, epoch):
+        """Prints the phase times of the epoch and exports them to TensorBoard and to self.phase_times."""
+        summary = self.phase_timer.summary()
+        self.phase_times.append({"epoch": epoch, "phases": summary})
+        print(f"Phase times of epoch {epoch} (p50 / p90 / p99 / total in seconds):")
+        for phase, stats in summary.items():
+            print(
+                f"  {phase:<10} {stats['p50']:.4f} / {stats['p90']:.4f} / {stats['p99']:.4f} / {stats['total']:.1f}"
+            )
+            if self.summary_writer is not None:
+                for name in ["p50", "p90", "p99", "total"]:
+                    self.summary_writer.add_scalar(
+                        f"phase_time/{phase}/{name}", stats[name], epoch
+                    )
 
     def evaluate(self, split="valid"):
         """Evaluates the model on the given `split` set and returns average accuracy."""
+        return self.evaluate_prompters(split)[0]
+
+    def evaluate_prompters(self, split="valid", active=None):
+        """Evaluates the given prompters (all by default) on the `split` set and returns their average accuracies."""
+        if active is None:
+            active = list(range(len(self.prompter_args)))
         batch_time = AverageMeter("Time", ":6.3f")
-        losses = AverageMeter("Loss", ":.4e")
-        top1_prompt = AverageMeter("Prompt Acc@1", ":6.2f")
+        losses = [AverageMeter(self.meter_name("Loss", k), ":.4e") for k in active]
+        top1s = [AverageMeter(self.meter_name("Prompt Acc@1", k), ":6.2f") for k in active]
         loader = self.val_loader if split == "valid" else self.test_loader
         progress = ProgressMeter(
             len(loader),
-            [batch_time, losses, top1_prompt],
+            [batch_time] + losses + top1s,
             prefix="Validate: ",
         )
 
@@ -335,6 +577,7 @@ class Learner:
                     loader,
                     mininterval=self.args.print_tqdm_interval,
                     maxinterval=self.args.print_tqdm_interval,
+                    disable=not is_main_process(),
                 )
             ):
                 #######################
@@ -353,26 +596,77 @@ class Learner:
                 # - Compute the loss (using self.criterion)
 
                 images, target = images.to(self.device), target.to(self.device)
-                output = self.clip.forward(images)
-                loss = self.criterion(output, target)
+                with autocast(self.device, self.precision):
+                    output = self.prompter_outputs(images, active)
+                    prompter_losses = self.prompter_losses(output, target)
                 #######################
                 # END OF YOUR CODE    #
                 #######################
 
                 # Measure accuracy and record loss
-                acc1 = accuracy(output, target, topk=(1,))
-                losses.update(loss.item(), images.size(0))
-                top1_prompt.update(acc1[0].item(), images.size(0))
+                for loss_meter, top1, prompter_output, loss in zip(
+                    losses, top1s, output, prompter_losses.tolist()
+                ):
+                    acc1 = accuracy(prompter_output, target, topk=(1,))
+                    loss_meter.update(loss, images.size(0))
+                    top1.update(acc1[0].item(), images.size(0))
 
                 # Measure elapsed time
                 batch_time.update(time.time() - end)
                 end = time.time()
 
-                if i % self.args.print_freq == 0:
+                if i % self.args.print_freq == 0 and is_main_process():
                     progress.display(i)
 
-            print(
-                " * Prompt Acc@1 {top1_prompt.avg:.3f}".format(top1_prompt=top1_prompt)
-            )
+            # Adam: every process evaluated a part of the split, so the accuracy is summed over all of them
+            for k, top1 in zip(active, top1s):
+                correct, count = all_reduce_sum([top1.sum, top1.count])
+                top1.avg = correct / max(count, 1)
+                print(f" * {self.prompter_name(k)}Prompt Acc@1 {top1.avg:.3f}")
+
+        return [top1.avg for top1 in top1s]
+
 
-        return top1_prompt.avg
+class MultiPromptLearner(Learner):
+    """
+    Trains several visual prompters in one pass over the data (see MultiVisualPromptCLIP).
+
+    Every prompter has its own optimizer, learning rate schedule, early stopping and checkpoints,
+    as if it was trained by a separate Learner with its own arguments.
+    """
+
+    def __init__(self, args, prompter_args):
+        super().__init__(args, prompter_args)
+
+    def build_clip(self):
+        print(f"Building custom CLIP with {len(self.prompter_args)} visual prompters")
+        return MultiVisualPromptCLIP(
+            self.args,
+            self.prompter_args,
+            self.test_dataset,
+            template=self.args.text_prompt_template,
+        )
+
+    def freeze_clip(self):
+        self.clip.requires_grad_(False)
+        self.clip.prompt_learners.requires_grad_(True)
+
+    def prompter_parameters(self):
+        return [prompter.parameters() for prompter in self.clip.prompt_learners]
+
+    def prompter_outputs(self, images, active):
+        return self.clip(images, active)
+
+    def load_prompter_checkpoint(self, k, checkpoint):
+        self.clip.prompt_learners[k].load_state_dict(checkpoint["state_dict"])
+
+    def prompter_state_dict(self, k):
+        """Returns the prompts of prompter k, in the format of the visual prompt checkpoints of Learner."""
+        return self.clip.prompt_learners[k].state_dict()
+
+    def run_name(self):
+        return f"{self.args.filename}_prompters"
+
+    def evaluate(self, split="valid"):
+        """Evaluates all prompters on the `split` set and returns their average accuracies."""
+        return self.evaluate_prompters(split)
@@ -0,0 +1,142 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""
+Load generator for the zero-shot CLIP server (clip_server.py).
+
+Sends CIFAR test images from several concurrent clients, checks the predictions against the labels
+and reports the client side latency percentiles and throughput, followed by the server statistics.
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import threading
+import time
+import urllib.request
+
+import numpy as np
+from torchvision.datasets import CIFAR10, CIFAR100
+
+
+DATASET = {"cifar10": CIFAR10, "cifar100": CIFAR100}
+
+
+def parse_option():
+    parser = argparse.ArgumentParser("Load generator for the zero-shot CLIP server")
+
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8000", help="server address")
+    parser.add_argument("--root", type=str, default="./data", help="dataset")
+    parser.add_argument("--dataset", type=str, default="cifar10", help="dataset of the images")
+    parser.add_argument("--clients", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=1000, help="total number of requests")
+    parser.add_argument("--images_per_request", type=int, default=1, help="images per request")
+    parser.add_argument("--top_k", type=int, default=5, help="number of predictions per image")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+
+    return parser.parse_args()
+
+
+def encode_image(image):
+    """Returns the base64 encoded PNG file of a PIL image."""
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def post_json(url, obj):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(obj).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def main():
+    args = parse_option()
+    rng = random.Random(args.seed)
+
+    dataset = DATASET[args.dataset](args.root, download=True, train=False)
+    # encoded once, so the clients measure the server and not the encoding
+    num_images = min(len(dataset), 1000)
+    samples = [
+        (encode_image(dataset[i][0]), dataset.classes[dataset[i][1]])
+        for i in rng.sample(range(len(dataset)), num_images)
+    ]
+
+    latencies, correct, total, errors = [], [0], [0], [0]
+    lock = threading.Lock()
+    counter = iter(range(args.requests))
+
+    def client(client_rng):
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            batch = client_rng.sample(samples, args.images_per_request)
+            start = time.perf_counter()
+            try:
+                response = post_json(
+                    f"{args.url}/classify",
+                    {"images": [image for image, _ in batch], "top_k": args.top_k},
+                )
+            except OSError as e:
+                with lock:
+                    errors[0] += 1
+                print(f"Request failed: {e}")
+                continue
+            latency = time.perf_counter() - start
+            hits = sum(
+                predictions[0]["class"] == label
+                for predictions, (_, label) in zip(response["predictions"], batch)
+            )
+            with lock:
+                latencies.append(latency)
+                correct[0] += hits
+                total[0] += len(batch)
+
+    threads = [
+        threading.Thread(target=client, args=(random.Random(rng.random()),))
+        for _ in range(args.clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    latencies = np.asarray(latencies) * 1000
+    print(f"Requests: {len(latencies)} ({errors[0]} failed) in {duration:.1f}s")
+    if len(latencies):
+        print(
+            f"Latency p50: {np.percentile(latencies, 50):.1f}ms, p99: {np.percentile(latencies, 99):.1f}ms"
+        )
+        print(
+            f"Throughput: {len(latencies) / duration:.1f} requests/s, {total[0] / duration:.1f} images/s"
+        )
+        print(f"Top-1 accuracy of the responses: {correct[0] / total[0] * 100:.2f}")
+
+    with urllib.request.urlopen(f"{args.url}/stats") as response:
+        print("Server statistics:")
+        print(json.dumps(json.loads(response.read()), indent=2))
+
+
+if __name__ == "__main__":
+    main()
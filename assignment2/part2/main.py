@@ -17,11 +17,13 @@
 """Main driver script to run the code."""
 import os
 import argparse
+import copy
 import torch
-from learner import Learner
+from learner import Learner, MultiPromptLearner
 import json
 import warnings
 from utils import get_device
+from distributed import cleanup, init_distributed, is_main_process
 
 
 def parse_option():
@@ -40,6 +42,18 @@ def parse_option():
     parser.add_argument(
         "--num_workers", type=int, default=16, help="num of workers to use"
     )
+    parser.add_argument(
+        "--autotune_loader",
+        action="store_true",
+        help="autotune the dataloader settings on first use and reuse them afterwards, instead of num_workers",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="auto",
+        choices=["auto", "fp32", "fp16", "bf16"],
+        help="precision of the frozen CLIP weights and the forward passes; auto uses fp16 on the GPU and fp32 otherwise",
+    )
     parser.add_argument(
         "--epochs", type=int, default=1000, help="number of training epochs"
     )
@@ -87,6 +101,28 @@ def parse_option():
         default=0,
         help="id of transformer layer to inject prompt into",
     )
+    # Adam: skip the frozen layers below the injection layer in all but the first epoch
+    parser.add_argument(
+        "--prefix_cache",
+        default=False,
+        action="store_true",
+        help="cache the activations below the injection layer of the deep prompt and train on them",
+    )
+    # Adam: speed up the evaluation of deep prompts by removing tokens between the transformer blocks
+    parser.add_argument(
+        "--token_schedule",
+        type=str,
+        default=None,
+        help="number of tokens to merge/prune before every transformer layer at inference time, either one number "
+        "for all layers or a comma separated number per layer; disabled by default",
+    )
+    parser.add_argument(
+        "--token_reduction",
+        type=str,
+        default="merge",
+        choices=["merge", "prune"],
+        help="merge similar tokens (ToMe) or prune the tokens with the lowest class token attention",
+    )
     parser.add_argument(
         "--method",
         type=str,
@@ -101,6 +137,15 @@ def parse_option():
     parser.add_argument(
         "--prompt_size", type=int, default=30, help="size for visual prompts"
     )
+    # Adam: train several visual prompters in one pass over the data, instead of one run per prompter
+    parser.add_argument(
+        "--prompters",
+        type=str,
+        nargs="+",
+        default=None,
+        help="train several visual prompters together, each given as method:prompt_size:prompt_init_method "
+        "(e.g. padding:30:random fixed_patch:1:random); overrides --method, --prompt_size and --prompt_init_method",
+    )
     # Adam:
     parser.add_argument(
         "--prompt_init_method",
@@ -127,6 +172,14 @@ def parse_option():
     parser.add_argument("--root", type=str, default="./data", help="dataset")
     parser.add_argument("--dataset", type=str, default="cifar100", help="dataset")
     parser.add_argument("--image_size", type=int, default=224, help="image size")
+    # Adam: run the vision transformer at a lower resolution than it was trained on
+    parser.add_argument(
+        "--input_resolution",
+        type=int,
+        default=None,
+        help="resize the images to this resolution and interpolate the positional embedding of the vision "
+        "transformer to match, instead of using the resolution of the pretrained model",
+    )
     parser.add_argument(
         "--test_noise",
         default=False,
@@ -163,12 +216,63 @@ def parse_option():
     parser.add_argument(
         "--use_wandb", default=False, action="store_true", help="whether to use wandb"
     )
+    # Adam: anomaly detection used to be always on, which slows down the backward pass a lot
+    parser.add_argument(
+        "--debug",
+        default=False,
+        action="store_true",
+        help="enable autograd anomaly detection in the training steps",
+    )
+    # Adam: data-parallel training on several CPU processes, started with torchrun (see distributed.py)
+    parser.add_argument(
+        "--distributed",
+        default=False,
+        action="store_true",
+        help="train with one process per torchrun worker (gloo, CPU); --batch_size is per process",
+    )
+    parser.add_argument(
+        "--no_scale_lr",
+        default=False,
+        action="store_true",
+        help="by default, a distributed run multiplies the learning rate by the number of processes and "
+        "divides the warmup steps by it (a step uses a batch of every process); with this flag both are "
+        "used as given",
+    )
 
     args = parser.parse_args()
 
     args.num_workers = min(args.num_workers, os.cpu_count())
+    args.device = get_device()
+    # the visual prompts cover the whole input image
+    if args.input_resolution is not None:
+        args.image_size = args.input_resolution
+
+    if args.prompters is not None and args.prompt_type != "visual_prompt":
+        parser.error("--prompters is only supported for visual prompts")
+    if args.distributed and args.prompters is not None:
+        parser.error("--prompters is not supported with --distributed")
+
+    init_distributed(args)
+    if args.distributed:
+        args.device = "cpu"
+        args.num_workers = min(args.num_workers, max(1, os.cpu_count() // args.world_size))
+        # the prompts are the same in all processes, so only the first one draws them
+        args.visualize_prompt = args.visualize_prompt and args.rank == 0
+    set_model_folder(args)
+
+    # A step of a distributed run uses world_size batches. The learning rate is scaled linearly with
+    # the batch and the warmup is shortened, so it covers the same number of samples; the file name
+    # keeps the given hyperparameters.
+    if args.world_size > 1 and not args.no_scale_lr:
+        args.warmup = max(1, args.warmup // args.world_size)
+        args.learning_rate *= args.world_size
+
+    return args
 
-    args.filename = "{}_{}_{}_{}_{}_{}_{}_{}_{}_{}_lr_{}_decay_{}_bsz_{}_warmup_{}_trial_{}".format(
+
+def get_filename(args):
+    """Returns the name of the model folder of a run, which identifies its hyperparameters."""
+    filename = "{}_{}_{}_{}_{}_{}_{}_{}_{}_{}_lr_{}_decay_{}_bsz_{}_warmup_{}_trial_{}".format(
         args.prompt_type,  # Adam: add prompt type to avoid visual and deep prompting models overwriting each other
         args.method,
         args.prompt_size,
@@ -185,32 +289,119 @@ def parse_option():
         args.warmup,
         args.trial,
     )
+    # only added if set, to keep the names of the existing runs
+    if getattr(args, "input_resolution", None) is not None:
+        filename += f"_res_{args.input_resolution}"
+    return filename
 
-    args.device = get_device()
+
+def set_model_folder(args):
+    """Sets the file name and the model folder of the run in args and creates the folder."""
+    args.filename = get_filename(args)
     args.model_folder = os.path.join(args.model_dir, args.filename)
-    if not os.path.isdir(args.model_folder):
-        os.makedirs(args.model_folder)
+    os.makedirs(args.model_folder, exist_ok=True)
 
     # Adam: option to easily resume from the best saved model for the given parameters to do additional evaluation
     # without manually specifying the default file name in the job file
     if args.resume_best:
         args.resume = os.path.join(args.model_folder, "model_best.pth.tar")
 
-    return args
+
+def get_prompter_args(args):
+    """
+    Returns a copy of the arguments for every prompter of --prompters, as if each was trained in a
+    separate run. They have their own model folder, so they can be evaluated like a single run.
+    """
+    prompter_args = []
+    for prompter in args.prompters:
+        method, prompt_size, prompt_init_method = prompter.split(":")
+        p_args = copy.copy(args)
+        p_args.method = method
+        p_args.prompt_size = int(prompt_size)
+        p_args.prompt_init_method = prompt_init_method
+        p_args.prompters = None
+        set_model_folder(p_args)
+        prompter_args.append(p_args)
+    return prompter_args
+
+
+def get_result_filename(args):
+    """Returns the name of the results file of a run in results_vp."""
+    fn = f"{args.dataset}_{args.prompt_type}_{args.method}_{args.prompt_num}_{args.injection_layer}_{args.prompt_size}_{args.prompt_init_method}_{args.test_noise}"
+    if getattr(args, "input_resolution", None) is not None:
+        fn += f"_res_{args.input_resolution}"
+    return f"{fn}.json"
+
+
+def save_results(results_dir, args, top1_val_acc, top1_test_acc, best_epoch, phase_times):
+    """Saves the accuracies of a run (or of one prompter of --prompters) and the phase times of its training steps."""
+    # Adam: save results into a single directory to make it easier to plot in the end
+    result = vars(args)
+    result["top1_val_acc"] = top1_val_acc
+    result["top1_test_acc"] = top1_test_acc
+    result["best_epoch"] = best_epoch
+    fn = get_result_filename(args)
+    with open(f"{results_dir}/{fn}", "w") as f:
+        json.dump(result, f)
+
+    # Adam: phase times of the training steps, in a separate directory so the plotting code
+    # still finds only the accuracies in results_vp
+    if phase_times:
+        timing_dir = "results_vp_timing"
+        os.makedirs(timing_dir, exist_ok=True)
+        with open(f"{timing_dir}/{fn}", "w") as f:
+            json.dump(phase_times, f, indent=2)
+
+
+def main_multi(args, results_dir):
+    """Trains and evaluates all prompters of --prompters together and saves their results like separate runs."""
+    prompter_args = get_prompter_args(args)
+    learn = MultiPromptLearner(args, prompter_args)
+
+    if args.evaluate:
+        top1_val_accs = [None] * len(prompter_args)
+    else:
+        learn.run()
+        learn.resume_best_checkpoint()
+        top1_val_accs = learn.evaluate("valid")
+    top1_test_accs = learn.evaluate("test")
+
+    # the prompters are trained in the same steps, so they share the phase times
+    for k, p_args in enumerate(prompter_args):
+        save_results(
+            results_dir,
+            p_args,
+            top1_val_accs[k],
+            top1_test_accs[k],
+            learn.best_epochs[k],
+            learn.phase_times,
+        )
 
 
 def main():
     args = parse_option()
-    print(args)
+    try:
+        run(args)
+    finally:
+        cleanup()
+
+
+def run(args):
+    if is_main_process():
+        print(args)
 
     if args.visualize_prompt:
         os.makedirs("images", exist_ok=True)
 
-    learn = Learner(args)
-
     # Adam: collect and save results
     results_dir = "results_vp"
     os.makedirs(results_dir, exist_ok=True)
+
+    if args.prompters is not None:
+        main_multi(args, results_dir)
+        return
+
+    learn = Learner(args)
     top1_val_acc, top1_test_acc = None, None
 
     if args.evaluate:
@@ -227,14 +418,13 @@ def main():
         top1_val_acc = learn.evaluate("valid")
         top1_test_acc = learn.evaluate("test")
 
-    # Adam: save results into a single directory to make it easier to plot in the end
-    result = vars(args)
-    result["top1_val_acc"] = top1_val_acc
-    result["top1_test_acc"] = top1_test_acc
-    result["best_epoch"] = learn.best_epoch
-    fn = f"{args.dataset}_{args.prompt_type}_{args.method}_{args.prompt_num}_{args.injection_layer}_{args.prompt_size}_{args.prompt_init_method}_{args.test_noise}.json"
-    with open(f"{results_dir}/{fn}", "w") as f:
-        json.dump(result, f)
+    # all processes have the same (all-reduced) accuracies, the first one saves them
+    if not is_main_process():
+        return
+
+    save_results(
+        results_dir, args, top1_val_acc, top1_test_acc, learn.best_epoch, learn.phase_times
+    )
 
     # Adam: if visualize prompt is requested then also visualize after training/loading the best model,
     # to see what we've actually learnt
@@ -0,0 +1,252 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""
+Evaluation of one prompted CLIP model on several datasets at once.
+
+The class names of all datasets are merged into one label space, in which every dataset starts at
+its label offset, and the text features of the merged classes are computed once. All datasets are
+read through a single DataLoader (one worker pool) that interleaves their batches. No training
+Learner is built, the prompts are loaded directly from the checkpoint.
+"""
+import math
+import os
+import sys
+from collections import namedtuple
+from types import SimpleNamespace
+
+import torch
+from torch.utils.data import ConcatDataset, Dataset, Sampler
+from torchvision.transforms import Compose
+from tqdm import tqdm
+
+from dataset import DATASET, AddGaussianNoise
+from clip_registry import get_preprocess
+from learner import load_prompt_checkpoint
+from precision import autocast
+from vpt_model import VisualPromptCLIP
+from dpt_model import DeepPromptCLIP
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from loader_autotune import tuned_dataloader  # noqa: E402
+
+
+EvalSet = namedtuple("EvalSet", ["dataset", "split", "label_offset"])
+
+
+def parse_eval_sets(specs):
+    """
+    Parses dataset:split[:label_offset] entries, the offset is None if it is not given.
+    Every dataset:split can only be given once, as the accuracies are reported per dataset_split.
+    """
+    eval_sets = []
+    for spec in specs:
+        parts = spec.split(":")
+        if len(parts) not in (2, 3):
+            raise ValueError(f"Expected dataset:split[:label_offset], got {spec}")
+        offset = int(parts[2]) if len(parts) == 3 else None
+        if any((s.dataset, s.split) == (parts[0], parts[1]) for s in eval_sets):
+            raise ValueError(f"{parts[0]}:{parts[1]} is given more than once")
+        eval_sets.append(EvalSet(parts[0], parts[1], offset))
+    return eval_sets
+
+
+def resolve_label_offsets(eval_sets, datasets):
+    """
+    Fills in the missing label offsets. A dataset reuses the offset of an earlier entry of the same
+    dataset, or starts after the classes of all earlier datasets.
+    """
+    resolved, offsets, next_offset = [], {}, 0
+    for eval_set, dataset in zip(eval_sets, datasets):
+        offset = eval_set.label_offset
+        if offset is None:
+            offset = offsets.get(eval_set.dataset, next_offset)
+        offsets.setdefault(eval_set.dataset, offset)
+        next_offset = max(next_offset, offset + len(dataset.classes))
+        resolved.append(eval_set._replace(label_offset=offset))
+    return resolved
+
+
+def load_eval_dataset(eval_set, root, preprocess, test_noise=False):
+    """Loads the (complete) train or test split of a dataset."""
+    if eval_set.split not in ("train", "test"):
+        raise ValueError(f"Unknown split {eval_set.split}, expected train or test")
+    transform = preprocess
+    if test_noise:
+        transform = Compose(preprocess.transforms + [AddGaussianNoise()])
+    return DATASET[eval_set.dataset](
+        root, transform=transform, download=True, train=eval_set.split == "train"
+    )
+
+
+def merge_class_names(datasets, eval_sets):
+    """Returns the class names of the merged label space."""
+    classnames = [None] * max(
+        s.label_offset + len(d.classes) for d, s in zip(datasets, eval_sets)
+    )
+    for dataset, eval_set in zip(datasets, eval_sets):
+        for i, name in enumerate(dataset.classes):
+            slot = eval_set.label_offset + i
+            if classnames[slot] is not None and classnames[slot] != name:
+                raise ValueError(
+                    f"Label {slot} is both {classnames[slot]} and {name} ({eval_set.dataset})"
+                )
+            classnames[slot] = name
+    if None in classnames:
+        raise ValueError(f"Label {classnames.index(None)} is not used by any dataset")
+    return classnames
+
+
+class OffsetTargets(Dataset):
+    """Returns the samples of a dataset with their target in the merged label space and the index of the dataset."""
+
+    def __init__(self, dataset, label_offset, dataset_idx):
+        self.dataset = dataset
+        self.label_offset = label_offset
+        self.dataset_idx = dataset_idx
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, target = self.dataset[idx]
+        return image, target + self.label_offset, self.dataset_idx
+
+
+class InterleavedBatchSampler(Sampler):
+    """
+    Batches of a ConcatDataset that take turns between its datasets, every batch is from one dataset.
+    Datasets that run out of samples are skipped, so all batches are used.
+    """
+
+    def __init__(self, sizes, batch_size):
+        self.sizes = list(sizes)
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        starts = [0]
+        for size in self.sizes[:-1]:
+            starts.append(starts[-1] + size)
+        batches = [
+            iter(
+                [
+                    list(range(start + i, start + min(i + self.batch_size, size)))
+                    for i in range(0, size, self.batch_size)
+                ]
+            )
+            for start, size in zip(starts, self.sizes)
+        ]
+        while batches:
+            for batch_iter in list(batches):
+                batch = next(batch_iter, None)
+                if batch is None:
+                    batches.remove(batch_iter)
+                else:
+                    yield batch
+
+    def __len__(self):
+        return sum(math.ceil(size / self.batch_size) for size in self.sizes)
+
+
+def build_prompted_model(args, classnames):
+    """Builds the prompted CLIP model of the arguments for the class names and loads its prompts from args.resume."""
+    classes = SimpleNamespace(classes=classnames)
+    if args.prompt_type == "visual_prompt":
+        model = VisualPromptCLIP(args, classes, template=args.text_prompt_template)
+    elif args.prompt_type == "deep_prompt":
+        model = DeepPromptCLIP(args, classes, template=args.text_prompt_template)
+    else:
+        raise NotImplementedError(f"{args.prompt_type} is not supported :)!")
+
+    print("=> loading checkpoint '{}'".format(args.resume))
+    checkpoint = torch.load(args.resume, map_location=args.device)
+    load_prompt_checkpoint(model, args.prompt_type, checkpoint)
+    model.requires_grad_(False)
+    return model.to(args.device).eval()
+
+
+class MultiDatasetEvaluator:
+    """Evaluates a prompted CLIP model on several datasets in a merged label space."""
+
+    def __init__(self, args, eval_sets):
+        self.args = args
+
+        preprocess = get_preprocess(args.arch, getattr(args, "input_resolution", None))
+        self.datasets = [
+            load_eval_dataset(eval_set, args.root, preprocess, args.test_noise)
+            for eval_set in eval_sets
+        ]
+        self.eval_sets = eval_sets = resolve_label_offsets(eval_sets, self.datasets)
+        self.classnames = merge_class_names(self.datasets, eval_sets)
+        # the text features of the merged classes are computed (or read from the cache) once here
+        self.model = build_prompted_model(args, self.classnames)
+
+        # Adam: with --autotune_loader, the worker, prefetching and pinning settings are tuned instead
+        self.loader = tuned_dataloader(
+            ConcatDataset(
+                [
+                    OffsetTargets(dataset, eval_set.label_offset, idx)
+                    for idx, (dataset, eval_set) in enumerate(zip(self.datasets, eval_sets))
+                ]
+            ),
+            batch_size=args.batch_size,
+            enabled=getattr(args, "autotune_loader", False),
+            dataset_name="+".join(f"{s.dataset}-{s.split}" for s in eval_sets),
+            transform_name=" ".join(repr(self.datasets[0].transform).split()),
+            batch_sampler=InterleavedBatchSampler(
+                [len(dataset) for dataset in self.datasets], args.batch_size
+            ),
+            num_workers=args.num_workers,
+            pin_memory=args.device.startswith("cuda"),
+        )
+
+    def run(self):
+        """
+        Returns the top-1 accuracy (in %) on every dataset, keyed by dataset_split, and on all
+        datasets together ("pooled").
+        """
+        num_sets = len(self.eval_sets)
+        correct = torch.zeros(num_sets, dtype=torch.long, device=self.args.device)
+        total = torch.zeros(num_sets, dtype=torch.long, device=self.args.device)
+
+        with torch.no_grad():
+            for i, (images, targets, dataset_idx) in enumerate(
+                tqdm(
+                    self.loader,
+                    mininterval=self.args.print_tqdm_interval,
+                    maxinterval=self.args.print_tqdm_interval,
+                )
+            ):
+                if 0 < self.args.max_batches <= i:
+                    break
+                images = images.to(self.args.device)
+                targets = targets.to(self.args.device)
+                dataset_idx = dataset_idx.to(self.args.device)
+                with autocast(self.args.device, self.model.precision):
+                    logits = self.model(images)
+                hits = (logits.argmax(dim=-1) == targets).long()
+                correct.index_add_(0, dataset_idx, hits)
+                total.index_add_(0, dataset_idx, torch.ones_like(hits))
+
+        correct, total = correct.tolist(), total.tolist()
+        accuracies = {
+            f"{eval_set.dataset}_{eval_set.split}": c / max(t, 1) * 100
+            for eval_set, c, t in zip(self.eval_sets, correct, total)
+        }
+        accuracies["pooled"] = sum(correct) / max(sum(total), 1) * 100
+        for name, accuracy in accuracies.items():
+            print(f" * {name} Acc@1 {accuracy:.3f}")
+        return accuracies
@@ -0,0 +1,104 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""
+Precision policy of the CLIP models.
+
+The frozen CLIP weights (apart from the LayerNorms) are stored in the precision of the policy, the
+forward passes run under autocast, and the learned prompts always stay float32 master copies. With
+fp16, the loss is scaled by a GradScaler to avoid underflowing prompt gradients.
+"""
+import contextlib
+
+import torch
+import torch.nn as nn
+from torch.cuda.amp import GradScaler
+
+
+PRECISIONS = ["auto", "fp32", "fp16", "bf16"]
+
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def resolve_precision(precision, device):
+    """
+    Returns the precision to use on the device.
+    auto keeps the previous behaviour: fp16 on the GPU (the precision of the released CLIP weights)
+    and fp32 otherwise.
+    """
+    if precision == "auto":
+        return "fp16" if device.startswith("cuda") else "fp32"
+    if precision == "fp16" and not device.startswith("cuda"):
+        raise ValueError(f"fp16 is only supported on the GPU, use bf16 on {device}")
+    if precision == "bf16" and device == "mps":
+        raise ValueError("bf16 is not supported on mps")
+    return precision
+
+
+def get_precision(args):
+    """Returns the resolved precision of the command line arguments (see --precision)."""
+    return resolve_precision(getattr(args, "precision", "auto"), args.device)
+
+
+def prepare_clip_model(clip_model, precision):
+    """
+    Stores the (frozen) weights of the CLIP model in the precision of the policy.
+
+    Like clip.model.convert_weights, only the weights of the convolutions, linear layers, attention
+    and projections are converted. The LayerNorms compute in float32 and keep float32 weights.
+    """
+    dtype = DTYPES[precision]
+
+    def _convert_weights(layer):
+        if isinstance(layer, (nn.Conv1d, nn.Conv2d, nn.Linear)):
+            layer.weight.data = layer.weight.data.to(dtype)
+            if layer.bias is not None:
+                layer.bias.data = layer.bias.data.to(dtype)
+
+        if isinstance(layer, nn.MultiheadAttention):
+            for attr in [
+                *[f"{s}_proj_weight" for s in ["in", "q", "k", "v"]],
+                "in_proj_bias",
+                "bias_k",
+                "bias_v",
+            ]:
+                tensor = getattr(layer, attr)
+                if tensor is not None:
+                    tensor.data = tensor.data.to(dtype)
+
+        for name in ["text_projection", "proj"]:
+            if hasattr(layer, name):
+                attr = getattr(layer, name)
+                if attr is not None:
+                    attr.data = attr.data.to(dtype)
+
+    clip_model.apply(_convert_weights)
+    return clip_model
+
+
+def autocast(device, precision):
+    """Returns the autocast context of the precision policy for the forward passes."""
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    return torch.autocast(
+        device_type="cuda" if device.startswith("cuda") else "cpu",
+        dtype=DTYPES[precision],
+    )
+
+
+def get_grad_scaler(precision):
+    """Returns the gradient scaler of the precision policy, which only scales the loss with fp16."""
+    return GradScaler(enabled=precision == "fp16")
@@ -0,0 +1,187 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""
+Cache of the DeepPromptCLIP activations below the injection layer.
+
+The layers below the injection layer are frozen and do not see the deep prompt, and the training
+preprocessing is deterministic, so their output is the same for an image in every epoch. It is
+computed once per training image and stored as a memory-mapped float16 file, indexed by the index
+of the image in the underlying (unsplit) dataset. Training then only runs the remaining layers.
+
+Storing float16 is the only size reduction, the activations are not compressed or quantized any
+further: the cache takes 2 * (grid ** 2 + 1) * width bytes per image, e.g. about 12 GB for ViT-B/16
+on the CIFAR training set. The activations depend on the precision of the forward pass, so every
+precision has its own cache.
+"""
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Subset
+from tqdm import tqdm
+
+from text_features import get_weights_hash
+
+
+def get_underlying_indices(dataset):
+    """Returns the underlying dataset and the indices of the samples of a (possibly nested) Subset in it."""
+    indices = np.arange(len(dataset))
+    while isinstance(dataset, Subset):
+        indices = np.asarray(dataset.indices)[indices]
+        dataset = dataset.dataset
+    return dataset, indices
+
+
+class IndexedDataset(Dataset):
+    """Returns the index of every sample together with the sample."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, target = self.dataset[idx]
+        return image, target, idx
+
+
+def prefix_cache_name(
+    cache_dir, arch, dataset_name, injection_layer, input_resolution=None, precision="fp32"
+):
+    """
+    Returns the file name prefix of the cached activations of a
+    (arch, dataset, injection layer, resolution, precision) combination.
+    """
+    name = f"{arch.replace('/', '-')}_{get_weights_hash(arch)[:8]}_{dataset_name}_layer{injection_layer}"
+    if input_resolution is not None:
+        name += f"_res{input_resolution}"
+    if precision != "fp32":
+        name += f"_{precision}"
+    return os.path.join(cache_dir, name)
+
+
+def fill_prefix_cache(
+    model, dataset, cache_name, batch_size, device, num_workers=0, print_tqdm_interval=1.0
+):
+    """
+    Computes the prefix activations (see DeepPromptCLIP.encode_prefix) of all samples of the
+    dataset that are not cached yet. An interrupted run continues where it stopped.
+
+    Returns:
+        features (np.ndarray): memory-mapped activations of all samples of the underlying dataset
+        labels (np.ndarray): labels of all samples of the underlying dataset
+        filled (np.ndarray): which samples of the underlying dataset are cached
+    """
+    underlying_dataset, indices = get_underlying_indices(dataset)
+    features_file = f"{cache_name}_prefix.npy"
+    labels_file = f"{cache_name}_labels.npy"
+    filled_file = f"{cache_name}_filled.npy"
+
+    if os.path.isfile(filled_file):
+        filled = np.load(filled_file)
+        labels = np.load(labels_file)
+    else:
+        filled = np.zeros(len(underlying_dataset), dtype=bool)
+        labels = np.zeros(len(underlying_dataset), dtype=np.int64)
+
+    missing = [i for i, idx in enumerate(indices) if not filled[idx]]
+    if not missing:
+        return np.load(features_file, mmap_mode="r"), labels, filled
+
+    model.eval()
+    with torch.no_grad():
+        loader = DataLoader(
+            IndexedDataset(Subset(dataset, missing)),
+            batch_size=batch_size,
+            num_workers=num_workers,
+        )
+        features = None
+        for images, targets, positions in tqdm(
+            loader,
+            desc="Caching prefix activations",
+            mininterval=print_tqdm_interval,
+            maxinterval=print_tqdm_interval,
+        ):
+            prefix = model.encode_prefix(images.to(device))
+            if features is None:
+                os.makedirs(os.path.dirname(cache_name) or ".", exist_ok=True)
+                features = np.lib.format.open_memmap(
+                    features_file,
+                    mode="r+" if os.path.isfile(features_file) else "w+",
+                    dtype=np.float16,
+                    shape=(len(underlying_dataset),) + tuple(prefix.shape[1:]),
+                )
+            idx = indices[np.asarray(missing)[positions.numpy()]]
+            # numpy has no bfloat16, so convert through float32
+            features[idx] = prefix.cpu().float().numpy().astype(np.float16)
+            labels[idx] = targets.numpy()
+            filled[idx] = True
+        features.flush()
+        del features
+
+    # the mask is written after the activations, so it never marks samples that are not stored
+    for array, file in ((labels, labels_file), (filled, filled_file)):
+        tmp_file = f"{file}.{os.getpid()}.tmp.npy"
+        np.save(tmp_file, array)
+        os.replace(tmp_file, file)
+    return np.load(features_file, mmap_mode="r"), labels, filled
+
+
+class PrefixCacheDataset(Dataset):
+    """Returns the cached prefix activations and the labels of the samples of a dataset."""
+
+    def __init__(self, dataset, cache_name):
+        _, self.indices = get_underlying_indices(dataset)
+        self.features_file = f"{cache_name}_prefix.npy"
+        self.labels = np.load(f"{cache_name}_labels.npy")
+        self.features = None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        # opened lazily, so every data loader worker maps the file itself
+        if self.features is None:
+            self.features = np.load(self.features_file, mmap_mode="r")
+        underlying_idx = self.indices[idx]
+        return (
+            torch.from_numpy(np.array(self.features[underlying_idx])),
+            int(self.labels[underlying_idx]),
+        )
+
+
+def get_prefix_dataset(model, dataset, args, cache_dir="save/prefix_cache"):
+    """Fills the prefix cache for the dataset if needed and returns a dataset of the cached activations."""
+    cache_name = prefix_cache_name(
+        cache_dir,
+        args.arch,
+        args.dataset,
+        args.injection_layer,
+        getattr(args, "input_resolution", None),
+        model.precision,
+    )
+    fill_prefix_cache(
+        model,
+        dataset,
+        cache_name,
+        args.batch_size,
+        args.device,
+        num_workers=args.num_workers,
+        print_tqdm_interval=args.print_tqdm_interval,
+    )
+    return PrefixCacheDataset(dataset, cache_name)
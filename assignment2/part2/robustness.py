@@ -32,6 +32,18 @@ def parse_option():
     parser.add_argument(
         "--num_workers", type=int, default=16, help="num of workers to use"
     )
+    parser.add_argument(
+        "--autotune_loader",
+        action="store_true",
+        help="autotune the dataloader settings on first use and reuse them afterwards, instead of num_workers",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="auto",
+        choices=["auto", "fp32", "fp16", "bf16"],
+        help="precision of the frozen CLIP weights and the forward passes; auto uses fp16 on the GPU and fp32 otherwise",
+    )
     parser.add_argument(
         "--epochs", type=int, default=1000, help="number of training epochs"
     )
@@ -0,0 +1,102 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""On-disk cache of the normalized CLIP text features of the class prompts."""
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from clip import clip
+
+
+# numpy has no bfloat16, features of other dtypes are stored as float32 and cast back when loaded
+NUMPY_DTYPES = {torch.float16: np.float16, torch.float32: np.float32}
+
+
+def get_weights_hash(arch):
+    """Returns the SHA256 of the pretrained CLIP weights, which is part of their download URL."""
+    return clip._MODELS[arch].split("/")[-2]
+
+
+def text_feature_cache_name(cache_dir, arch, prompts, dtype):
+    """
+    Returns the file name of the cached text features.
+
+    The prompts are the template filled in with the class names, so the key covers the
+    (arch, weights, template, class names, dtype) combination.
+    """
+    key = json.dumps(
+        {
+            "arch": arch,
+            "weights": get_weights_hash(arch),
+            "prompts": list(prompts),
+            "dtype": str(dtype),
+        }
+    )
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{arch.replace('/', '-')}_{digest}.npy")
+
+
+def encode_text_features(clip_model, prompts, device, batch_size=1024):
+    """
+    Computes the normalized text features of the prompts, of shape (num_prompts, embedding dimension).
+    The prompts are encoded in batches, so large vocabularies of class names fit into memory.
+    """
+    text_features = []
+    with torch.no_grad():
+        for start in range(0, len(prompts), batch_size):
+            tokenized_prompts = torch.cat(
+                [clip.tokenize(p) for p in prompts[start : start + batch_size]]
+            ).to(device)
+            features = clip_model.encode_text(tokenized_prompts)
+            features /= features.norm(dim=-1, keepdim=True)
+            text_features.append(features)
+    return torch.cat(text_features)
+
+
+def get_text_features(
+    clip_model, arch, prompts, device, cache_dir="save/text_features"
+):
+    """
+    Returns the normalized text features of the prompts.
+
+    The features are computed on first use and stored as a .npy file in cache_dir.
+    Later calls memory-map the stored features instead of running the text encoder.
+    """
+    dtype = clip_model.dtype
+    cache_name = text_feature_cache_name(cache_dir, arch, prompts, dtype)
+
+    if os.path.isfile(cache_name):
+        # copy-on-write, so the features can be turned into a (writable) tensor without a copy
+        features = np.load(cache_name, mmap_mode="c")
+        return torch.from_numpy(features).to(device=device, dtype=dtype)
+
+    text_features = encode_text_features(clip_model, prompts, device)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_name = f"{cache_name}.{os.getpid()}.tmp"
+    with open(tmp_name, "wb") as f:
+        np.save(
+            f,
+            text_features.cpu()
+            .to(torch.float32)
+            .numpy()
+            .astype(NUMPY_DTYPES.get(dtype, np.float32)),
+        )
+    os.replace(tmp_name, cache_name)
+    return text_features
@@ -0,0 +1,195 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""
+Token reduction between the residual attention blocks of the CLIP vision transformer.
+
+The cost of a block grows with the number of tokens, so removing tokens early speeds up all later
+blocks. Two methods are supported, both applied before the blocks of a per-layer schedule:
+
+- merge: bipartite soft matching of ToMe (Bolya et al., 2023). The r most similar patch tokens of
+  one half are averaged into their most similar token of the other half, weighted by the number of
+  patches a token already represents. Proportional attention is not used, as it would require
+  changing the attention of the pretrained blocks.
+- prune: the r patch tokens that receive the least attention from the class token in the next
+  block are dropped.
+
+The class token and the deep prompt tokens are never reduced.
+"""
+import torch
+import torch.nn.functional as F
+
+
+TOKEN_REDUCTION_METHODS = ["merge", "prune"]
+
+
+def parse_token_schedule(spec, num_layers):
+    """
+    Returns the number of tokens to remove before every layer.
+
+    Args:
+        spec (str): a single number for all layers, or a comma separated number per layer
+        num_layers (int): number of residual attention blocks
+    """
+    values = [int(v) for v in spec.split(",")]
+    if len(values) == 1:
+        return values * num_layers
+    if len(values) != num_layers:
+        raise ValueError(
+            f"The token schedule has {len(values)} entries, but the model has {num_layers} layers"
+        )
+    return values
+
+
+def merge_tokens(x, size, r, protect_first=1, protect_last=0):
+    """
+    Merges r pairs of tokens with bipartite soft matching.
+
+    Args:
+        x (torch.Tensor): tokens of shape (batch_size, num_tokens, width)
+        size (torch.Tensor): number of patches every token represents, of shape (batch_size, num_tokens, 1)
+        r (int): number of tokens to remove
+        protect_first (int): number of leading tokens that are not merged (the class token)
+        protect_last (int): number of trailing tokens that are not merged (the deep prompts)
+
+    Returns:
+        tuple: merged tokens and their sizes
+    """
+    num_tokens = x.shape[1]
+    body = slice(protect_first, num_tokens - protect_last)
+    x_body, size_body = x[:, body], size[:, body]
+    r = min(r, x_body.shape[1] // 2)
+    if r <= 0:
+        return x, size
+
+    with torch.no_grad():
+        metric = x_body / x_body.norm(dim=-1, keepdim=True)
+        scores = metric[:, ::2] @ metric[:, 1::2].transpose(-1, -2)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unmerged_idx = edge_idx[:, r:]
+        src_idx = edge_idx[:, :r]
+        dst_idx = node_idx[..., None].gather(dim=1, index=src_idx)
+
+    def merge(t):
+        src, dst = t[:, ::2], t[:, 1::2]
+        channels = t.shape[-1]
+        unmerged = src.gather(dim=1, index=unmerged_idx.expand(-1, -1, channels))
+        src = src.gather(dim=1, index=src_idx.expand(-1, -1, channels))
+        dst = dst.scatter_reduce(
+            1, dst_idx.expand(-1, -1, channels), src, reduce="sum"
+        )
+        return torch.cat([unmerged, dst], dim=1)
+
+    # weighted average of the merged tokens
+    merged_size = merge(size_body)
+    merged_x = merge(x_body * size_body) / merged_size
+    return (
+        torch.cat([x[:, :protect_first], merged_x, x[:, body.stop :]], dim=1),
+        torch.cat([size[:, :protect_first], merged_size, size[:, body.stop :]], dim=1),
+    )
+
+
+def class_attention(block, x):
+    """
+    Returns the attention of the class token to all tokens in the block, averaged over the heads.
+
+    Args:
+        block (ResidualAttentionBlock): the next block of the transformer
+        x (torch.Tensor): tokens of shape (batch_size, num_tokens, width)
+    """
+    attn = block.attn
+    batch_size, num_tokens, width = x.shape
+    head_dim = width // attn.num_heads
+    y = block.ln_1(x)
+    w_q, w_k, _ = attn.in_proj_weight.chunk(3)
+    b_q, b_k, _ = attn.in_proj_bias.chunk(3)
+    q = F.linear(y[:, :1], w_q, b_q).view(batch_size, attn.num_heads, head_dim)
+    k = F.linear(y, w_k, b_k).view(batch_size, num_tokens, attn.num_heads, head_dim)
+    scores = torch.einsum("nhd,nlhd->nhl", q, k) / head_dim**0.5
+    return scores.softmax(dim=-1).mean(dim=1)
+
+
+def prune_tokens(x, size, r, block, protect_first=1, protect_last=0):
+    """
+    Drops the r tokens with the lowest class token attention in the next block.
+    See merge_tokens for the arguments.
+    """
+    num_tokens = x.shape[1]
+    body = slice(protect_first, num_tokens - protect_last)
+    keep = max(x[:, body].shape[1] - r, 1)
+    if keep >= x[:, body].shape[1]:
+        return x, size
+
+    with torch.no_grad():
+        scores = class_attention(block, x)[:, body]
+        keep_idx = scores.topk(keep, dim=1).indices.sort(dim=1).values[..., None]
+    x_body = x[:, body].gather(dim=1, index=keep_idx.expand(-1, -1, x.shape[-1]))
+    size_body = size[:, body].gather(dim=1, index=keep_idx)
+    return (
+        torch.cat([x[:, :protect_first], x_body, x[:, body.stop :]], dim=1),
+        torch.cat([size[:, :protect_first], size_body, size[:, body.stop :]], dim=1),
+    )
+
+
+class TokenReduction:
+    """Removes tokens before the residual attention blocks according to a per-layer schedule."""
+
+    def __init__(self, schedule, method="merge"):
+        assert method in TOKEN_REDUCTION_METHODS, f"{method} is not supported :)!"
+        self.schedule = schedule
+        self.method = method
+
+    @classmethod
+    def from_args(cls, args, num_layers):
+        """Returns the token reduction of --token_schedule and --token_reduction, or None if it is disabled."""
+        spec = getattr(args, "token_schedule", None)
+        if not spec:
+            return None
+        schedule = parse_token_schedule(spec, num_layers)
+        if not any(schedule):
+            return None
+        return cls(schedule, getattr(args, "token_reduction", "merge"))
+
+    def run(self, resblocks, x, size=None, first_layer=0, protect_last=0):
+        """
+        Runs the blocks with the token reduction.
+
+        Args:
+            resblocks (list): residual attention blocks to run
+            x (torch.Tensor): tokens of shape (num_tokens, batch_size, width), as in the CLIP transformer
+            size (torch.Tensor): number of patches every token represents, of shape (batch_size, num_tokens, 1);
+                all ones if None
+            first_layer (int): index of the first block in the transformer, to look up its schedule
+            protect_last (int): number of trailing tokens that are never removed (the deep prompts)
+
+        Returns:
+            tuple: the output tokens and their sizes
+        """
+        if size is None:
+            size = torch.ones(x.shape[1], x.shape[0], 1, dtype=x.dtype, device=x.device)
+        for layer, block in enumerate(resblocks, start=first_layer):
+            r = self.schedule[layer]
+            if r > 0:
+                x = x.permute(1, 0, 2)  # LND -> NLD
+                if self.method == "merge":
+                    x, size = merge_tokens(x, size, r, protect_last=protect_last)
+                else:
+                    x, size = prune_tokens(x, size, r, block, protect_last=protect_last)
+                x = x.permute(1, 0, 2)  # NLD -> LND
+            x = block(x)
+        return x, size
+
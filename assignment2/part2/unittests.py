@@ -0,0 +1,669 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+import base64
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.utils.data as data
+from clip.model import CLIP, LayerNorm, ResidualAttentionBlock
+from PIL import Image
+
+import clip_registry
+from clip_server import DynamicBatcher, ServerStats, make_handler
+from clipzs import ZeroshotCLIP, extract_image_features, image_feature_cache_name
+from dpt_model import DeepPromptCLIP
+from large_vocab import PQIndex, chunked_topk
+from learner import Learner, MultiPromptLearner, load_prompt_checkpoint
+from main import main_multi, parse_option, run
+from multi_eval import InterleavedBatchSampler, OffsetTargets, parse_eval_sets
+from precision import autocast
+from prefix_cache import get_prefix_dataset
+from token_reduction import TokenReduction, merge_tokens, parse_token_schedule, prune_tokens
+from utils import AsyncCheckpointWriter, trainable_state_dict
+from vit import encode_image, get_positional_embedding, interpolate_positional_embedding
+from vpt_model import VisualPromptCLIP
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from loader_autotune import get_cache_key, tuned_dataloader  # noqa: E402
+
+
+ARCH = "ViT-B/32"
+CLASSES = ["cat", "dog", "ship"]
+
+
+def register_tiny_clip(image_resolution=32, vision_width=768):
+    """
+    Registers a randomly initialized CLIP with a tiny vision transformer (grid of 4 x 4 patches) in
+    place of the pretrained ARCH, so the models are built without downloading any weights. The text
+    encoder keeps the context length and vocabulary of the tokenizer.
+    """
+    torch.manual_seed(42)
+    model = CLIP(
+        embed_dim=32,
+        image_resolution=image_resolution,
+        vision_layers=2,
+        vision_width=vision_width,
+        vision_patch_size=image_resolution // 4,
+        context_length=77,
+        vocab_size=49408,
+        transformer_width=64,
+        transformer_heads=1,
+        transformer_layers=1,
+    )
+    model.eval()
+    model.requires_grad_(False)
+    clip_registry._models[ARCH] = model
+    return model
+
+
+def zeroshot_args(**kwargs):
+    args = SimpleNamespace(
+        device="cpu",
+        arch=ARCH,
+        root="./data",
+        class_names=CLASSES,
+        precision="fp32",
+        token_schedule=None,
+        token_reduction="merge",
+    )
+    args.__dict__.update(kwargs)
+    return args
+
+
+def prompt_args(**kwargs):
+    args = zeroshot_args(
+        injection_layer=1,
+        prompt_num=2,
+        model_folder=".",
+        method="padding",
+        prompt_size=4,
+        image_size=32,
+        prompt_init_method="random",
+        visualize_prompt=False,
+    )
+    args.__dict__.update(kwargs)
+    return args
+
+
+class TestCase(unittest.TestCase):
+    """Runs every test in a temporary directory, where the feature caches are written."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+        clip_registry._models.pop(ARCH, None)
+
+
+class TestTemplateSweep(TestCase):
+
+    @torch.no_grad()
+    def test_features_of_configured_model(self):
+        register_tiny_clip()
+        clipzs = ZeroshotCLIP(zeroshot_args(token_schedule="2"), None, "a photo of a {}")
+        images = torch.randn(6, 3, 32, 32)
+        loader = data.DataLoader(data.TensorDataset(images, torch.arange(6) % 3), batch_size=4)
+
+        cache_name = image_feature_cache_name(
+            "cache", ARCH, "tiny", "test", False, 0, token_reduction=clipzs.token_reduction
+        )
+        features, labels = extract_image_features(clipzs, loader, cache_name, "cpu")
+        expected = clipzs.image_features(images)
+        self.assertTrue(np.allclose(features, expected.numpy(), atol=1e-2),
+                        msg="The cached features must be those of the model with token reduction")
+        self.assertTrue(np.array_equal(labels, (torch.arange(6) % 3).numpy()))
+
+        clipzs.token_reduction = None
+        self.assertFalse(torch.allclose(clipzs.image_features(images), expected, atol=1e-2),
+                         msg="The token reduction should change the features")
+
+    def test_cache_name(self):
+        names = {
+            image_feature_cache_name("cache", ARCH, "tiny", "test", False, 0),
+            image_feature_cache_name("cache", ARCH, "tiny", "test", False, 0, input_resolution=64),
+            image_feature_cache_name(
+                "cache", ARCH, "tiny", "test", False, 0, token_reduction=TokenReduction([2, 2])
+            ),
+            image_feature_cache_name(
+                "cache", ARCH, "tiny", "test", False, 0, token_reduction=TokenReduction([2, 2], "prune")
+            ),
+            image_feature_cache_name("cache", ARCH, "tiny", "test", False, 0, precision="bf16"),
+        }
+        self.assertEqual(len(names), 5, msg="Every model configuration needs its own cache entry")
+
+
+class TestInputResolution(TestCase):
+
+    @torch.no_grad()
+    def test_positional_embedding(self):
+        visual = register_tiny_clip().visual
+        positional_embedding = visual.positional_embedding
+        self.assertIs(get_positional_embedding(visual, 4), positional_embedding)
+        self.assertTrue(torch.allclose(interpolate_positional_embedding(positional_embedding, 4),
+                                       positional_embedding, atol=1e-5),
+                        msg="The interpolation to the native grid must be the identity")
+
+        interpolated = get_positional_embedding(visual, 6)
+        self.assertEqual(interpolated.shape, (6 * 6 + 1, 768))
+        self.assertTrue(torch.equal(interpolated[0], positional_embedding[0]),
+                        msg="The class embedding must not be interpolated")
+        self.assertIs(get_positional_embedding(visual, 6), interpolated, msg="The interpolation must be cached")
+
+    @torch.no_grad()
+    def test_encode_image(self):
+        model = register_tiny_clip()
+        images = torch.randn(2, 3, 32, 32)
+        self.assertTrue(torch.allclose(encode_image(model.visual, images), model.encode_image(images), atol=1e-5),
+                        msg="At the native resolution the features must be those of CLIP")
+
+    @torch.no_grad()
+    def test_other_resolution(self):
+        register_tiny_clip()
+        clipzs = ZeroshotCLIP(zeroshot_args(token_schedule="2"), None, "a photo of a {}")
+        images = torch.randn(6, 3, 48, 48)
+        loader = data.DataLoader(data.TensorDataset(images, torch.arange(6) % 3), batch_size=4)
+
+        self.assertEqual(clipzs.model_inference(images).shape, (6, 3))
+        cache_name = image_feature_cache_name(
+            "cache", ARCH, "tiny", "test", False, 0, input_resolution=48, token_reduction=clipzs.token_reduction
+        )
+        features, _ = extract_image_features(clipzs, loader, cache_name, "cpu")
+        self.assertEqual(features.shape, (6, 32))
+        self.assertTrue(np.allclose(features, clipzs.image_features(images).numpy(), atol=1e-2))
+
+
+class TestClipServer(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        register_tiny_clip()
+        clipzs = ZeroshotCLIP(zeroshot_args(), None, "a photo of a {}")
+        stats = ServerStats(100)
+        batcher = DynamicBatcher(clipzs, ARCH, "cpu", stats, max_batch_size=4, max_latency=0.001)
+        self.server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), make_handler(batcher, clip_registry.get_preprocess(ARCH), stats)
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def post(self, path, obj):
+        """Returns the status and the response of a POST request."""
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{self.server.server_port}{path}",
+            data=json.dumps(obj).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def test_classes(self):
+        for body in [
+            {},
+            [],
+            {"class_names": "cat"},
+            {"class_names": []},
+            {"class_names": ["cat", 1]},
+            {"class_names": ["cat"], "template": 1},
+            {"class_names": ["cat"], "template": "a photo of a {name}"},
+        ]:
+            with self.subTest(body=body):
+                status, response = self.post("/classes", body)
+                self.assertEqual(status, 400)
+                self.assertIn("error", response)
+
+        status, response = self.post("/classes", {"class_names": ["cat", "dog"]})
+        self.assertEqual((status, response), (200, {"classes": 2}))
+
+        status, response = self.post("/classify", {"images": [self.image()], "top_k": 5})
+        self.assertEqual(status, 200)
+        self.assertEqual(sorted(p["class"] for p in response["predictions"][0]), ["cat", "dog"])
+
+    def image(self):
+        buffer = io.BytesIO()
+        Image.new("RGB", (40, 40)).save(buffer, format="PNG")
+        return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+    def test_classify(self):
+        image = self.image()
+        for body in [
+            {},
+            {"images": image},
+            {"images": [1]},
+            {"images": [image], "top_k": 0},
+            {"images": [image], "top_k": -1},
+            {"images": [image], "top_k": 1.5},
+            {"images": [image], "top_k": "2"},
+            {"images": ["not an image"]},
+        ]:
+            with self.subTest(body=body):
+                status, response = self.post("/classify", body)
+                self.assertEqual(status, 400)
+                self.assertIn("error", response)
+
+        for top_k, expected in [(1, 1), (2, 2), (10, 3)]:
+            status, response = self.post("/classify", {"images": [image, image], "top_k": top_k})
+            self.assertEqual(status, 200)
+            self.assertEqual([len(p) for p in response["predictions"]], [expected, expected])
+
+
+class TestLargeVocabulary(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(42)
+        self.image_features = torch.randn(5, 16)
+        self.text_features = torch.randn(100, 16)
+
+    def test_chunked_topk(self):
+        expected_scores, expected_indices = (self.image_features @ self.text_features.T).topk(10, dim=1)
+        for chunk_size in [1, 7, 10, 64, 1000]:
+            with self.subTest(chunk_size=chunk_size):
+                scores, indices = chunked_topk(self.image_features, self.text_features, 10, chunk_size)
+                self.assertTrue(torch.allclose(scores, expected_scores, atol=1e-5))
+                self.assertTrue(torch.equal(indices, expected_indices))
+
+        # more classes requested than there are
+        scores, indices = chunked_topk(self.image_features, self.text_features[:3], 10, chunk_size=2)
+        self.assertEqual(scores.shape, (5, 3))
+        self.assertTrue(torch.equal(indices.sort(dim=1).values, torch.arange(3).expand(5, 3)))
+
+    def test_memory_mapped(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, "text_features.npy")
+            np.save(filename, self.text_features.numpy())
+            text_features = np.load(filename, mmap_mode="c")
+            scores, indices = chunked_topk(self.image_features, text_features, 10, chunk_size=16)
+            del text_features
+        expected_scores, expected_indices = chunked_topk(self.image_features, self.text_features, 10)
+        self.assertTrue(torch.allclose(scores, expected_scores))
+        self.assertTrue(torch.equal(indices, expected_indices))
+
+    def test_pq_search(self):
+        index = PQIndex.build(self.text_features, num_subspaces=4, num_centroids=16)
+        # re-ranking all the classes is the exact search
+        scores, indices = index.search(self.image_features, 10, rerank=10, chunk_size=7)
+        expected_scores, expected_indices = chunked_topk(self.image_features, self.text_features, 10)
+        self.assertTrue(torch.allclose(scores, expected_scores, atol=1e-5))
+        self.assertTrue(torch.equal(indices, expected_indices))
+
+
+class TestInterleavedBatchSampler(unittest.TestCase):
+
+    def test_coverage(self):
+        sizes = [5, 0, 12, 3]
+        sampler = InterleavedBatchSampler(sizes, batch_size=4)
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        self.assertEqual(sorted(i for batch in batches for i in batch), list(range(sum(sizes))),
+                         msg="Every sample must be used exactly once")
+
+        dataset_of = [d for d, size in enumerate(sizes) for _ in range(size)]
+        datasets = []
+        for batch in batches:
+            self.assertLessEqual(len(batch), 4)
+            self.assertEqual(len({dataset_of[i] for i in batch}), 1, msg="Every batch must be from one dataset")
+            datasets.append(dataset_of[batch[0]])
+        self.assertEqual(datasets, [0, 2, 3, 0, 2, 2], msg="The datasets must take turns")
+
+    def test_data_loader(self):
+        sizes = [3, 6]
+        dataset = data.ConcatDataset([
+            OffsetTargets(data.TensorDataset(torch.arange(size), torch.arange(size) % 2), offset, i)
+            for i, (size, offset) in enumerate(zip(sizes, [0, 2]))
+        ])
+        loader = data.DataLoader(dataset, batch_sampler=InterleavedBatchSampler(sizes, batch_size=2))
+        self.assertEqual(len(loader), 2 + 3)
+        seen = []
+        for images, targets, dataset_idx in loader:
+            self.assertEqual(len(dataset_idx.unique()), 1)
+            self.assertTrue(torch.equal(targets, images % 2 + 2 * dataset_idx))
+            seen.extend((d, i) for d, i in zip(dataset_idx.tolist(), images.tolist()))
+        self.assertEqual(sorted(seen), [(d, i) for d, size in enumerate(sizes) for i in range(size)])
+
+    def test_tuned_data_loader(self):
+        dataset = data.TensorDataset(torch.arange(10))
+        batch_sampler = InterleavedBatchSampler([4, 6], batch_size=3)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, "cache.json")
+            settings = {"num_workers": 0, "pin_memory": False}
+            with open(cache_file, "w") as f:
+                json.dump({get_cache_key(dataset, 3, "tiny", "none"): {"settings": settings}}, f)
+            loader = tuned_dataloader(
+                dataset,
+                batch_size=3,
+                dataset_name="tiny",
+                transform_name="none",
+                cache_file=cache_file,
+                batch_sampler=batch_sampler,
+            )
+            self.assertEqual([batch.tolist() for batch, in loader], list(batch_sampler))
+
+    def test_duplicate_eval_sets(self):
+        self.assertEqual(len(parse_eval_sets(["cifar10:test", "cifar10:train", "cifar100:test:10"])), 3)
+        with self.assertRaises(ValueError):
+            parse_eval_sets(["cifar10:test:0", "cifar10:test:10"])
+
+
+class TestPrefixCache(TestCase):
+
+    @torch.no_grad()
+    def test_precisions(self):
+        register_tiny_clip()
+        images = torch.randn(6, 3, 32, 32)
+        dataset = data.Subset(data.TensorDataset(images, torch.arange(6) % 3), [4, 1, 2])
+        datasets = {}
+        for precision in ["fp32", "bf16"]:
+            args = prompt_args(
+                precision=precision, dataset="tiny", batch_size=2, num_workers=0, print_tqdm_interval=60
+            )
+            model = DeepPromptCLIP(args, SimpleNamespace(classes=CLASSES), "a photo of a {}")
+            datasets[precision] = get_prefix_dataset(model, dataset, args, cache_dir="cache")
+
+            prefix_dataset = datasets[precision]
+            self.assertEqual(len(prefix_dataset), 3)
+            with autocast("cpu", precision):
+                expected = model.encode_prefix(images[[4, 1, 2]]).float()
+            for i in range(3):
+                x, y = prefix_dataset[i]
+                self.assertEqual(x.dtype, torch.float16)
+                self.assertEqual(y, [4, 1, 2][i] % 3)
+                self.assertTrue(torch.allclose(x.float(), expected[i], atol=1e-2, rtol=1e-2))
+
+        self.assertNotEqual(datasets["fp32"].features_file, datasets["bf16"].features_file,
+                            msg="Every precision needs its own cache")
+
+
+class TinyDataset(data.TensorDataset):
+    """Random 32 x 32 images of CLASSES, in place of a CIFAR split."""
+
+    classes = CLASSES
+
+    def __init__(self, size):
+        super().__init__(torch.randn(size, 3, 32, 32), torch.arange(size) % len(CLASSES))
+
+
+class TestMultiPromptLearner(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        register_tiny_clip()
+        datasets = (TinyDataset(8), TinyDataset(4), TinyDataset(4))
+        patcher = mock.patch("learner.load_dataset", return_value=datasets)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def parse_option(self, *argv):
+        argv = [
+            "main.py", "--arch", ARCH, "--image_size", "32", "--batch_size", "4", "--num_workers", "0",
+            "--epochs", "2", "--warmup", "1", "--learning_rate", "1", "--print_tqdm_interval", "60",
+        ] + list(argv)
+        with mock.patch("sys.argv", argv):
+            return parse_option()
+
+    def test_results_of_every_prompter(self):
+        args = self.parse_option("--prompt_size", "4", "--prompters", "padding:4:random", "fixed_patch:2:random")
+        main_multi(args, ".")
+
+        results = sorted(fn for fn in os.listdir(".") if fn.endswith(".json"))
+        self.assertEqual(len(results), 2, msg="Every prompter needs its own result file")
+        self.assertEqual(sorted(os.listdir("results_vp_timing")), results,
+                         msg="Every prompter needs its own phase times")
+
+        model_folders = set()
+        for fn, method in zip(results, ["fixed_patch", "padding"]):
+            with open(fn) as f:
+                result = json.load(f)
+            self.assertEqual(result["method"], method)
+            model_folders.add(result["model_folder"])
+            self.assertGreaterEqual(result["best_epoch"], 1)
+            checkpoint = torch.load(os.path.join(result["model_folder"], "model_best.pth.tar"))
+            self.assertEqual(checkpoint["epoch"], result["best_epoch"])
+            model = VisualPromptCLIP(
+                SimpleNamespace(**result), SimpleNamespace(classes=CLASSES), "a photo of a {}"
+            )
+            model.prompt_learner.load_state_dict(checkpoint["state_dict"])
+        self.assertEqual(len(model_folders), 2, msg="Every prompter needs its own model folder")
+
+    def test_same_as_learner(self):
+        """A single prompter is trained exactly as by a Learner."""
+        args = self.parse_option("--method", "padding", "--prompt_size", "4")
+        learner = Learner(args)
+        multi_learner = MultiPromptLearner(args, [args])
+        multi_learner.clip.prompt_learners[0].load_state_dict(learner.clip.prompt_learner.state_dict())
+        learner.run()
+        multi_learner.run()
+        for name, tensor in learner.clip.prompt_learner.state_dict().items():
+            self.assertTrue(torch.allclose(tensor, multi_learner.clip.prompt_learners[0].state_dict()[name]))
+        self.assertEqual(len(learner.phase_times), 2)
+        self.assertEqual(len(multi_learner.phase_times), 2)
+
+    def test_run(self):
+        args = self.parse_option("--method", "padding", "--prompt_size", "4")
+        os.makedirs("results_vp")
+        run(args)
+        self.assertEqual(len(os.listdir("results_vp")), 1)
+        self.assertEqual(len(os.listdir("results_vp_timing")), 1)
+
+
+class TestCheckpointing(TestCase):
+
+    def test_round_trip(self):
+        register_tiny_clip()
+        args = prompt_args()
+        model = DeepPromptCLIP(args, SimpleNamespace(classes=CLASSES), "a photo of a {}")
+        states = []
+        writer = AsyncCheckpointWriter()
+        for epoch, is_best in [(1, True), (2, True), (3, False)]:
+            with torch.no_grad():
+                model.deep_prompt.add_(1.0)
+            state = {
+                "epoch": epoch,
+                "state_dict": trainable_state_dict(model),
+                "trainable_only": True,
+                "best_acc1": float(epoch),
+            }
+            writer.save(state, args, is_best=is_best)
+            states.append({k: v.clone() for k, v in state["state_dict"].items()})
+        # the states are snapshots, the update after the last save must not end up in the files
+        with torch.no_grad():
+            model.deep_prompt.add_(1.0)
+        writer.close()
+
+        self.assertEqual(sorted(os.listdir(".")), ["checkpoint.pth.tar", "model_best.pth.tar", "save"],
+                         msg="No temporary files may be left behind")
+        for filename, expected in [("checkpoint.pth.tar", states[2]), ("model_best.pth.tar", states[1])]:
+            checkpoint = torch.load(filename)
+            self.assertEqual(list(checkpoint["state_dict"]), ["deep_prompt"],
+                             msg="Only the prompts may be saved")
+            loaded = DeepPromptCLIP(args, SimpleNamespace(classes=CLASSES), "a photo of a {}")
+            load_prompt_checkpoint(loaded, "deep_prompt", checkpoint)
+            self.assertTrue(torch.equal(loaded.deep_prompt, expected["deep_prompt"]),
+                            msg=f"The prompts of {filename} differ after loading")
+
+    def test_error_is_raised(self):
+        writer = AsyncCheckpointWriter()
+        writer.save({"state_dict": {}}, SimpleNamespace(model_folder="missing"))
+        with self.assertRaises(RuntimeError):
+            writer.close()
+
+
+class TestPrecision(TestCase):
+
+    PRECISIONS = ["fp32", "bf16"] + (["fp16"] if torch.cuda.is_available() else [])
+
+    def check_forward(self, model, precision, device, train=False):
+        images = torch.rand(2, 3, 32, 32, device=device)
+        targets = torch.tensor([0, 1], device=device)
+        with torch.set_grad_enabled(train), autocast(device, precision):
+            logits = model(images)
+            loss = nn.functional.cross_entropy(logits, targets)
+        self.assertEqual(logits.shape, (2, len(CLASSES)))
+        self.assertTrue(torch.isfinite(logits).all(), msg=f"Non-finite logits in {precision}")
+        if train:
+            loss.backward()
+            grads = [p.grad for p in model.parameters() if p.requires_grad]
+            self.assertTrue(grads and all(g is not None and g.dtype == torch.float32 for g in grads),
+                            msg=f"The prompts must get float32 gradients in {precision}")
+
+    def test_forward(self):
+        for precision in self.PRECISIONS:
+            device = "cuda" if precision == "fp16" else "cpu"
+            with self.subTest(precision=precision):
+                clip_model = register_tiny_clip()
+                args = prompt_args(precision=precision, device=device)
+
+                zeroshot = ZeroshotCLIP(args, None, "a photo of a {}")
+                for module in clip_model.modules():
+                    if isinstance(module, LayerNorm):
+                        self.assertEqual(module.weight.dtype, torch.float32,
+                                         msg="The LayerNorms must keep float32 weights")
+                with torch.no_grad():
+                    self.assertEqual(zeroshot.model_inference(torch.rand(2, 3, 32, 32, device=device)).shape,
+                                     (2, len(CLASSES)))
+
+                for model_class in [VisualPromptCLIP, DeepPromptCLIP]:
+                    model = model_class(args, SimpleNamespace(classes=CLASSES), "a photo of a {}")
+                    model.clip_model.requires_grad_(False)
+                    model.train()
+                    self.check_forward(model, precision, device, train=True)
+                    model.eval()
+                    self.check_forward(model, precision, device)
+
+
+class TestTokenReduction(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(42)
+        # class token, 16 patches and 2 deep prompts
+        self.x = torch.randn(2, 19, 8)
+        self.size = torch.ones(2, 19, 1)
+
+    def check_protected(self, x, size):
+        self.assertTrue(torch.equal(x[:, :1], self.x[:, :1]), msg="The class token must not change")
+        self.assertTrue(torch.equal(x[:, -2:], self.x[:, -2:]), msg="The deep prompts must not change")
+        self.assertTrue(torch.equal(size[:, :1], self.size[:, :1]))
+        self.assertTrue(torch.equal(size[:, -2:], self.size[:, -2:]))
+
+    def test_merge(self):
+        x, size = merge_tokens(self.x, self.size, 5, protect_last=2)
+        self.assertEqual(x.shape, (2, 14, 8))
+        self.assertEqual(size.shape, (2, 14, 1))
+        self.check_protected(x, size)
+        self.assertTrue(torch.equal(size.sum(dim=1), self.size.sum(dim=1)),
+                        msg="Every patch must be represented by exactly one token")
+        self.assertTrue(torch.allclose((x * size).sum(dim=1), (self.x * self.size).sum(dim=1), atol=1e-5),
+                        msg="The merged tokens must be the size-weighted averages of their patches")
+
+    def test_merge_limits(self):
+        # at most half of the tokens can be merged in one step
+        x, size = merge_tokens(self.x, self.size, 100, protect_last=2)
+        self.assertEqual(x.shape[1], 19 - 8)
+        x, size = merge_tokens(self.x, self.size, 0, protect_last=2)
+        self.assertIs(x, self.x)
+
+    def test_merge_duplicates(self):
+        x = self.x.clone()
+        x[:, 2] = x[:, 1]
+        merged, size = merge_tokens(x, self.size, 1, protect_last=2)
+        self.assertEqual(size.max().item(), 2)
+        self.assertTrue(torch.allclose(merged[size[..., 0] == 2], x[:, 1], atol=1e-5),
+                        msg="The identical tokens must be merged")
+
+    def test_prune(self):
+        block = ResidualAttentionBlock(8, 2)
+        x, size = prune_tokens(self.x, self.size, 5, block, protect_last=2)
+        self.assertEqual(x.shape, (2, 14, 8))
+        self.assertEqual(size.shape, (2, 14, 1))
+        self.check_protected(x, size)
+        self.assertTrue(torch.equal(size, torch.ones_like(size)), msg="Pruning does not change the sizes")
+        for i in range(2):
+            rows = [(self.x[i, 1:17] == token).all(dim=1).nonzero().item() for token in x[i, 1:-2]]
+            self.assertEqual(rows, sorted(rows), msg="The kept tokens must be original tokens in their order")
+
+        # at least one patch token is kept
+        x, size = prune_tokens(self.x, self.size, 100, block, protect_last=2)
+        self.assertEqual(x.shape[1], 1 + 1 + 2)
+
+    def test_run(self):
+        blocks = [ResidualAttentionBlock(8, 2) for _ in range(3)]
+        schedule = parse_token_schedule("2,0,3", 3)
+        self.assertEqual(schedule, [2, 0, 3])
+        with self.assertRaises(ValueError):
+            parse_token_schedule("1,2", 3)
+        for method in ["merge", "prune"]:
+            with self.subTest(method=method):
+                x, size = TokenReduction(schedule, method).run(blocks, self.x[:, :17].permute(1, 0, 2))
+                self.assertEqual(x.shape, (17 - 5, 2, 8))
+                self.assertEqual(size.shape, (2, 17 - 5, 1))
+                if method == "merge":
+                    self.assertTrue(torch.equal(size.sum(dim=1), torch.full((2, 1), 17.0)))
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestTemplateSweep)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestInputResolution)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestClipServer)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestLargeVocabulary)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestInterleavedBatchSampler)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestPrefixCache)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestMultiPromptLearner)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCheckpointing)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestPrecision)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestTokenReduction)
+    unittest.TextTestRunner(verbosity=2).run(suite)
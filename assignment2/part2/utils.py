@@ -16,9 +16,11 @@
 
 """Helper functions for training and testing."""
 import os
+import queue
+import threading
+import time
 import torch
 import numpy as np
-import shutil
 
 
 def set_seed(seed):
@@ -75,7 +77,8 @@ def cosine_lr(optimizer, base_lr, warmup_length, steps):
         else:
             e = step - warmup_length
             es = steps - warmup_length
-            lr = 0.5 * (1 + np.cos(np.pi * e / es)) * base_lr
+            # a float, not a numpy scalar, so the optimizer state loads with torch.load(weights_only=True)
+            lr = float(0.5 * (1 + np.cos(np.pi * e / es)) * base_lr)
         assign_learning_rate(optimizer, lr)
         return lr
 
@@ -116,15 +119,130 @@ class ProgressMeter(object):
         return "[" + fmt + "/" + fmt.format(num_batches) + "]"
 
 
+class PhaseTimer(object):
+    """
+    Wall-clock time of the phases of every step, e.g. data loading, forward and backward pass.
+
+    A phase lasts from the end of the previous phase (or from start) until lap is called with
+    its name. On the GPU the device is synchronized at every lap, so the asynchronously launched
+    kernels are attributed to the phase that launched them.
+    """
+
+    def __init__(self, phases, device="cpu"):
+        self.phases = list(phases)
+        self.synchronize = device.startswith("cuda")
+        self.reset()
+
+    def reset(self):
+        self.times = {phase: [] for phase in self.phases}
+        self.last = None
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start(self):
+        self.last = self._now()
+
+    def lap(self, phase):
+        now = self._now()
+        self.times[phase].append(now - self.last)
+        self.last = now
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Returns the count, total, mean and percentiles (in seconds) of the recorded times of every phase."""
+        summary = {}
+        for phase, times in self.times.items():
+            if not times:
+                continue
+            times = np.asarray(times)
+            summary[phase] = {
+                "count": len(times),
+                "total": float(times.sum()),
+                "mean": float(times.mean()),
+                **{f"p{q}": float(np.percentile(times, q)) for q in percentiles},
+            }
+        return summary
+
+
+def snapshot(obj):
+    """Returns a copy of (a nested structure of) tensors on the CPU, which is safe to write while training continues."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def trainable_state_dict(model):
+    """Returns the parameters of the model that require gradients (the prompts)."""
+    return {
+        name: param for name, param in model.named_parameters() if param.requires_grad
+    }
+
+
+def save_atomic(state, filename):
+    """Writes the checkpoint to a temporary file first and renames it, so readers never see a partial file."""
+    tmp_filename = f"{filename}.tmp"
+    torch.save(state, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
 def save_checkpoint(state, args, is_best=False, filename="checkpoint.pth.tar"):
     savefile = os.path.join(args.model_folder, filename)
     bestfile = os.path.join(args.model_folder, "model_best.pth.tar")
-    torch.save(state, savefile)
+    save_atomic(state, savefile)
     if is_best:
-        shutil.copyfile(savefile, bestfile)
+        # Adam: hard link instead of copying the file, the next save replaces savefile with a new file
+        tmp_bestfile = f"{bestfile}.tmp"
+        if os.path.lexists(tmp_bestfile):
+            os.remove(tmp_bestfile)
+        os.link(savefile, tmp_bestfile)
+        os.replace(tmp_bestfile, bestfile)
         print("saved best file")
 
 
+class AsyncCheckpointWriter:
+    """
+    Saves checkpoints (see save_checkpoint) from a background thread, so training does not stall
+    while writing. The states passed to save are copied to the CPU first.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            state, args, kwargs = item
+            try:
+                save_checkpoint(state, args, **kwargs)
+            except Exception as e:  # reported in the training thread by save()/close()
+                self.error = e
+
+    def save(self, state, args, **kwargs):
+        self._raise_error()
+        self.queue.put((snapshot(state), args, kwargs))
+
+    def close(self):
+        """Waits until all queued checkpoints are written."""
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from self.error
+
+
 def get_device() -> str:
     """Returns the device for PyTorch to use, including Mac support."""
     device = "cpu"
@@ -0,0 +1,113 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""
+Forward pass of the CLIP vision transformer at any input resolution.
+
+The positional embedding of the pretrained models covers the patch grid of their input resolution.
+For other resolutions it is interpolated (bicubic) to the patch grid of the input, and the result is
+cached, so it is computed only once per (model, dtype, device, grid).
+"""
+import torch
+import torch.nn.functional as F
+
+
+_positional_embeddings = {}
+
+
+def interpolate_positional_embedding(positional_embedding, grid):
+    """Interpolates the positional embedding of shape (old_grid ** 2 + 1, width) to a grid x grid patches."""
+    class_embedding, patch_embedding = positional_embedding[:1], positional_embedding[1:]
+    old_grid = int(round(patch_embedding.shape[0] ** 0.5))
+    width = patch_embedding.shape[-1]
+    patch_embedding = (
+        patch_embedding.float().reshape(1, old_grid, old_grid, width).permute(0, 3, 1, 2)
+    )
+    patch_embedding = F.interpolate(
+        patch_embedding, size=(grid, grid), mode="bicubic", align_corners=False
+    )
+    patch_embedding = patch_embedding.permute(0, 2, 3, 1).reshape(grid * grid, width)
+    return torch.cat([class_embedding, patch_embedding.to(positional_embedding.dtype)])
+
+
+def get_positional_embedding(visual, grid):
+    """Returns the positional embedding of the vision transformer for a grid x grid patches."""
+    positional_embedding = visual.positional_embedding
+    if positional_embedding.shape[0] == grid * grid + 1:
+        return positional_embedding
+    key = (
+        positional_embedding.data_ptr(),
+        positional_embedding.dtype,
+        positional_embedding.device,
+        grid,
+    )
+    if key not in _positional_embeddings:
+        with torch.no_grad():
+            _positional_embeddings[key] = interpolate_positional_embedding(
+                positional_embedding, grid
+            )
+    return _positional_embeddings[key]
+
+
+def embed_patches(visual, images):
+    """
+    Embeds the images into the input tokens of the transformer
+    (cf. https://github.com/openai/CLIP/blob/main/clip/model.py#L223).
+
+    Returns:
+        torch.Tensor: tokens of shape (batch_size, grid ** 2 + 1, width)
+    """
+    x = images.type(visual.conv1.weight.dtype)
+    x = visual.conv1(x)  # shape = [*, width, grid, grid]
+    grid = x.shape[-1]
+    x = x.reshape(x.shape[0], x.shape[1], -1)  # shape = [*, width, grid ** 2]
+    x = x.permute(0, 2, 1)  # shape = [*, grid ** 2, width]
+    x = torch.cat(
+        [
+            visual.class_embedding.to(x.dtype)
+            + torch.zeros(x.shape[0], 1, x.shape[-1], dtype=x.dtype, device=x.device),
+            x,
+        ],
+        dim=1,
+    )  # shape = [*, grid ** 2 + 1, width]
+    x = x + get_positional_embedding(visual, grid).to(x.dtype)
+    return visual.ln_pre(x)
+
+
+def encode_image(visual, images, token_reduction=None):
+    """
+    Image encoder of CLIP (the same as clip_model.encode_image) at the resolution of the images,
+    with an optional token reduction (see token_reduction.py).
+    """
+    if not hasattr(visual, "transformer"):
+        if token_reduction is not None or images.shape[-1] != visual.input_resolution:
+            raise ValueError(
+                "Token reduction and other input resolutions are only supported for the ViT backbones"
+            )
+        return visual(images.type(visual.conv1.weight.dtype))
+
+    x = embed_patches(visual, images)
+    x = x.permute(1, 0, 2)  # NLD -> LND
+    if token_reduction is None:
+        x = visual.transformer(x)
+    else:
+        x, _ = token_reduction.run(visual.transformer.resblocks, x)
+    x = x.permute(1, 0, 2)  # LND -> NLD
+
+    x = visual.ln_post(x[:, 0, :])
+    if visual.proj is not None:
+        x = x @ visual.proj
+    return x
@@ -21,7 +21,10 @@ import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
 
-from clip import clip
+from text_features import get_text_features
+from clip_registry import get_clip_model
+from precision import get_precision, prepare_clip_model
+from vit import encode_image
 from vp import (
     PadPrompter,
     FixedPatchPrompter,
@@ -36,21 +39,7 @@ PROMPT_TYPES = {
 
 def load_clip_to_cpu(cfg):
     """Loads CLIP model to CPU."""
-    backbone_name = cfg.MODEL.BACKBONE.NAME
-    url = clip._MODELS[backbone_name]
-    model_path = clip._download(url)
-
-    try:
-        # loading JIT archive
-        model = torch.jit.load(model_path, map_location="cpu").eval()
-        state_dict = None
-
-    except RuntimeError:
-        state_dict = torch.load(model_path, map_location="cpu")
-
-    model = clip.build_model(state_dict or model.state_dict())
-
-    return model
+    return get_clip_model(cfg.MODEL.BACKBONE.NAME)
 
 
 class VisualPromptCLIP(nn.Module):
@@ -64,9 +53,9 @@ class VisualPromptCLIP(nn.Module):
         clip_model = self.load_clip_to_cpu(args)
         clip_model.to(args.device)
 
-        # Hack to make model as float() (This is a CLIP hack)
-        if args.device == "cpu" or args.device == "mps":
-            clip_model = clip_model.float()
+        # Adam: store the frozen weights in the precision of the policy, instead of always upcasting on the CPU
+        self.precision = get_precision(args)
+        clip_model = prepare_clip_model(clip_model, self.precision)
 
         prompts = [template.format(c.replace("_", " ")) for c in classnames]
         print("List of prompts:")
@@ -82,12 +71,8 @@ class VisualPromptCLIP(nn.Module):
         # Instructions:
         # - Given a list of prompts, compute the text features for each prompt.
         # - Return a tensor of shape (num_prompts, 512).
-        with torch.no_grad():
-            tokenized_prompts = torch.cat([clip.tokenize(p) for p in prompts]).to(
-                args.device
-            )
-            text_features = clip_model.encode_text(tokenized_prompts)
-            text_features /= text_features.norm(dim=-1, keepdim=True)
+        # Adam: the text features only depend on the prompts and the weights, so they are cached on disk
+        text_features = get_text_features(clip_model, args.arch, prompts, args.device)
 
         #######################
         # END OF YOUR CODE    #
@@ -98,6 +83,7 @@ class VisualPromptCLIP(nn.Module):
         self.logit_scale = self.clip_model.logit_scale.exp().detach()
 
         assert args.method in PROMPT_TYPES, f"{args.method} is not supported :)!"
+        self.image_size = args.image_size
         self.prompt_learner = PROMPT_TYPES[args.method](args)
 
         if args.visualize_prompt:
@@ -125,7 +111,8 @@ class VisualPromptCLIP(nn.Module):
         # - Return logits of shape (batch size, number of classes).
 
         images = self.prompt_learner(images)
-        image_features = self.clip_model.encode_image(images)
+        # Adam: the same as clip_model.encode_image, but also at other input resolutions (see vit.py)
+        image_features = encode_image(self.clip_model.visual, images)
         # do NOT use image_features /= image_features.norm(dim=-1, keepdim=True) here, as the inplace operation
         # will break gradient calculation
         image_features = image_features / image_features.norm(dim=-1, keepdim=True)
@@ -139,25 +126,48 @@ class VisualPromptCLIP(nn.Module):
 
     def load_clip_to_cpu(self, args):
         """Loads CLIP model to CPU."""
-        backbone_name = args.arch
-        url = clip._MODELS[backbone_name]
-        model_path = clip._download(url, args.root)
-        try:
-            # loading JIT archive
-            model = torch.jit.load(model_path, map_location="cpu").eval()
-            state_dict = None
-        except RuntimeError:
-            state_dict = torch.load(model_path, map_location="cpu")
-
-        model = clip.build_model(state_dict or model.state_dict())
-        return model
+        # Adam: the model is loaded only once per process and shared (see clip_registry.py)
+        return get_clip_model(args.arch, args.root)
 
     @torch.no_grad()
     def visualize_prompt(self, filename, device):
         """Visualizes the prompt."""
-        fake_img = torch.ones(1, 3, 224, 224).to(device)
+        fake_img = torch.ones(1, 3, self.image_size, self.image_size).to(device)
         prompted_img = self.prompt_learner(fake_img)[0].cpu()
         prompted_img = torch.clamp(prompted_img, 0, 1)
 
         print("Visualizing prompt...")
         plt.imsave(f"{filename}.png", prompted_img.permute(1, 2, 0).numpy())
+
+
+class MultiVisualPromptCLIP(VisualPromptCLIP):
+    """
+    VisualPromptCLIP with several prompters that are trained together.
+    All prompters are applied to the same batch and the prompted copies are encoded in a single
+    encode_image call, so the data pipeline and the text features are shared between them.
+    """
+
+    def __init__(self, args, prompter_args, dataset, template="This is a photo of {}"):
+        super(MultiVisualPromptCLIP, self).__init__(args, dataset, template=template)
+        # the prompter built from args is replaced by one prompter per entry of prompter_args
+        del self.prompt_learner
+        for p_args in prompter_args:
+            assert p_args.method in PROMPT_TYPES, f"{p_args.method} is not supported :)!"
+        self.prompt_learners = nn.ModuleList(
+            [PROMPT_TYPES[p_args.method](p_args) for p_args in prompter_args]
+        )
+
+    def forward(self, images, active=None):
+        """
+        Forward pass of the prompters with the given indices (all by default).
+
+        Returns:
+            logits of shape (number of prompters, batch size, number of classes)
+        """
+        if active is None:
+            active = range(len(self.prompt_learners))
+        prompted = torch.cat([self.prompt_learners[k](images) for k in active])
+        image_features = encode_image(self.clip_model.visual, prompted)
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        similarity = self.logit_scale * image_features @ self.text_features.T
+        return similarity.view(len(active), images.size(0), -1)
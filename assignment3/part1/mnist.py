@@ -14,13 +14,19 @@
 # Date Created: 2022-11-25
 ################################################################################
 
+import os
+import sys
+
 import torchvision
 from torchvision import transforms
 import torch
-import torch.utils.data as data
 from torch.utils.data import random_split
 import numpy as np
 
+# Adam: the DataLoader autotuner is shared by all assignments, it lives in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from loader_autotune import tuned_dataloader  # noqa: E402
+
 
 class DiscretizeTransform(object):
     def __init__(self, num_values):
@@ -31,7 +37,7 @@ class DiscretizeTransform(object):
         return (x * self.num_values).long().clamp_(max=self.num_values-1)
 
 
-def mnist(root='../data/', batch_size=128, num_workers=4, download=True):
+def mnist(root='../data/', batch_size=128, num_workers=4, download=True, autotune_loader=False):
     """
     Returns data loaders for 4-bit MNIST dataset, i.e. values between 0 and 15.
 
@@ -43,6 +49,8 @@ def mnist(root='../data/', batch_size=128, num_workers=4, download=True):
         num_workers - Number of workers to use in the data loaders.
         download - If True, MNIST is downloaded if it cannot be found in the specified
                    root directory.
+        autotune_loader - If True, the worker, prefetching and pinning settings of the data
+                          loaders are autotuned (see loader_autotune.py) instead of num_workers.
     """
     data_transforms = transforms.Compose([transforms.ToTensor(),
                                           DiscretizeTransform(num_values=16)
@@ -60,14 +68,17 @@ def mnist(root='../data/', batch_size=128, num_workers=4, download=True):
     # Each data loader returns tuples of (img, label)
     # For the generative models we don't need the labels, which we need to take into account
     # when writing the train code.
-    train_loader = data.DataLoader(
-        train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+    train_loader = tuned_dataloader(
+        train_dataset, batch_size=batch_size, enabled=autotune_loader,
+        dataset_name='MNIST4bit_train', shuffle=True, num_workers=num_workers,
         pin_memory=True)
-    val_loader = data.DataLoader(
-        val_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+    val_loader = tuned_dataloader(
+        val_dataset, batch_size=batch_size, enabled=autotune_loader,
+        dataset_name='MNIST4bit_val', shuffle=False, num_workers=num_workers,
         drop_last=False)
-    test_loader = data.DataLoader(
-        test_set, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+    test_loader = tuned_dataloader(
+        test_set, batch_size=batch_size, enabled=autotune_loader,
+        dataset_name='MNIST4bit_test', shuffle=False, num_workers=num_workers,
         drop_last=False)
 
     return train_loader, val_loader, test_loader
@@ -212,7 +212,8 @@ def train_vae(args):
     os.makedirs(args.log_dir, exist_ok=True)
     train_loader, val_loader, test_loader = mnist(batch_size=args.batch_size,
                                                    num_workers=args.num_workers,
-                                                   root=args.data_dir)
+                                                   root=args.data_dir,
+                                                   autotune_loader=args.autotune_loader)
 
     # Create a PyTorch Lightning trainer with the generation callback
     gen_callback = GenerateCallback(save_to_disk=True)
@@ -283,6 +284,9 @@ if __name__ == '__main__':
     parser.add_argument('--num_workers', default=4, type=int,
                         help='Number of workers to use in the data loaders. To have a truly deterministic run, this has to be 0. ' + \
                              'For your assignment report, you can use multiple workers (e.g. 4) and do not have to set it to 0.')
+    parser.add_argument('--autotune_loader', action='store_true',
+                        help='Autotune the data loader settings on first use and reuse them afterwards, '
+                             'instead of using num_workers.')
     parser.add_argument('--log_dir', default='VAE_logs', type=str,
                         help='Directory where the PyTorch Lightning logs should be created.')
     parser.add_argument('--progress_bar', action='store_true',
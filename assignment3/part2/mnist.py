@@ -14,13 +14,19 @@
 # Date Created: 2022-11-25
 ################################################################################
 
+import os
+import sys
+
 import torch
 from torchvision import transforms
 from torchvision import datasets
-from torch.utils.data import DataLoader
+
+# Adam: the DataLoader autotuner is shared by all assignments, it lives in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from loader_autotune import tuned_dataloader  # noqa: E402
 
 
-def mnist(root="../data", batch_size=64, num_workers=4, download=True):
+def mnist(root="../data", batch_size=64, num_workers=4, download=True, autotune_loader=False):
     """
     Returns the data loader for the training set of MNIST dataset.
     Inputs:
@@ -31,6 +37,8 @@ def mnist(root="../data", batch_size=64, num_workers=4, download=True):
         num_workers - Number of workers to use in the data loaders.
         download - If True, MNIST is downloaded if it cannot be found in the specified
                    root directory.
+        autotune_loader - If True, the worker, prefetching and pinning settings of the data
+                          loader are autotuned (see loader_autotune.py) instead of num_workers.
     """
 
     data_transforms = transforms.Compose([transforms.ToTensor(),
@@ -38,10 +46,12 @@ def mnist(root="../data", batch_size=64, num_workers=4, download=True):
     train_dataset = datasets.MNIST(root, train=True, download=download,
                                    transform=data_transforms)
 
-    train_loader = DataLoader(train_dataset,
-                              batch_size=batch_size,
-                              shuffle=True,
-                              num_workers=num_workers,
-                              pin_memory=True)
+    train_loader = tuned_dataloader(train_dataset,
+                                    batch_size=batch_size,
+                                    enabled=autotune_loader,
+                                    dataset_name="MNIST_normalized_train",
+                                    shuffle=True,
+                                    num_workers=num_workers,
+                                    pin_memory=True)
 
     return train_loader
@@ -181,7 +181,8 @@ def main(args):
 
     train_loader = mnist(root=args.data_dir,
                          batch_size=args.batch_size,
-                         num_workers=args.num_workers)
+                         num_workers=args.num_workers,
+                         autotune_loader=args.autotune_loader)
 
     args.cuda = not args.no_cuda and torch.cuda.is_available()
     # device = torch.device("cuda:0" if args.cuda else "cpu")
@@ -262,6 +263,9 @@ if __name__ == '__main__':
     parser.add_argument('--num_workers', default=4, type=int,
                         help='Number of workers to use in the data loaders.' +
                              'To have a truly deterministic run, this has to be 0.')
+    parser.add_argument('--autotune_loader', action='store_true',
+                        help='Autotune the data loader settings on first use and ' +
+                             'reuse them afterwards, instead of using num_workers.')
     parser.add_argument('--log_dir', default='AAE_logs/', type=str,
                         help='Directory where the PyTorch Lightning logs ' +
                              'should be created.')
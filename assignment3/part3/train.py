@@ -1,9 +1,11 @@
 import argparse
+import os
+import sys
 
 import torch
 import torchmetrics
 from torch.nn import functional as F
-from torch.utils.data import DataLoader, RandomSampler
+from torch.utils.data import RandomSampler
 
 import pytorch_lightning as pl
 from lightning.pytorch.loggers import TensorBoardLogger
@@ -14,6 +16,10 @@ from gpt import GPT
 from dataset import TextDataset
 from generate import generate as generate_pretrained
 
+# Adam: the DataLoader autotuner is shared by all assignments, it lives in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from loader_autotune import tuned_dataloader  # noqa: E402
+
 
 
 class GPTLightningModule(pl.LightningModule):
@@ -124,9 +130,11 @@ class GPTLightningModule(pl.LightningModule):
     
     def train_dataloader(self):
         # Setup the dataloader
-        train_loader = DataLoader(
+        train_loader = tuned_dataloader(
             self.train_dataset,
             batch_size=self.config.train_batch_size, 
+            enabled=self.config.autotune_loader,
+            dataset_name=f"TextDataset_{os.path.basename(self.config.txt_file)}_block{self.config.block_size}",
             sampler=RandomSampler(self.train_dataset, replacement=True),
             shuffle=False,
             drop_last=True, 
@@ -204,6 +212,7 @@ if __name__ == "__main__":
     parser.add_argument('--log_dir', type=str, default='./logs', help='Sets logging directory for tensorboard logger.')
     parser.add_argument('--seed', type=int, default=0, help='Seed for pseudo-random number generator')
     parser.add_argument('--num_workers', type=int, default=8, help='Num cpu workers used for training')
+    parser.add_argument('--autotune_loader', action='store_true', help='Autotune the data loader settings on first use and reuse them afterwards, instead of using num_workers')
     parser.add_argument('--progress_bar', action='store_true', help=(
                             'Use a progress bar indicator for interactive experimentation. '
                             'Not to be used in conjuction with SLURM jobs'
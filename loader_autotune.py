@@ -0,0 +1,260 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2022 University of Amsterdam
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to conditions.
+#
+# Author: Deep Learning Course (UvA) | Fall 2022
+# Date Created: 2022-11-14
+################################################################################
+
+"""
+DataLoader autotuner shared by the training scripts of all assignments.
+
+On first use for a given (dataset, transform, batch size, host), a few candidate combinations of
+num_workers, prefetch_factor, persistent_workers and pin_memory are benchmarked for a couple of
+seconds. The fastest one is cached in a local JSON file and reused on later runs.
+
+Datasets with a set_epoch method (e.g. the augmentation bank) change between epochs in the main
+process. Persistent workers keep their own copy of the dataset and would never see the change, so
+they are not used for these datasets.
+
+The assignments are run from their own directories, so the scripts add the repository root to
+sys.path before importing this module:
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+    from loader_autotune import tuned_dataloader
+"""
+import json
+import os
+import socket
+import time
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+# Settings of the DataLoader that are tuned, all other arguments are passed through unchanged
+TUNED_KWARGS = ("num_workers", "prefetch_factor", "persistent_workers", "pin_memory")
+
+DEFAULT_CACHE_FILE = os.environ.get(
+    "LOADER_AUTOTUNE_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "uvadlc", "loader_autotune.json"),
+)
+
+
+def get_host_name():
+    """Returns an identifier of the host, including the resources visible to this process."""
+    num_cpus = (
+        len(os.sched_getaffinity(0))
+        if hasattr(os, "sched_getaffinity")
+        else os.cpu_count()
+    )
+    return f"{socket.gethostname()}_cpu{num_cpus}_cuda{torch.cuda.device_count()}"
+
+
+def describe_dataset(dataset):
+    """Returns the name (with the number of samples) and the transform description of a (possibly wrapped) dataset."""
+    num_samples = len(dataset)
+    while isinstance(dataset, Subset):
+        dataset = dataset.dataset
+    transform = getattr(dataset, "transform", None)
+    return f"{type(dataset).__name__}_{num_samples}", " ".join(repr(transform).split())
+
+
+def has_epoch_state(dataset):
+    """Whether the (possibly wrapped) dataset changes between epochs through set_epoch."""
+    while isinstance(dataset, Subset):
+        dataset = dataset.dataset
+    return hasattr(dataset, "set_epoch")
+
+
+def get_cache_key(dataset, batch_size, dataset_name=None, transform_name=None):
+    """Returns the cache key of the tuned settings for the dataset, transform, batch size and host."""
+    default_dataset_name, default_transform_name = describe_dataset(dataset)
+    return "|".join(
+        [
+            dataset_name or default_dataset_name,
+            transform_name or default_transform_name,
+            f"bs{batch_size}",
+            get_host_name(),
+        ]
+    )
+
+
+def load_cache(cache_file=DEFAULT_CACHE_FILE):
+    if not os.path.isfile(cache_file):
+        return {}
+    with open(cache_file) as f:
+        return json.load(f)
+
+
+def save_cache(cache, cache_file=DEFAULT_CACHE_FILE):
+    """Writes the cache atomically, so concurrent jobs never read a partial file."""
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, cache_file)
+
+
+def get_candidates(max_workers=None, persistent_workers=True):
+    """
+    Returns the candidate settings to benchmark, with a worker count doubling up to the number of CPUs.
+    Without persistent_workers, no candidates with persistent workers are included.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    pin_memory_options = [False, True] if torch.cuda.is_available() else [False]
+
+    candidates = [
+        {"num_workers": 0, "pin_memory": pin_memory}
+        for pin_memory in pin_memory_options
+    ]
+    num_workers = 2
+    while num_workers <= max_workers:
+        worker_options = ((2, False), (2, True), (4, True))
+        if not persistent_workers:
+            worker_options = ((2, False), (4, False))
+        for prefetch_factor, persistent in worker_options:
+            for pin_memory in pin_memory_options:
+                candidates.append(
+                    {
+                        "num_workers": num_workers,
+                        "prefetch_factor": prefetch_factor,
+                        "persistent_workers": persistent,
+                        "pin_memory": pin_memory,
+                    }
+                )
+        num_workers *= 2
+    return candidates
+
+
+def make_dataloader(dataset, batch_size, **kwargs):
+    """
+    Returns a DataLoader of the dataset. With a batch_sampler, the batches come from the sampler and
+    batch_size is only the (typical) size of a batch, as in the cache key.
+    """
+    if kwargs.get("batch_sampler") is not None:
+        return DataLoader(dataset, **kwargs)
+    return DataLoader(dataset, batch_size=batch_size, **kwargs)
+
+
+def benchmark_loader(dataset, batch_size, settings, seconds, num_epochs=2, **kwargs):
+    """
+    Returns the number of samples per second the loader delivers with the given settings.
+
+    The time budget is split over num_epochs short epochs, so the cost of (re)starting the workers
+    at the start of an epoch is included, which is what persistent_workers saves.
+    With pin_memory, the batches are also copied to the GPU, as pinning only pays off there.
+    """
+    loader = make_dataloader(dataset, batch_size, **kwargs, **settings)
+    device = "cuda" if settings.get("pin_memory") else None
+    num_samples = 0
+    start_time = time.perf_counter()
+    for epoch in range(num_epochs):
+        epoch_deadline = start_time + seconds * (epoch + 1) / num_epochs
+        for batch in loader:
+            if device is not None:
+                batch = [
+                    t.to(device, non_blocking=True)
+                    for t in batch
+                    if isinstance(t, torch.Tensor)
+                ]
+            num_samples += batch_size
+            if time.perf_counter() > epoch_deadline:
+                break
+    if device is not None:
+        torch.cuda.synchronize()
+    throughput = num_samples / (time.perf_counter() - start_time)
+    del loader
+    return throughput
+
+
+def autotune(
+    dataset,
+    batch_size,
+    dataset_name=None,
+    transform_name=None,
+    cache_file=DEFAULT_CACHE_FILE,
+    seconds_per_candidate=2.0,
+    max_workers=None,
+    verbose=True,
+    **kwargs,
+):
+    """
+    Returns the fastest loader settings for the dataset, benchmarking them on first use.
+
+    Args:
+        dataset: Dataset to load.
+        batch_size: Batch size of the loader.
+        dataset_name: Name of the dataset in the cache key, by default its class name and size.
+        transform_name: Description of the transform in the cache key, by default its repr.
+        cache_file: JSON file the tuned settings are stored in.
+        seconds_per_candidate: Time to benchmark every candidate for.
+        max_workers: Maximal number of workers to try, by default the number of CPUs.
+        kwargs: Other arguments of the DataLoader, used during the benchmark.
+    Returns:
+        settings: Dictionary with the tuned DataLoader arguments.
+    """
+    key = get_cache_key(dataset, batch_size, dataset_name, transform_name)
+    cache = load_cache(cache_file)
+    if key in cache:
+        return cache[key]["settings"]
+
+    results = []
+    for settings in get_candidates(
+        max_workers, persistent_workers=not has_epoch_state(dataset)
+    ):
+        throughput = benchmark_loader(
+            dataset, batch_size, settings, seconds_per_candidate, **kwargs
+        )
+        results.append((throughput, settings))
+        if verbose:
+            print(f"DataLoader autotune {settings}: {throughput:.1f} samples/s")
+    throughput, settings = max(results, key=lambda r: r[0])
+    if verbose:
+        print(f"DataLoader autotune selected {settings} ({throughput:.1f} samples/s)")
+
+    # Re-read the cache, another job might have added entries in the meantime
+    cache = load_cache(cache_file)
+    cache[key] = {"settings": settings, "throughput": throughput}
+    save_cache(cache, cache_file)
+    return settings
+
+
+def tuned_dataloader(
+    dataset,
+    batch_size,
+    enabled=True,
+    dataset_name=None,
+    transform_name=None,
+    cache_file=DEFAULT_CACHE_FILE,
+    **kwargs,
+):
+    """
+    Returns a DataLoader with autotuned worker, prefetching and pinning settings.
+
+    The tuned settings override the corresponding arguments in kwargs. If not enabled, the
+    DataLoader is created with kwargs as given, so callers can keep their previous defaults.
+    """
+    if not enabled:
+        return make_dataloader(dataset, batch_size, **kwargs)
+    fixed_kwargs = {k: v for k, v in kwargs.items() if k not in TUNED_KWARGS}
+    settings = autotune(
+        dataset,
+        batch_size,
+        dataset_name=dataset_name,
+        transform_name=transform_name,
+        cache_file=cache_file,
+        **fixed_kwargs,
+    )
+    if has_epoch_state(dataset) and settings.get("persistent_workers"):
+        # settings cached before persistent workers were excluded for these datasets
+        settings = dict(settings, persistent_workers=False)
+    return make_dataloader(dataset, batch_size, **fixed_kwargs, **settings)